@@ -1,9 +1,31 @@
 import os
 import re
+import json
+import time
+import random
+import uuid
+import weakref
+import atexit
+import bisect
 import hashlib
+import hmac
+import threading
+import unicodedata
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import requests
+import httpx
 import pytz
-from openai import OpenAI
+import numpy as np
+from openai import (
+    OpenAI,
+    APIError,
+    APIConnectionError,
+    RateLimitError,
+    InternalServerError,
+)
 
 from flask import (
     Flask,
@@ -12,17 +34,21 @@ from flask import (
     session,
     request,
     render_template_string,
+    jsonify,
+    Response,
 )
 
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.rest import Client as TwilioClient
 
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, time as dt_time
 from dotenv import load_dotenv
 
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request as GoogleAuthRequest
 
 from werkzeug.middleware.proxy_fix import ProxyFix
 
@@ -60,2934 +86,8348 @@ app.wsgi_app = ProxyFix(
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-5-mini")
 
+# Opcional: otro endpoint compatible (proxy, servidor falso en
+# pruebas).
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
 if not OPENAI_API_KEY:
     print("ADVERTENCIA: falta OPENAI_API_KEY.")
 
 client = None
 
 if OPENAI_API_KEY:
+    # Sin reintentos del SDK: los maneja crear_completion().
     client = OpenAI(
-        api_key=OPENAI_API_KEY
+        api_key=OPENAI_API_KEY,
+        base_url=OPENAI_BASE_URL,
+        max_retries=0,
     )
 
 
 # ============================================================
-# MODO SIN BASE DE DATOS
+# OPENAI - RESILIENCIA
 # ============================================================
 
-# PostgreSQL deshabilitado temporalmente para esta prueba.
-# El flujo de WhatsApp mantiene el estado en memoria y Google Calendar
-# sigue siendo la fuente de verdad para disponibilidad y reservas.
+# Todas las llamadas a chat.completions pasan por
+# crear_completion(): plazo por intento y total, reintentos con
+# jitter, hedging opcional y un cortacircuitos que, con el
+# proveedor caído, responde al instante con el mensaje de respaldo.
 
-DATABASE_URL = None
+# Plazo de cada intento y de la llamada completa, con reintentos.
+OPENAI_TIMEOUT_SECONDS = float(
+    os.getenv("OPENAI_TIMEOUT_SECONDS", "15")
+)
+OPENAI_DEADLINE_SECONDS = float(
+    os.getenv("OPENAI_DEADLINE_SECONDS", "25")
+)
 
-def db_connect():
-    return None
+OPENAI_REINTENTOS = int(
+    os.getenv("OPENAI_REINTENTOS", "2")
+)
+OPENAI_REINTENTO_BASE_SECONDS = float(
+    os.getenv("OPENAI_REINTENTO_BASE_SECONDS", "0.5")
+)
 
-def init_database():
-    print("MODO SIN POSTGRESQL: base de datos deshabilitada.")
+# Hedging: si la respuesta tarda más que este percentil de las
+# latencias recientes, se lanza una segunda llamada igual y se usa
+# la primera que responda. 0 lo desactiva (cuesta tokens extra).
+OPENAI_HEDGE_PERCENTIL = float(
+    os.getenv("OPENAI_HEDGE_PERCENTIL", "0")
+)
+OPENAI_HEDGE_MIN_MUESTRAS = 20
 
-def obtener_conversacion(cliente_id, canal="web"):
-    return None
+# Fallos seguidos que abren el circuito y segundos que queda
+# abierto antes de dejar pasar una llamada de prueba.
+OPENAI_CIRCUITO_FALLOS = int(
+    os.getenv("OPENAI_CIRCUITO_FALLOS", "5")
+)
+OPENAI_CIRCUITO_ABIERTO_SECONDS = float(
+    os.getenv("OPENAI_CIRCUITO_ABIERTO_SECONDS", "30")
+)
 
-def crear_conversacion(cliente_id, canal="web"):
-    return None
+class PlazoAgotado(Exception):
+    """
+    El intento empezó (por ejemplo tras esperar en EJECUTOR_OPENAI)
+    cuando ya no quedaba plazo para llamar a OpenAI.
+    """
 
-def asegurar_conversacion(cliente_id, canal="web"):
-    return None
 
-def guardar_mensaje(cliente_id, canal, role, contenido):
-    return None
+# Errores transitorios: se reintentan y cuentan para el circuito.
+# Los demás (400, 401...) se propagan de inmediato.
+OPENAI_ERRORES_TRANSITORIOS = (
+    APIConnectionError,
+    RateLimitError,
+    InternalServerError,
+    PlazoAgotado,
+)
 
-def actualizar_conversacion_datos(
-    cliente_id, canal, nombre=None, telefono=None, correo=None,
-    servicio=None, fecha_reserva=None, meet_url=None, estado=None
-):
-    return None
+# Errores al consumir un stream ya abierto: el SDK deja pasar los de
+# httpx (incluido el timeout de lectura) y los eventos de error.
+OPENAI_ERRORES_FLUJO = (
+    httpx.TransportError,
+    APIError,
+    PlazoAgotado,
+)
 
-def guardar_reserva_db(
-    cliente_id, canal, datos, inicio, fin, evento_id, meet_url
-):
-    return None
 
+class CircuitoAbierto(Exception):
+    pass
 
-# ============================================================
-# CONFIGURACIÓN DEL NEGOCIO
-# ============================================================
 
-ESTILISTA_NOMBRE = os.getenv(
-    "ESTILISTA_NOMBRE",
-    "Diego"
-)
+class CircuitoOpenAI:
+    """
+    Cortacircuitos de tres estados: "cerrado" deja pasar todo,
+    "abierto" rechaza todo y, pasado el tiempo de espera,
+    "semiabierto" deja pasar una sola llamada de prueba.
+    """
 
-NEGOCIO_NOMBRE = os.getenv(
-    "NEGOCIO_NOMBRE",
-    "Estilista Diego"
-)
+    def __init__(
+        self,
+        max_fallos,
+        segundos_abierto
+    ):
 
-TIMEZONE = os.getenv(
-    "TIMEZONE",
-    "America/Santiago"
-)
+        self.max_fallos = max_fallos
+        self.segundos_abierto = segundos_abierto
 
-CALENDAR_ID = os.getenv(
-    "GOOGLE_CALENDAR_ID",
-    "primary"
-)
+        self.estado = "cerrado"
+        self.fallos_seguidos = 0
+        self.abierto_desde = 0.0
 
+        self.lock = threading.Lock()
 
-# ============================================================
-# HORARIO
-# ============================================================
+        self.aperturas = 0
+        self.rechazadas = 0
 
-HORA_APERTURA = 10
-HORA_CIERRE = 18
+    def permitir(self):
 
-DURACION_RESERVA = 60
+        with self.lock:
 
-DIAS_ATENCION = {
-    0: "lunes",
-    1: "martes",
-    2: "miércoles",
-    3: "jueves",
-    4: "viernes",
-    5: "sábado",
-}
+            if self.estado == "cerrado":
+                return True
 
-HORAS_DISPONIBLES = list(
-    range(
-        HORA_APERTURA,
-        HORA_CIERRE
-    )
-)
+            if (
+                self.estado == "abierto"
+                and time.monotonic() - self.abierto_desde
+                >= self.segundos_abierto
+            ):
+                self.estado = "semiabierto"
+                return True
 
+            self.rechazadas += 1
 
-# ============================================================
-# SERVICIOS
-# ============================================================
+            return False
 
-SERVICIOS = {
+    def abierto(self):
 
-    "corte_hombre": {
-        "numero": 1,
-        "nombre": "Corte de cabello hombre",
-        "duracion": 60,
-        "precio": 17000,
-        "precio_texto": "$17.000",
-        "detalle": "Incluye perfilado de cejas, lavado de cabello y aplicación de producto.",
-    },
+        with self.lock:
+            return self.estado == "abierto"
 
-    "perfilado_barba": {
-        "numero": 2,
-        "nombre": "Perfilado de barba",
-        "duracion": 60,
-        "precio": 10000,
-        "precio_texto": "$10.000",
-    },
+    def registrar_exito(self):
 
-    "base_rizos": {
-        "numero": 3,
-        "nombre": "Base de rizos permanente",
-        "duracion": 60,
-        "precio": 65000,
-        "precio_texto": "$65.000",
-    },
+        with self.lock:
 
-    "mechas_hombre": {
-        "numero": 4,
-        "nombre": "Mechas",
-        "duracion": 60,
-        "precio": 70000,
-        "precio_texto": "desde $70.000",
-    },
+            self.estado = "cerrado"
+            self.fallos_seguidos = 0
 
-    "decoloracion_global": {
-        "numero": 5,
-        "nombre": "Decoloración global",
-        "duracion": 60,
-        "precio": 120000,
-        "precio_texto": "$120.000",
-    },
+    def registrar_respuesta(self):
+        """
+        OpenAI respondió con un error que no es del proveedor (por
+        ejemplo un 400). Corta la racha de fallos, pero no cierra el
+        circuito: si era la llamada de prueba, lo deja listo para
+        otra prueba.
+        """
 
-    "corte_mujer": {
-        "numero": 6,
-        "nombre": "Corte de cabello mujer",
-        "duracion": 60,
-        "precio": 30000,
-        "precio_texto": "$30.000",
-        "detalle": "Incluye lavado de cabello, hidratación y brushing.",
-    },
+        with self.lock:
 
-    "masaje_hidratacion": {
-        "numero": 7,
-        "nombre": "Masaje de hidratación",
-        "duracion": 60,
-        "precio": 45000,
-        "precio_texto": "$45.000",
-    },
+            if self.estado == "cerrado":
+                self.fallos_seguidos = 0
 
-    "botox_capilar": {
-        "numero": 8,
-        "nombre": "Botox capilar",
-        "duracion": 60,
-        "precio": 65000,
-        "precio_texto": "desde $65.000",
-    },
+            elif self.estado == "semiabierto":
 
-    "alisado_permanente": {
-        "numero": 9,
-        "nombre": "Alisado permanente",
-        "duracion": 60,
-        "precio": 70000,
-        "precio_texto": "desde $70.000",
-    },
+                self.estado = "abierto"
+                self.abierto_desde = (
+                    time.monotonic() - self.segundos_abierto
+                )
 
-    "retoque_raiz": {
-        "numero": 10,
-        "nombre": "Retoque de color de raíz",
-        "duracion": 60,
-        "precio": 50000,
-        "precio_texto": "$50.000",
-    },
+    def registrar_fallo(self):
 
-    "bano_color": {
-        "numero": 11,
-        "nombre": "Baño de color",
-        "duracion": 60,
-        "precio": 30000,
-        "precio_texto": "$30.000",
-    },
+        with self.lock:
 
-    "diagnostico_balayage": {
-        "numero": 12,
-        "nombre": "Diagnóstico capilar gratuito para Balayage",
-        "duracion": 60,
-        "precio": 0,
-        "precio_texto": "Diagnóstico gratuito · Balayage estimado desde $150.000",
-        "detalle": "El valor final del Balayage se define después del diagnóstico capilar.",
-    },
-}
+            self.fallos_seguidos += 1
 
-SERVICIO_POR_NUMERO = {
-    servicio["numero"]: codigo
-    for codigo, servicio in SERVICIOS.items()
-}
+            if (
+                self.estado == "semiabierto"
+                or self.fallos_seguidos >= self.max_fallos
+            ):
 
+                if self.estado != "abierto":
+                    self.aperturas += 1
 
-# ============================================================
-# GOOGLE
-# ============================================================
+                    print(
+                        "OPENAI CIRCUITO ABIERTO:",
+                        self.fallos_seguidos,
+                        "fallos seguidos"
+                    )
 
-GOOGLE_CLIENT_ID = os.getenv(
-    "GOOGLE_CLIENT_ID"
-)
+                self.estado = "abierto"
+                self.abierto_desde = time.monotonic()
 
-GOOGLE_CLIENT_SECRET = os.getenv(
-    "GOOGLE_CLIENT_SECRET"
-)
+    def metricas(self):
 
-GOOGLE_REFRESH_TOKEN = os.getenv(
-    "GOOGLE_REFRESH_TOKEN"
+        with self.lock:
+
+            return {
+                "estado": self.estado,
+                "fallos_seguidos": self.fallos_seguidos,
+                "aperturas": self.aperturas,
+                "rechazadas": self.rechazadas,
+            }
+
+
+CIRCUITO_OPENAI = CircuitoOpenAI(
+    OPENAI_CIRCUITO_FALLOS,
+    OPENAI_CIRCUITO_ABIERTO_SECONDS
 )
 
-GOOGLE_REDIRECT_URI = os.getenv(
-    "GOOGLE_REDIRECT_URI",
-    "https://chatbot-laortiga-9.onrender.com/callback"
+# Latencias de las últimas llamadas exitosas, para el percentil de
+# hedging y las métricas.
+OPENAI_LATENCIAS = deque(maxlen=200)
+
+OPENAI_STATS = {
+    "llamadas": 0,
+    "intentos": 0,
+    "reintentos": 0,
+    "fallos": 0,
+    "hedges": 0,
+    "hedges_ganados": 0,
+}
+
+OPENAI_STATS_LOCK = threading.Lock()
+
+# Hilos para las llamadas con hedging; las demás corren en el hilo
+# del request.
+EJECUTOR_OPENAI = ThreadPoolExecutor(
+    max_workers=8,
+    thread_name_prefix="openai",
 )
 
-SCOPES = [
-    "https://www.googleapis.com/auth/calendar"
-]
 
+def contar_openai(clave, cantidad=1):
 
-# ============================================================
-# GOOGLE FLOW
-# ============================================================
+    with OPENAI_STATS_LOCK:
+        OPENAI_STATS[clave] += cantidad
 
-def crear_google_flow():
 
-    return Flow.from_client_config(
-        {
-            "web": {
-                "client_id": GOOGLE_CLIENT_ID,
-                "client_secret": GOOGLE_CLIENT_SECRET,
-                "auth_uri":
-                    "https://accounts.google.com/o/oauth2/auth",
-                "token_uri":
-                    "https://oauth2.googleapis.com/token",
-                "redirect_uris": [
-                    GOOGLE_REDIRECT_URI
-                ],
-            }
-        },
-        scopes=SCOPES,
-        redirect_uri=GOOGLE_REDIRECT_URI
-    )
+def umbral_hedge_seconds():
+    """
+    Segundos de espera antes de lanzar la llamada de respaldo, o
+    None si el hedging está desactivado o faltan muestras.
+    """
 
+    if OPENAI_HEDGE_PERCENTIL <= 0:
+        return None
 
-def obtener_credentials_diego():
+    with OPENAI_STATS_LOCK:
+        latencias = list(OPENAI_LATENCIAS)
 
-    if not GOOGLE_REFRESH_TOKEN:
-        raise Exception(
-            "Falta GOOGLE_REFRESH_TOKEN."
-        )
+    if len(latencias) < OPENAI_HEDGE_MIN_MUESTRAS:
+        return None
 
-    return Credentials(
-        token=None,
-        refresh_token=GOOGLE_REFRESH_TOKEN,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=GOOGLE_CLIENT_ID,
-        client_secret=GOOGLE_CLIENT_SECRET,
-        scopes=SCOPES,
+    return float(
+        np.percentile(
+            latencias,
+            OPENAI_HEDGE_PERCENTIL
+        )
     )
 
 
-def obtener_calendar_service():
+def intento_completion(limite, parametros):
+    """
+    Un intento que debe terminar antes de limite (time.monotonic()).
+    El timeout se calcula al empezar, así descuenta lo que la tarea
+    esperó en la cola del ejecutor.
+    """
 
-    credentials = obtener_credentials_diego()
+    inicio = time.monotonic()
 
-    return build(
-        "calendar",
-        "v3",
-        credentials=credentials,
-        cache_discovery=False,
-    )
+    timeout = limite - inicio
 
+    if timeout <= 0:
+        raise PlazoAgotado()
 
-# ============================================================
-# FECHA / HORA
-# ============================================================
+    respuesta = client.with_options(
+        timeout=timeout,
+        max_retries=0,
+    ).chat.completions.create(**parametros)
 
-def obtener_zona():
-    return pytz.timezone(TIMEZONE)
+    if not parametros.get("stream"):
 
+        with OPENAI_STATS_LOCK:
+            OPENAI_LATENCIAS.append(
+                time.monotonic() - inicio
+            )
 
-def ahora_local():
+    return respuesta
 
-    return datetime.now(
-        obtener_zona()
-    )
 
+def cerrar_respuesta_openai(futuro):
+    """
+    Callback de la llamada que perdió la carrera del hedging: libera
+    lo que haya devuelto. El SDK síncrono no permite interrumpir una
+    petición en curso desde otro hilo; termina dentro del límite del
+    intento y su respuesta se cierra aquí.
+    """
 
-def normalizar_texto(texto):
+    if futuro.cancelled():
+        return
 
-    texto = (
-        texto or ""
-    ).strip().lower()
-
-    reemplazos = {
-        "á": "a",
-        "é": "e",
-        "í": "i",
-        "ó": "o",
-        "ú": "u",
-        "ü": "u",
-    }
+    try:
+        respuesta = futuro.result()
+    except Exception:
+        return
 
-    for a, b in reemplazos.items():
-        texto = texto.replace(a, b)
+    for objeto in (respuesta, getattr(respuesta, "response", None)):
 
-    return texto
+        cerrar = getattr(objeto, "close", None)
 
+        if callable(cerrar):
+            cerrar()
+            return
 
-DIAS_NOMBRES = [
-    "lunes",
-    "martes",
-    "miércoles",
-    "jueves",
-    "viernes",
-    "sábado",
-    "domingo",
-]
 
+def descartar_intento(futuro):
 
-MESES_NOMBRES = [
-    "enero", "febrero", "marzo", "abril", "mayo", "junio",
-    "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"
-]
+    # Si todavía espera en la cola del ejecutor, no llega a salir.
+    if not futuro.cancel():
+        futuro.add_done_callback(cerrar_respuesta_openai)
 
-MESES_MAP = {
-    "enero": 1,
-    "febrero": 2,
-    "marzo": 3,
-    "abril": 4,
-    "mayo": 5,
-    "junio": 6,
-    "julio": 7,
-    "agosto": 8,
-    "septiembre": 9,
-    "setiembre": 9,
-    "octubre": 10,
-    "noviembre": 11,
-    "diciembre": 12,
-}
 
+def intento_con_hedge(limite, parametros):
+    """
+    Lanza el intento en un hilo y, si supera el umbral de hedging,
+    una copia. Ambas comparten el límite del intento. Devuelve la
+    primera respuesta exitosa; si ambas fallan, propaga el error de
+    la primera.
+    """
 
-def es_comando_menu(texto):
-    texto_n = normalizar_texto(texto)
-    comandos = {
-        "menu",
-        "menu principal",
-        "volver al menu",
-        "volver al menu principal",
-        "inicio",
-        "volver",
-    }
-    return texto_n in comandos
+    umbral = umbral_hedge_seconds()
 
+    if umbral is None or umbral >= limite - time.monotonic():
+        return intento_completion(limite, parametros)
 
-def detectar_mes_solicitado(texto):
-    """
-    Detecta un mes indicado sin un día específico.
-    Ejemplos:
-    - "en septiembre"
-    - "quiero hora para octubre"
+    principal = EJECUTOR_OPENAI.submit(
+        intento_completion,
+        limite,
+        parametros
+    )
 
-    Devuelve el primer día del mes solicitado, en el año correcto.
-    Si el mes de este año ya pasó, usa el año siguiente.
-    Si el mensaje contiene un día explícito, devuelve None para que
-    detectar_fecha_solicitada() procese la fecha exacta.
-    """
-    texto_n = normalizar_texto(texto)
+    hecho, _ = wait([principal], timeout=umbral)
 
-    patron_dia_mes = (
-        r"\b(?:el\s+)?([0-3]?\d)\s*(?:de\s+)?"
-        r"(enero|febrero|marzo|abril|mayo|junio|julio|agosto|"
-        r"septiembre|setiembre|octubre|noviembre|diciembre)\b"
-    )
-    if re.search(patron_dia_mes, texto_n):
-        return None
+    if hecho:
+        return principal.result()
 
-    ahora = ahora_local()
+    contar_openai("hedges")
 
-    for nombre_mes, numero_mes in MESES_MAP.items():
-        if re.search(rf"\b{re.escape(nombre_mes)}\b", texto_n):
-            anio = ahora.year
-            if numero_mes < ahora.month:
-                anio += 1
-
-            return obtener_zona().localize(
-                datetime(
-                    anio,
-                    numero_mes,
-                    1,
-                    0,
-                    0,
-                    0
-                )
-            )
+    respaldo = EJECUTOR_OPENAI.submit(
+        intento_completion,
+        limite,
+        parametros
+    )
 
-    return None
+    pendientes = [principal, respaldo]
 
+    primer_error = None
 
-def texto_menciona_fecha_o_mes(texto):
-    texto_n = normalizar_texto(texto)
+    while pendientes:
 
-    palabras = [
-        "hoy",
-        "manana",
-        "pasado manana",
-        "lunes",
-        "martes",
-        "miercoles",
-        "jueves",
-        "viernes",
-        "sabado",
-        "domingo",
-    ] + list(MESES_MAP.keys())
+        hecho, _ = wait(
+            pendientes,
+            return_when=FIRST_COMPLETED
+        )
 
-    return any(
-        re.search(rf"\b{re.escape(p)}\b", texto_n)
-        for p in palabras
-    )
+        for futuro in hecho:
 
+            pendientes.remove(futuro)
 
-def es_dia_atencion(fecha):
+            try:
+                respuesta = futuro.result()
+            except Exception as e:
+                primer_error = primer_error or e
+                continue
 
-    fecha = fecha.astimezone(
-        obtener_zona()
-    )
+            if futuro is respaldo:
+                contar_openai("hedges_ganados")
 
-    return fecha.weekday() in DIAS_ATENCION
+            for otro in pendientes:
+                descartar_intento(otro)
 
+            return respuesta
 
-def formato_fecha_corta(fecha):
+    raise primer_error
 
-    fecha = fecha.astimezone(
-        obtener_zona()
-    )
 
-    return (
-        f"{DIAS_NOMBRES[fecha.weekday()]} "
-        f"{fecha.day}/{fecha.month} "
-        f"{fecha.strftime('%H:%M')}"
-    )
+def crear_completion(**parametros):
+    """
+    Reemplazo de client.chat.completions.create con plazos,
+    reintentos, hedging (sin stream) y cortacircuitos. Lanza
+    CircuitoAbierto sin llamar a OpenAI si el circuito está abierto.
+    Para el circuito cuenta la llamada completa: un solo fallo si se
+    agotan los reintentos, no uno por intento. Con stream=True
+    devuelve un FlujoOpenAI, que aplica el plazo y el circuito también
+    mientras se consume.
+    """
 
+    if not CIRCUITO_OPENAI.permitir():
+        raise CircuitoAbierto()
 
-def formato_fecha_larga(fecha):
+    contar_openai("llamadas")
 
-    fecha = fecha.astimezone(
-        obtener_zona()
-    )
+    limite = time.monotonic() + OPENAI_DEADLINE_SECONDS
 
-    meses = [
-        "enero",
-        "febrero",
-        "marzo",
-        "abril",
-        "mayo",
-        "junio",
-        "julio",
-        "agosto",
-        "septiembre",
-        "octubre",
-        "noviembre",
-        "diciembre",
-    ]
+    intento = 0
 
-    return (
-        f"{DIAS_NOMBRES[fecha.weekday()]} "
-        f"{fecha.day} de "
-        f"{meses[fecha.month - 1]} "
-        f"a las {fecha.strftime('%H:%M')}"
-    )
+    while True:
 
+        limite_intento = min(
+            limite,
+            time.monotonic() + OPENAI_TIMEOUT_SECONDS
+        )
 
-# ============================================================
-# SERVICIOS
-# ============================================================
+        contar_openai("intentos")
 
-def obtener_servicio(codigo):
+        try:
 
-    return SERVICIOS.get(
-        codigo,
-        {
-            "nombre": "Servicio",
-            "duracion": 60,
-            "precio": 0,
-            "precio_texto": "Valor a confirmar",
-        }
-    )
+            if parametros.get("stream"):
 
+                # El circuito se resuelve al terminar el flujo.
+                return FlujoOpenAI(
+                    intento_completion(
+                        limite_intento,
+                        parametros
+                    ),
+                    limite
+                )
 
-def precio_texto_servicio(servicio):
+            respuesta = intento_con_hedge(
+                limite_intento,
+                parametros
+            )
 
-    if servicio.get("precio_texto"):
-        return servicio["precio_texto"]
+            CIRCUITO_OPENAI.registrar_exito()
 
-    precio = servicio.get("precio", 0)
+            return respuesta
 
-    return (
-        f"${precio:,}"
-        .replace(",", ".")
-    )
+        except OPENAI_ERRORES_TRANSITORIOS as e:
 
+            contar_openai("fallos")
 
-def mensaje_menu_principal():
+            # Backoff exponencial con jitter completo.
+            espera = random.uniform(
+                0,
+                OPENAI_REINTENTO_BASE_SECONDS * 2 ** intento
+            )
 
-    return (
-        f"¡Hola! 👋 Soy el asistente virtual de {ESTILISTA_NOMBRE}.\n\n"
-        "¿Qué te gustaría hacer?\n\n"
-        "1. Conocer servicios y precios 💇‍♂️💇‍♀️\n"
-        "2. Agendar una hora 📅\n\n"
-        "Respóndeme con 1 o 2."
-    )
+            intento += 1
 
+            if (
+                intento > OPENAI_REINTENTOS
+                or time.monotonic() + espera >= limite - 1
+                or CIRCUITO_OPENAI.abierto()
+            ):
 
-def mostrar_servicios():
+                CIRCUITO_OPENAI.registrar_fallo()
 
-    return (
-        "Estos son nuestros servicios y precios 👇\n\n"
-        "👨 HOMBRE\n"
-        "1. Corte de cabello hombre — $17.000\n"
-        "   Incluye perfilado de cejas, lavado de cabello y aplicación de producto.\n\n"
-        "2. Perfilado de barba — $10.000\n"
-        "3. Base de rizos permanente — $65.000\n"
-        "4. Mechas — desde $70.000\n"
-        "5. Decoloración global — $120.000\n\n"
-        "👩 MUJER\n"
-        "6. Corte de cabello mujer — $30.000\n"
-        "   Incluye lavado de cabello, hidratación y brushing.\n\n"
-        "7. Masaje de hidratación — $45.000\n"
-        "8. Botox capilar — desde $65.000\n"
-        "9. Alisado permanente — desde $70.000\n"
-        "10. Retoque de color de raíz — $50.000\n"
-        "11. Baño de color — $30.000\n"
-        "12. Balayage — valor estimado desde $150.000\n"
-        "    Requiere agendar un diagnóstico capilar gratuito para definir el valor final.\n\n"
-        "Para agendar, respóndeme con el número del servicio (1 al 12).\n"
-        "Si solo querías revisar precios, puedes escribir MENÚ para volver."
-    )
+                raise
 
+            print(
+                "OPENAI REINTENTO:",
+                intento,
+                repr(e)
+            )
 
-def detectar_servicio_por_numero(texto):
+            contar_openai("reintentos")
 
-    match = re.fullmatch(
-        r"\s*(\d{1,2})\s*",
-        texto or ""
-    )
+            time.sleep(espera)
 
-    if not match:
-        return None
+        except Exception:
 
-    numero = int(match.group(1))
+            # OpenAI respondió (por ejemplo un 400): el proveedor está
+            # disponible aunque esta llamada no sirva.
+            CIRCUITO_OPENAI.registrar_respuesta()
 
-    return SERVICIO_POR_NUMERO.get(numero)
+            raise
 
 
-def detectar_servicio(texto):
+class FlujoOpenAI:
+    """
+    Envuelve el Stream del SDK. Cada lectura ya tiene el timeout de
+    httpx del intento; además el flujo completo se corta al pasar
+    limite. Un error al consumirlo cuenta como fallo del circuito y
+    solo un flujo terminado lo cierra.
+    """
 
-    texto_n = normalizar_texto(texto)
+    def __init__(self, stream, limite):
 
-    servicio_numero = detectar_servicio_por_numero(texto)
+        self.stream = stream
+        self.limite = limite
 
-    if servicio_numero:
-        return servicio_numero
+    def __iter__(self):
 
-    # Servicios con nombres suficientemente específicos.
-    if "corte" in texto_n and (
-        "mujer" in texto_n
-        or "dama" in texto_n
-        or "femenino" in texto_n
-    ):
-        return "corte_mujer"
+        recibidos = 0
 
-    if "corte" in texto_n and (
-        "hombre" in texto_n
-        or "varon" in texto_n
-        or "masculino" in texto_n
-    ):
-        return "corte_hombre"
+        try:
 
-    if "perfilado" in texto_n and "barba" in texto_n:
-        return "perfilado_barba"
+            for chunk in self.stream:
 
-    if "barba" in texto_n:
-        return "perfilado_barba"
+                if time.monotonic() > self.limite:
+                    raise PlazoAgotado()
 
-    if "rizo" in texto_n or "permanente de rizo" in texto_n:
-        return "base_rizos"
+                recibidos += 1
 
-    if "mecha" in texto_n:
-        return "mechas_hombre"
+                yield chunk
 
-    if "decoloracion" in texto_n:
-        return "decoloracion_global"
+        except OPENAI_ERRORES_FLUJO:
 
-    if "masaje" in texto_n and "hidrat" in texto_n:
-        return "masaje_hidratacion"
+            contar_openai("fallos")
 
-    if "botox" in texto_n:
-        return "botox_capilar"
+            CIRCUITO_OPENAI.registrar_fallo()
 
-    if "alisado" in texto_n:
-        return "alisado_permanente"
+            raise
 
-    if "retoque" in texto_n and "raiz" in texto_n:
-        return "retoque_raiz"
+        except GeneratorExit:
 
-    if "bano de color" in texto_n or ("bano" in texto_n and "color" in texto_n):
-        return "bano_color"
+            # El cliente dejó de leer (por ejemplo, cerró el chat).
+            if recibidos:
+                CIRCUITO_OPENAI.registrar_exito()
+            else:
+                CIRCUITO_OPENAI.registrar_respuesta()
 
-    if "balayage" in texto_n:
-        return "diagnostico_balayage"
+            raise
 
-    # "corte" a secas es ambiguo: no asumimos hombre o mujer.
-    return None
+        else:
+            CIRCUITO_OPENAI.registrar_exito()
 
+        finally:
+            self.stream.response.close()
 
-# ============================================================
-# DETECTAR FECHA / HORA SOLICITADA EN TEXTO LIBRE
-# ============================================================
 
-def detectar_hora_solicitada(texto):
-    """
-    Interpreta expresiones como:
-    - a las 3
-    - a las 3:30
-    - 15:00
-    - 3 pm
+def metricas_openai():
 
-    Como el negocio atiende entre 10:00 y 18:00,
-    una hora simple como "3" se interpreta como 15:00.
-    """
+    with OPENAI_STATS_LOCK:
 
-    texto_n = normalizar_texto(texto)
+        stats = dict(OPENAI_STATS)
+        latencias = list(OPENAI_LATENCIAS)
 
-    # 15:00 / 15.30 / a las 15:00
-    match = re.search(
-        r"(?:a\s+las?\s+)?\b([01]?\d|2[0-3])[:.]([0-5]\d)\b",
-        texto_n
-    )
+    if latencias:
 
-    if match:
-        hora = int(match.group(1))
-        minuto = int(match.group(2))
-        return hora, minuto
+        p50, p95 = np.percentile(latencias, [50, 95])
 
-    # 3 pm / 3:30 pm
-    match = re.search(
-        r"(?:a\s+las?\s+)?\b(1[0-2]|[1-9])"
-        r"(?:[:.]([0-5]\d))?\s*(am|pm)\b",
-        texto_n
-    )
+        stats["latencia_p50_ms"] = round(p50 * 1000, 1)
+        stats["latencia_p95_ms"] = round(p95 * 1000, 1)
 
-    if match:
-        hora = int(match.group(1))
-        minuto = int(match.group(2) or 0)
-        periodo = match.group(3)
+    stats["circuito"] = CIRCUITO_OPENAI.metricas()
+    stats["hedge_umbral_seconds"] = umbral_hedge_seconds()
 
-        if periodo == "pm" and hora < 12:
-            hora += 12
+    return stats
 
-        if periodo == "am" and hora == 12:
-            hora = 0
 
-        return hora, minuto
+# ============================================================
+# BASE DE DATOS
+# ============================================================
 
-    # "a las 3" / "a la 1"
-    match = re.search(
-        r"\ba\s+las?\s+(\d{1,2})\b",
-        texto_n
-    )
+# DATABASE_URL acepta:
+#   postgres://... o postgresql://...  -> PostgreSQL con pool de conexiones
+#   sqlite:///ruta/archivo.sqlite3      -> SQLite local (pruebas)
+# Sin DATABASE_URL las funciones no hacen nada y el bot sigue
+# funcionando con Google Calendar como fuente de verdad.
 
-    if match:
-        hora = int(match.group(1))
+DATABASE_URL = os.getenv("DATABASE_URL")
 
-        # Dentro del horario del negocio, 1..6 normalmente
-        # significa 13:00..18:00.
-        if 1 <= hora <= 6:
-            hora += 12
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
 
-        return hora, 0
+DB_DIALECTO = None
 
-    return None
+if DATABASE_URL:
 
+    if DATABASE_URL.startswith("sqlite:///"):
+        DB_DIALECTO = "sqlite"
 
-def detectar_fecha_solicitada(texto, hora_data=None):
-    """
-    Detecta hoy, mañana, pasado mañana, días de la semana y fechas exactas
-    como "2 de septiembre" o "15 enero".
-    """
+    elif DATABASE_URL.startswith(("postgres://", "postgresql://")):
+        DB_DIALECTO = "postgres"
 
-    texto_n = normalizar_texto(texto)
-    ahora = ahora_local()
-    zona = obtener_zona()
-
-    fecha_base = ahora.replace(
-        second=0,
-        microsecond=0
-    )
+    else:
+        print("ADVERTENCIA: DATABASE_URL no reconocida, base de datos deshabilitada.")
 
-    patron_dia_mes = (
-        r"\b(?:el\s+)?([0-3]?\d)\s*(?:de\s+)?"
-        r"(enero|febrero|marzo|abril|mayo|junio|julio|agosto|"
-        r"septiembre|setiembre|octubre|noviembre|diciembre)\b"
-    )
+DB_ESTADO = {
+    "pool": None,
+}
 
-    match_fecha = re.search(
-        patron_dia_mes,
-        texto_n
-    )
+# Nombres de las sentencias ya preparadas en cada conexión de
+# PostgreSQL. La clave es la conexión misma (no su id()): cuando el
+# pool cierra una conexión sobrante, su entrada desaparece con ella
+# y una conexión nueva nunca hereda sentencias que no tiene.
+DB_PREPARADAS = weakref.WeakKeyDictionary()
+
+DB_LOCK = threading.Lock()
+
+DB_LOCAL = threading.local()
+
+
+# Sentencias del camino caliente. En PostgreSQL se preparan una vez
+# por conexión (PREPARE) y después solo se ejecutan; en SQLite los
+# parámetros $n se traducen a ?n. Un parámetro sin columna de
+# destino (por ejemplo en la lista de un SELECT) lleva CAST: PREPARE
+# no puede deducir su tipo y PostgreSQL rechaza la sentencia.
+DB_SENTENCIAS = {
+
+    "tocar_conversacion": """
+        INSERT INTO conversaciones (cliente_id, canal)
+        VALUES ($1, $2)
+        ON CONFLICT (cliente_id, canal) DO UPDATE SET
+            updated_at = CURRENT_TIMESTAMP
+    """,
+
+    "insertar_mensaje": """
+        INSERT INTO mensajes (conversation_id, role, contenido)
+        SELECT id, CAST($3 AS TEXT), CAST($4 AS TEXT)
+        FROM conversaciones
+        WHERE cliente_id = $1 AND canal = $2
+    """,
+
+    "actualizar_conversacion": """
+        INSERT INTO conversaciones (
+            cliente_id, canal, nombre, telefono, correo,
+            servicio, fecha_reserva, meet_url, estado
+        )
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+        ON CONFLICT (cliente_id, canal) DO UPDATE SET
+            nombre = COALESCE(excluded.nombre, conversaciones.nombre),
+            telefono = COALESCE(excluded.telefono, conversaciones.telefono),
+            correo = COALESCE(excluded.correo, conversaciones.correo),
+            servicio = COALESCE(excluded.servicio, conversaciones.servicio),
+            fecha_reserva = COALESCE(
+                excluded.fecha_reserva,
+                conversaciones.fecha_reserva
+            ),
+            meet_url = COALESCE(excluded.meet_url, conversaciones.meet_url),
+            estado = COALESCE(excluded.estado, conversaciones.estado),
+            updated_at = CURRENT_TIMESTAMP
+    """,
+
+    "obtener_conversacion": """
+        SELECT * FROM conversaciones
+        WHERE cliente_id = $1 AND canal = $2
+    """,
+}
 
-    if match_fecha:
 
-        dia = int(match_fecha.group(1))
-        mes = MESES_MAP[match_fecha.group(2)]
-        anio = ahora.year
+DB_ESQUEMA = {
+
+    "postgres": [
+        """
+        CREATE TABLE IF NOT EXISTS conversaciones (
+            id SERIAL PRIMARY KEY,
+            cliente_id TEXT NOT NULL,
+            canal TEXT NOT NULL,
+            nombre TEXT,
+            telefono TEXT,
+            correo TEXT,
+            servicio TEXT,
+            fecha_reserva TIMESTAMPTZ,
+            meet_url TEXT,
+            estado TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (cliente_id, canal)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS mensajes (
+            id BIGSERIAL PRIMARY KEY,
+            conversation_id INTEGER NOT NULL
+                REFERENCES conversaciones (id) ON DELETE CASCADE,
+            role TEXT NOT NULL,
+            contenido TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS reservas (
+            id SERIAL PRIMARY KEY,
+            cliente_id TEXT NOT NULL,
+            canal TEXT NOT NULL,
+            servicio TEXT,
+            nombre TEXT,
+            telefono TEXT,
+            correo TEXT,
+            inicio TIMESTAMPTZ NOT NULL,
+            fin TIMESTAMPTZ NOT NULL,
+            evento_id TEXT UNIQUE,
+            meet_url TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS calendar_canal (
+            id INTEGER PRIMARY KEY,
+            canal_id TEXT,
+            resource_id TEXT,
+            expira_en DOUBLE PRECISION NOT NULL DEFAULT 0,
+            version BIGINT NOT NULL DEFAULT 0,
+            renovando_hasta DOUBLE PRECISION NOT NULL DEFAULT 0,
+            duenio TEXT
+        )
+        """,
+        """
+        INSERT INTO calendar_canal (id) VALUES (1)
+        ON CONFLICT (id) DO NOTHING
+        """,
+    ],
+
+    "sqlite": [
+        """
+        CREATE TABLE IF NOT EXISTS conversaciones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cliente_id TEXT NOT NULL,
+            canal TEXT NOT NULL,
+            nombre TEXT,
+            telefono TEXT,
+            correo TEXT,
+            servicio TEXT,
+            fecha_reserva TEXT,
+            meet_url TEXT,
+            estado TEXT,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (cliente_id, canal)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS mensajes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL
+                REFERENCES conversaciones (id) ON DELETE CASCADE,
+            role TEXT NOT NULL,
+            contenido TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS reservas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cliente_id TEXT NOT NULL,
+            canal TEXT NOT NULL,
+            servicio TEXT,
+            nombre TEXT,
+            telefono TEXT,
+            correo TEXT,
+            inicio TEXT NOT NULL,
+            fin TEXT NOT NULL,
+            evento_id TEXT UNIQUE,
+            meet_url TEXT,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS calendar_canal (
+            id INTEGER PRIMARY KEY,
+            canal_id TEXT,
+            resource_id TEXT,
+            expira_en DOUBLE PRECISION NOT NULL DEFAULT 0,
+            version BIGINT NOT NULL DEFAULT 0,
+            renovando_hasta DOUBLE PRECISION NOT NULL DEFAULT 0,
+            duenio TEXT
+        )
+        """,
+        """
+        INSERT INTO calendar_canal (id) VALUES (1)
+        ON CONFLICT (id) DO NOTHING
+        """,
+    ],
+}
 
-        try:
-            candidato = zona.localize(
-                datetime(
-                    anio,
-                    mes,
-                    dia,
-                    0,
-                    0,
-                    0
-                )
-            )
-        except ValueError:
-            return None
+DB_INDICES = [
+    """
+    CREATE INDEX IF NOT EXISTS conversaciones_updated_at_idx
+    ON conversaciones (updated_at DESC)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS mensajes_conversation_idx
+    ON mensajes (conversation_id, id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS reservas_cliente_idx
+    ON reservas (cliente_id, canal)
+    """,
+]
 
-        if candidato.date() < ahora.date():
-            anio += 1
 
-            try:
-                candidato = zona.localize(
-                    datetime(
-                        anio,
-                        mes,
-                        dia,
-                        0,
-                        0,
-                        0
-                    )
-                )
-            except ValueError:
-                return None
+def valor_db(valor):
 
-        return candidato
+    # SQLite no tiene tipo fecha; en PostgreSQL el texto ISO con
+    # zona horaria se convierte solo a TIMESTAMPTZ.
+    if isinstance(valor, datetime):
+        return valor.isoformat()
 
-    if "pasado manana" in texto_n:
-        return fecha_base + timedelta(days=2)
+    return valor
 
-    if "manana" in texto_n:
-        return fecha_base + timedelta(days=1)
 
-    if "hoy" in texto_n:
-        return fecha_base
+def obtener_pool_db():
 
-    dias_map = {
-        "lunes": 0,
-        "martes": 1,
-        "miercoles": 2,
-        "jueves": 3,
-        "viernes": 4,
-        "sabado": 5,
-        "domingo": 6,
-    }
+    with DB_LOCK:
 
-    for nombre_dia, weekday in dias_map.items():
+        if DB_ESTADO["pool"] is None:
 
-        if nombre_dia in texto_n:
+            from psycopg2.pool import ThreadedConnectionPool
 
-            diferencia = (
-                weekday
-                - ahora.weekday()
-            ) % 7
+            DB_ESTADO["pool"] = ThreadedConnectionPool(
+                DB_POOL_MIN,
+                DB_POOL_MAX,
+                DATABASE_URL
+            )
 
-            if diferencia == 0 and hora_data:
+        return DB_ESTADO["pool"]
 
-                hora, minuto = hora_data
 
-                candidato_hoy = ahora.replace(
-                    hour=hora,
-                    minute=minuto,
-                    second=0,
-                    microsecond=0
-                )
+@contextmanager
+def db_connect():
+    """
+    Entrega una conexión dentro de una transacción: confirma al salir
+    y revierte si hubo error. En PostgreSQL la conexión vuelve al pool
+    (y se descarta si quedó rota); en SQLite cada hilo mantiene la suya.
 
-                if candidato_hoy <= ahora:
-                    diferencia = 7
+    En SQLite un db_connect() anidado reutiliza la conexión del hilo,
+    así que solo el nivel exterior confirma o revierte: si no, el
+    interior cerraría la transacción del exterior a medio camino.
+    """
 
-            return fecha_base + timedelta(days=diferencia)
+    if DB_DIALECTO == "sqlite":
 
-    if hora_data:
+        conexion = getattr(DB_LOCAL, "conexion", None)
 
-        hora, minuto = hora_data
+        if conexion is None:
 
-        for offset in range(8):
+            import sqlite3
 
-            candidato_fecha = (
-                ahora
-                + timedelta(days=offset)
-            ).replace(
-                hour=hora,
-                minute=minuto,
-                second=0,
-                microsecond=0
+            conexion = sqlite3.connect(
+                DATABASE_URL[len("sqlite:///"):],
+                timeout=10
             )
 
-            if not es_dia_atencion(candidato_fecha):
-                continue
-
-            if candidato_fecha <= ahora:
-                continue
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA foreign_keys=ON")
 
-            return candidato_fecha
+            DB_LOCAL.conexion = conexion
+            DB_LOCAL.profundidad = 0
 
-    return None
+        DB_LOCAL.profundidad += 1
 
+        try:
 
-def construir_fecha_hora_solicitada(texto):
-    """
-    Devuelve un datetime timezone-aware si el mensaje contiene
-    una hora interpretable.
-    """
+            yield conexion
 
-    hora_data = detectar_hora_solicitada(
-        texto
-    )
+            if DB_LOCAL.profundidad == 1:
+                conexion.commit()
 
-    if not hora_data:
-        return None
+        except Exception:
 
-    fecha = detectar_fecha_solicitada(
-        texto,
-        hora_data
-    )
+            if DB_LOCAL.profundidad == 1:
+                conexion.rollback()
 
-    if not fecha:
-        return None
+            raise
 
-    hora, minuto = hora_data
+        finally:
+            DB_LOCAL.profundidad -= 1
 
-    return fecha.replace(
-        hour=hora,
-        minute=minuto,
-        second=0,
-        microsecond=0
-    )
+        return
 
+    pool = obtener_pool_db()
 
-# ============================================================
-# GOOGLE CALENDAR DISPONIBILIDAD
-# ============================================================
+    conexion = pool.getconn()
 
-def verificar_disponibilidad(
-    inicio,
-    duracion=60
-):
+    rota = False
 
     try:
+        yield conexion
+        conexion.commit()
 
-        zona = obtener_zona()
-
-        inicio = inicio.astimezone(zona)
+    except Exception:
 
-        if not es_dia_atencion(inicio):
-            return False
+        try:
+            conexion.rollback()
+        except Exception:
+            pass
 
-        if inicio.minute != 0:
-            return False
+        rota = bool(conexion.closed)
+        raise
 
-        if (
-            inicio.hour < HORA_APERTURA
-            or inicio.hour >= HORA_CIERRE
-        ):
-            return False
+    finally:
 
-        fin = inicio + timedelta(
-            minutes=duracion
+        pool.putconn(
+            conexion,
+            close=rota
         )
 
-        limite = inicio.replace(
-            hour=HORA_CIERRE,
-            minute=0,
-            second=0,
-            microsecond=0
-        )
 
-        if fin > limite:
-            return False
+def ejecutar_sentencia(cursor, nombre, parametros):
 
-        service = obtener_calendar_service()
+    parametros = tuple(
+        valor_db(valor)
+        for valor in parametros
+    )
 
-        resultado = (
-            service
-            .freebusy()
-            .query(
-                body={
-                    "timeMin": inicio.isoformat(),
-                    "timeMax": fin.isoformat(),
-                    "items": [
-                        {
-                            "id": CALENDAR_ID
-                        }
-                    ],
-                }
-            )
-            .execute()
+    sql = DB_SENTENCIAS[nombre]
+
+    if DB_DIALECTO == "sqlite":
+
+        cursor.execute(
+            re.sub(r"\$(\d+)", r"?\1", sql),
+            parametros
         )
 
-        calendario = (
-            resultado
-            .get("calendars", {})
-            .get(CALENDAR_ID, {})
+        return
+
+    with DB_LOCK:
+
+        preparadas = DB_PREPARADAS.setdefault(
+            cursor.connection,
+            set()
         )
 
-        busy = calendario.get(
-            "busy",
-            []
+    # La conexión la usa un solo hilo mientras está prestada.
+    if nombre not in preparadas:
+
+        cursor.execute(
+            f"PREPARE {nombre} AS {sql}"
         )
 
-        return len(busy) == 0
+        preparadas.add(nombre)
 
-    except Exception as e:
+    cursor.execute(
+        f"EXECUTE {nombre} ("
+        + ", ".join(["%s"] * len(parametros))
+        + ")",
+        parametros
+    )
 
-        print(
-            "ERROR FREEBUSY:",
-            repr(e)
-        )
 
-        return None
+def filas_como_dict(cursor):
 
+    columnas = [
+        columna[0]
+        for columna in cursor.description
+    ]
 
-# ============================================================
-# 15 PRÓXIMAS HORAS
-# ============================================================
+    return [
+        dict(zip(columnas, fila))
+        for fila in cursor.fetchall()
+    ]
 
-def buscar_proximas_15_horas(desde=None):
 
+def consultar_db(sql, parametros=()):
     """
-    Busca las próximas 15 horas disponibles haciendo UNA sola
-    consulta a Google Calendar para evitar timeouts de Twilio.
-
-    Si recibe "desde", comienza a buscar desde esa fecha/hora.
+    Consulta de lectura para el panel admin. Usa %s como marcador.
     """
 
-    ahora = ahora_local()
-    zona = obtener_zona()
+    if not DB_DIALECTO:
+        return []
 
-    if desde is None:
-        desde = ahora
-    else:
-        desde = desde.astimezone(zona)
+    if DB_DIALECTO == "sqlite":
+        sql = sql.replace("%s", "?")
 
-    if desde < ahora:
-        desde = ahora
+    with db_connect() as conexion:
 
-    # Revisamos hasta 31 días hacia adelante.
-    inicio_rango = desde
+        cursor = conexion.cursor()
 
-    fin_rango = (
-        desde
-        + timedelta(days=31)
-    ).replace(
-        hour=23,
-        minute=59,
-        second=59,
-        microsecond=0
-    )
+        try:
+            cursor.execute(sql, parametros)
+            return filas_como_dict(cursor)
 
-    try:
+        finally:
+            cursor.close()
 
-        service = obtener_calendar_service()
 
-        eventos_resultado = (
-            service
-            .events()
-            .list(
-                calendarId=CALENDAR_ID,
-                timeMin=inicio_rango.isoformat(),
-                timeMax=fin_rango.isoformat(),
-                singleEvents=True,
-                orderBy="startTime",
-                maxResults=500,
-            )
-            .execute()
-        )
+def init_database():
 
-        eventos = eventos_resultado.get(
-            "items",
-            []
-        )
+    if not DB_DIALECTO:
+        print("MODO SIN BASE DE DATOS: falta DATABASE_URL.")
+        return
 
-        print(
-            "CALENDAR OK - EVENTOS EN RANGO:",
-            len(eventos),
-            "DESDE:",
-            inicio_rango.isoformat(),
-            "HASTA:",
-            fin_rango.isoformat(),
-        )
+    with db_connect() as conexion:
 
-    except Exception as e:
+        cursor = conexion.cursor()
 
-        print(
-            "ERROR CONSULTANDO CALENDAR PARA DISPONIBILIDAD:",
-            repr(e)
-        )
+        try:
 
-        import traceback
-        print(traceback.format_exc())
+            for sql in DB_ESQUEMA[DB_DIALECTO] + DB_INDICES:
+                cursor.execute(sql)
 
-        # None permite distinguir un error técnico de "sin horas disponibles".
-        return None
+        finally:
+            cursor.close()
 
+    print("BASE DE DATOS LISTA:", DB_DIALECTO)
 
-    # Convertimos eventos del calendario en intervalos ocupados.
-    ocupados = []
+    if DB_MENSAJES_WRITE_BEHIND:
+        BUFFER_MENSAJES.recuperar()
 
-    for evento in eventos:
 
-        start_data = evento.get(
-            "start",
-            {}
-        )
+def obtener_conversacion(cliente_id, canal="web"):
 
-        end_data = evento.get(
-            "end",
-            {}
-        )
+    if not DB_DIALECTO:
+        return None
 
-        start_str = start_data.get(
-            "dateTime"
-        )
+    try:
 
-        end_str = end_data.get(
-            "dateTime"
-        )
+        with db_connect() as conexion:
 
-        # Evento con hora específica.
-        if start_str and end_str:
+            cursor = conexion.cursor()
 
             try:
 
-                inicio_evento = (
-                    datetime
-                    .fromisoformat(
-                        start_str.replace(
-                            "Z",
-                            "+00:00"
-                        )
-                    )
-                    .astimezone(zona)
+                ejecutar_sentencia(
+                    cursor,
+                    "obtener_conversacion",
+                    (cliente_id, canal)
                 )
 
-                fin_evento = (
-                    datetime
-                    .fromisoformat(
-                        end_str.replace(
-                            "Z",
-                            "+00:00"
-                        )
-                    )
-                    .astimezone(zona)
-                )
+                filas = filas_como_dict(cursor)
 
-                ocupados.append(
-                    (
-                        inicio_evento,
-                        fin_evento
-                    )
-                )
+            finally:
+                cursor.close()
 
-            except Exception:
+        return filas[0] if filas else None
 
-                continue
+    except Exception as e:
 
-        # Evento de día completo.
-        elif (
-            start_data.get("date")
-            and end_data.get("date")
-        ):
+        print(
+            "ERROR DB OBTENER CONVERSACION:",
+            repr(e)
+        )
 
-            try:
+        return None
 
-                inicio_evento = zona.localize(
-                    datetime.combine(
-                        datetime.fromisoformat(
-                            start_data["date"]
-                        ).date(),
-                        datetime.min.time()
-                    )
-                )
 
-                fin_evento = zona.localize(
-                    datetime.combine(
-                        datetime.fromisoformat(
-                            end_data["date"]
-                        ).date(),
-                        datetime.min.time()
-                    )
-                )
+def crear_conversacion(cliente_id, canal="web"):
 
-                ocupados.append(
-                    (
-                        inicio_evento,
-                        fin_evento
-                    )
-                )
+    if not DB_DIALECTO:
+        return None
 
-            except Exception:
+    try:
 
-                continue
+        with db_connect() as conexion:
 
+            cursor = conexion.cursor()
 
-    resultados = []
+            try:
 
-    # Generar horas enteras de lunes a sábado,
-    # entre 10:00 y 17:00.
-    for offset in range(32):
+                ejecutar_sentencia(
+                    cursor,
+                    "tocar_conversacion",
+                    (cliente_id, canal)
+                )
 
-        fecha = (
-            desde
-            + timedelta(days=offset)
-        ).replace(
-            hour=0,
-            minute=0,
-            second=0,
-            microsecond=0
+            finally:
+                cursor.close()
+
+    except Exception as e:
+
+        print(
+            "ERROR DB CREAR CONVERSACION:",
+            repr(e)
         )
 
-        if not es_dia_atencion(
-            fecha
-        ):
+        return None
 
-            continue
+    return obtener_conversacion(
+        cliente_id,
+        canal
+    )
 
-        for hora in HORAS_DISPONIBLES:
 
-            inicio = fecha.replace(
-                hour=hora,
-                minute=0,
-                second=0,
-                microsecond=0
-            )
+def asegurar_conversacion(cliente_id, canal="web"):
 
-            if inicio <= ahora:
+    return (
+        obtener_conversacion(cliente_id, canal)
+        or crear_conversacion(cliente_id, canal)
+    )
 
-                continue
 
-            if inicio < desde:
+def guardar_mensaje(cliente_id, canal, role, contenido):
 
-                continue
+    if not DB_DIALECTO:
+        return None
 
-            fin = (
-                inicio
-                + timedelta(
-                    minutes=DURACION_RESERVA
-                )
-            )
+    if DB_MENSAJES_WRITE_BEHIND:
 
-            # No permitir reservas que terminen después de las 18:00.
-            limite = fecha.replace(
-                hour=HORA_CIERRE,
-                minute=0,
-                second=0,
-                microsecond=0
-            )
+        BUFFER_MENSAJES.encolar(
+            cliente_id,
+            canal,
+            role,
+            contenido
+        )
 
-            if fin > limite:
+        return None
 
-                continue
+    return guardar_mensaje_directo(
+        cliente_id,
+        canal,
+        role,
+        contenido
+    )
 
-            disponible = True
 
-            for (
-                inicio_ocupado,
-                fin_ocupado
-            ) in ocupados:
+def guardar_mensaje_directo(cliente_id, canal, role, contenido):
 
-                if (
-                    inicio < fin_ocupado
-                    and fin > inicio_ocupado
-                ):
+    try:
 
-                    disponible = False
-                    break
+        with db_connect() as conexion:
 
-            if disponible:
+            cursor = conexion.cursor()
 
-                resultados.append(
-                    inicio
-                )
+            try:
 
-                if len(resultados) >= 15:
+                if DB_DIALECTO == "postgres":
 
-                    print(
-                        "15 HORAS DISPONIBLES:",
-                        [
-                            h.isoformat()
-                            for h in resultados
-                        ]
+                    # Perder el último mensaje ante una caída del
+                    # servidor es aceptable; esperar el fsync de
+                    # cada línea en el webhook no lo es.
+                    cursor.execute(
+                        "SET LOCAL synchronous_commit TO OFF"
                     )
 
-                    return resultados
+                ejecutar_sentencia(
+                    cursor,
+                    "tocar_conversacion",
+                    (cliente_id, canal)
+                )
 
-    return resultados
+                ejecutar_sentencia(
+                    cursor,
+                    "insertar_mensaje",
+                    (cliente_id, canal, role, contenido)
+                )
 
+            finally:
+                cursor.close()
 
-def buscar_horas_disponibles_dia(fecha_obj):
-    """
-    Devuelve todas las horas enteras disponibles del día solicitado
-    dentro del horario 10:00 a 18:00, haciendo una sola consulta
-    a Google Calendar.
-    """
+    except Exception as e:
 
-    zona = obtener_zona()
-    ahora = ahora_local()
+        print(
+            "ERROR DB GUARDAR MENSAJE:",
+            repr(e)
+        )
 
-    fecha_obj = fecha_obj.astimezone(zona)
+    return None
 
-    inicio_dia = fecha_obj.replace(
-        hour=0,
-        minute=0,
-        second=0,
-        microsecond=0
-    )
 
-    fin_dia = (
-        inicio_dia
-        + timedelta(days=1)
-    )
+def actualizar_conversacion_datos(
+    cliente_id, canal, nombre=None, telefono=None, correo=None,
+    servicio=None, fecha_reserva=None, meet_url=None, estado=None
+):
 
-    if not es_dia_atencion(inicio_dia):
-        return []
+    if not DB_DIALECTO:
+        return None
 
     try:
 
-        service = obtener_calendar_service()
+        with db_connect() as conexion:
 
-        eventos_resultado = (
-            service
-            .events()
-            .list(
-                calendarId=CALENDAR_ID,
-                timeMin=inicio_dia.isoformat(),
-                timeMax=fin_dia.isoformat(),
-                singleEvents=True,
-                orderBy="startTime",
-                maxResults=100,
-            )
-            .execute()
-        )
+            cursor = conexion.cursor()
 
-        eventos = eventos_resultado.get(
-            "items",
-            []
-        )
+            try:
+
+                ejecutar_sentencia(
+                    cursor,
+                    "actualizar_conversacion",
+                    (
+                        cliente_id, canal, nombre, telefono, correo,
+                        servicio, fecha_reserva, meet_url, estado,
+                    )
+                )
+
+            finally:
+                cursor.close()
 
     except Exception as e:
 
         print(
-            "ERROR CONSULTANDO DISPONIBILIDAD DEL DIA:",
+            "ERROR DB ACTUALIZAR CONVERSACION:",
             repr(e)
         )
 
-        return None
+    return None
 
 
-    ocupados = []
+def guardar_reserva_db(
+    cliente_id, canal, datos, inicio, fin, evento_id, meet_url
+):
 
-    for evento in eventos:
+    if not DB_DIALECTO:
+        return None
 
-        start_data = evento.get(
-            "start",
-            {}
+    sql = """
+        INSERT INTO reservas (
+            cliente_id, canal, servicio, nombre, telefono,
+            correo, inicio, fin, evento_id, meet_url
         )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (evento_id) DO NOTHING
+    """
 
-        end_data = evento.get(
-            "end",
-            {}
-        )
+    if DB_DIALECTO == "sqlite":
+        sql = sql.replace("%s", "?")
 
-        start_str = start_data.get(
-            "dateTime"
-        )
+    try:
 
-        end_str = end_data.get(
-            "dateTime"
-        )
+        with db_connect() as conexion:
 
-        if start_str and end_str:
+            cursor = conexion.cursor()
 
             try:
 
-                inicio_evento = (
-                    datetime
-                    .fromisoformat(
-                        start_str.replace(
-                            "Z",
-                            "+00:00"
-                        )
-                    )
-                    .astimezone(zona)
-                )
-
-                fin_evento = (
-                    datetime
-                    .fromisoformat(
-                        end_str.replace(
-                            "Z",
-                            "+00:00"
+                cursor.execute(
+                    sql,
+                    tuple(
+                        valor_db(valor)
+                        for valor in (
+                            cliente_id,
+                            canal,
+                            datos.get("servicio"),
+                            datos.get("nombre"),
+                            datos.get("telefono"),
+                            datos.get("correo"),
+                            inicio,
+                            fin,
+                            evento_id,
+                            meet_url,
                         )
                     )
-                    .astimezone(zona)
                 )
 
-                ocupados.append(
-                    (
-                        inicio_evento,
-                        fin_evento
-                    )
-                )
+            finally:
+                cursor.close()
 
-            except Exception:
-                continue
+    except Exception as e:
 
-        elif (
-            start_data.get("date")
-            and end_data.get("date")
-        ):
+        print(
+            "ERROR DB GUARDAR RESERVA:",
+            repr(e)
+        )
 
-            # Evento de día completo: bloquear todo el día.
-            return []
+    return None
 
 
-    resultados = []
+def listar_conversaciones(limite=200):
 
-    for hora in HORAS_DISPONIBLES:
+    return consultar_db(
+        """
+        SELECT * FROM conversaciones
+        ORDER BY updated_at DESC
+        LIMIT %s
+        """,
+        (limite,)
+    )
 
-        inicio = inicio_dia.replace(
-            hour=hora,
-            minute=0,
-            second=0,
-            microsecond=0
-        )
 
-        if inicio <= ahora:
-            continue
+def obtener_conversacion_por_id(conversation_id):
 
-        fin = inicio + timedelta(
-            minutes=DURACION_RESERVA
-        )
+    filas = consultar_db(
+        "SELECT * FROM conversaciones WHERE id = %s",
+        (conversation_id,)
+    )
 
-        limite = inicio_dia.replace(
-            hour=HORA_CIERRE,
-            minute=0,
-            second=0,
-            microsecond=0
-        )
+    return filas[0] if filas else None
 
-        if fin > limite:
-            continue
 
-        disponible = True
+def listar_mensajes(conversation_id):
 
-        for (
-            inicio_ocupado,
-            fin_ocupado
-        ) in ocupados:
+    return consultar_db(
+        """
+        SELECT role, contenido, created_at FROM mensajes
+        WHERE conversation_id = %s
+        ORDER BY id
+        """,
+        (conversation_id,)
+    )
 
-            if (
-                inicio < fin_ocupado
-                and fin > inicio_ocupado
-            ):
 
-                disponible = False
-                break
+# ============================================================
+# REGISTRO DE MENSAJES EN SEGUNDO PLANO
+# ============================================================
 
-        if disponible:
-            resultados.append(inicio)
+# guardar_mensaje no escribe en la base: deja la fila en memoria y en
+# un archivo JSONL local (una línea por mensaje) y un hilo la inserta
+# por lotes cada DB_MENSAJES_INTERVALO_SECONDS o al juntar
+# DB_MENSAJES_LOTE filas. Antes de insertar, el archivo se renombra a
+# .flushing; solo se borra cuando el lote quedó confirmado. Si el
+# proceso muere, el próximo arranque reinserta lo que quedó en disco.
+#
+# Si un lote falla se reintenta fila por fila: las filas que fallan
+# solas con la base disponible se reintentan hasta
+# DB_MENSAJES_MAX_REINTENTOS veces y luego pasan al archivo de
+# descartados. Lo mismo ocurre con las más antiguas cuando hay más de
+# DB_MENSAJES_MAX_PENDIENTES filas en memoria.
+
+DB_MENSAJES_WRITE_BEHIND = os.getenv(
+    "DB_MENSAJES_WRITE_BEHIND",
+    "1"
+) == "1"
+
+DB_MENSAJES_LOTE = int(
+    os.getenv(
+        "DB_MENSAJES_LOTE",
+        "200"
+    )
+)
 
-    return resultados
+DB_MENSAJES_INTERVALO_SECONDS = float(
+    os.getenv(
+        "DB_MENSAJES_INTERVALO_SECONDS",
+        "1"
+    )
+)
 
+DB_MENSAJES_SPILL_PATH = os.getenv(
+    "DB_MENSAJES_SPILL_PATH",
+    "mensajes_pendientes"
+)
 
-def formatear_opciones_horas(horas):
+DB_MENSAJES_MAX_PENDIENTES = int(
+    os.getenv(
+        "DB_MENSAJES_MAX_PENDIENTES",
+        "20000"
+    )
+)
 
-    lineas = []
+DB_MENSAJES_MAX_REINTENTOS = int(
+    os.getenv(
+        "DB_MENSAJES_MAX_REINTENTOS",
+        "3"
+    )
+)
 
-    for i, hora in enumerate(
-        horas,
-        start=1
-    ):
+DB_MENSAJES_DESCARTADOS_PATH = os.getenv(
+    "DB_MENSAJES_DESCARTADOS_PATH",
+    "mensajes_descartados.jsonl"
+)
 
-        lineas.append(
-            f"{i}. {formato_fecha_corta(hora)}"
-        )
 
-    return "\n".join(lineas)
+def guardar_mensajes_lote(filas):
+    """
+    Inserta un lote de mensajes en una sola transacción. Cada fila es
+    un dict con cliente_id, canal, role, contenido y created_at.
+    """
 
+    conversaciones = list(dict.fromkeys(
+        (fila["cliente_id"], fila["canal"])
+        for fila in filas
+    ))
 
-# ============================================================
-# DETECTAR INTENCIONES
-# ============================================================
+    with db_connect() as conexion:
 
-def pregunta_servicios(texto):
+        cursor = conexion.cursor()
 
-    texto_n = normalizar_texto(texto)
+        try:
 
-    patrones = [
-        "servicios",
-        "servicio",
-        "precios",
-        "precio",
-        "cuanto cuesta",
-        "cuanto sale",
-        "valor",
-        "valores",
-        "tarifa",
-        "lista de precios",
-        "que hacen",
-    ]
+            if DB_DIALECTO == "sqlite":
 
-    return any(
-        p in texto_n
-        for p in patrones
-    )
+                cursor.executemany(
+                    re.sub(
+                        r"\$(\d+)",
+                        r"?\1",
+                        DB_SENTENCIAS["tocar_conversacion"]
+                    ),
+                    conversaciones
+                )
 
+                cursor.executemany(
+                    """
+                    INSERT INTO mensajes (
+                        conversation_id, role, contenido, created_at
+                    )
+                    SELECT id, ?, ?, ?
+                    FROM conversaciones
+                    WHERE cliente_id = ? AND canal = ?
+                    """,
+                    [
+                        (
+                            fila["role"],
+                            fila["contenido"],
+                            fila["created_at"],
+                            fila["cliente_id"],
+                            fila["canal"],
+                        )
+                        for fila in filas
+                    ]
+                )
 
-def es_intencion_agendar(texto):
+                return
 
-    texto_n = normalizar_texto(texto)
+            from psycopg2.extras import execute_values
 
-    patrones = [
-        "agendar",
-        "agenda",
-        "reservar",
-        "reserva",
-        "reservame",
-        "quiero una hora",
-        "quiero agendar",
-        "quiero reservar",
-        "sacar hora",
-        "sacar una hora",
-        "pedir hora",
-        "cita",
-        "turno",
-        "disponibilidad",
-        "horas disponibles",
-        "hora disponible",
-        "que horas tienes",
-        "que hora tienes",
-        "tienes hora",
-        "tienes horas",
-        "hay hora",
-        "hay horas",
-        "disponible manana",
-        "disponible hoy",
-        "quiero cortarme",
-        "quiero cortar",
-        "cortarme el pelo",
-        "cortarme el cabello",
-        "cortar el pelo",
-        "cortar el cabello",
-        "quiero un corte",
-        "quiero corte",
-        "necesito un corte",
-    ]
+            cursor.execute(
+                "SET LOCAL synchronous_commit TO OFF"
+            )
 
-    return any(
-        p in texto_n
-        for p in patrones
-    )
+            execute_values(
+                cursor,
+                """
+                INSERT INTO conversaciones (cliente_id, canal)
+                VALUES %s
+                ON CONFLICT (cliente_id, canal) DO UPDATE SET
+                    updated_at = CURRENT_TIMESTAMP
+                """,
+                conversaciones
+            )
 
+            execute_values(
+                cursor,
+                """
+                INSERT INTO mensajes (
+                    conversation_id, role, contenido, created_at
+                )
+                SELECT c.id, v.role, v.contenido, v.created_at::timestamptz
+                FROM (VALUES %s) AS v (
+                    orden, cliente_id, canal, role, contenido, created_at
+                )
+                JOIN conversaciones c
+                    ON c.cliente_id = v.cliente_id
+                    AND c.canal = v.canal
+                ORDER BY v.orden
+                """,
+                [
+                    (
+                        orden,
+                        fila["cliente_id"],
+                        fila["canal"],
+                        fila["role"],
+                        fila["contenido"],
+                        fila["created_at"],
+                    )
+                    for orden, fila in enumerate(filas)
+                ],
+                page_size=max(len(filas), 1)
+            )
 
-def es_saludo_o_menu(texto):
+        finally:
+            cursor.close()
 
-    texto_n = normalizar_texto(texto)
 
-    return texto_n in {
-        "hola",
-        "holi",
-        "holaa",
-        "buenas",
-        "buenos dias",
-        "buenas tardes",
-        "buenas noches",
-        "menu",
-        "inicio",
-        "volver",
-    }
+def base_datos_disponible():
 
+    try:
+        consultar_db("SELECT 1")
+        return True
 
-def usuario_no_quiere(texto):
+    except Exception:
+        return False
 
-    texto_n = normalizar_texto(texto)
 
-    patrones = [
-        "no quiero",
-        "no gracias",
-        "gracias no",
-        "dejalo",
-        "olvidalo",
-        "cancelar",
-        "cancela",
-        "no por ahora",
-        "despues",
-        "no necesito",
-    ]
+class BufferMensajes:
 
-    return any(
-        p in texto_n
-        for p in patrones
-    )
+    def __init__(
+        self,
+        ruta_base,
+        lote,
+        intervalo,
+        max_pendientes,
+        max_reintentos,
+        ruta_descartados
+    ):
 
+        self.ruta_base = ruta_base
+        self.lote = lote
+        self.intervalo = intervalo
+        self.max_pendientes = max_pendientes
+        self.max_reintentos = max_reintentos
+        self.ruta_descartados = ruta_descartados
 
-# ============================================================
-# OPENAI - CONVERSACIÓN NATURAL
-# ============================================================
+        # Cada worker de gunicorn escribe su propio archivo. La ruta
+        # se arma al abrirlo, ya en el worker: con --preload este
+        # objeto se crea en el proceso maestro, antes del fork.
+        self.ruta = None
 
-def responder_openai(
-    historial,
-    pregunta
-):
+        self.filas = []
 
-    if not client:
+        # Archivos .flushing cuyas filas están en self.filas o en
+        # el lote que se está insertando.
+        self.archivos = []
 
-        return (
-            "¡Hola! 😊 Qué gusto saludarte. "
-            "Si quieres, puedo mostrarte los servicios "
-            "o ayudarte a reservar una hora."
-        )
+        self.archivo = None
+        self.rotaciones = 0
 
-    system_prompt = f"""
-Eres el asistente virtual de {ESTILISTA_NOMBRE}.
+        self.lock = threading.Lock()
+        self.lock_vaciado = threading.Lock()
+        self.lock_descartes = threading.Lock()
+        self.evento = threading.Event()
 
-Responde en español de Chile, de forma breve, clara y amable.
+        self.hilo = None
 
-REGLAS ESTRICTAS:
-- No inventes servicios, precios, promociones, horarios ni disponibilidad.
-- No agregues recomendaciones largas ni información que el cliente no pidió.
-- No divagues ni cambies de tema.
-- Tu objetivo es llevar al cliente a una de dos opciones:
-  1) conocer servicios y precios;
-  2) agendar una hora.
-- Si la consulta no corresponde a estas opciones, responde brevemente y vuelve a ofrecerlas.
-- Nunca confirmes una hora por tu cuenta. La aplicación consulta la agenda real.
-- Nunca hables de APIs, programación, Twilio, bases de datos ni sistemas internos.
+        self.insertadas = 0
+        self.lotes = 0
+        self.errores = 0
+        self.descartadas = 0
 
-SERVICIOS HOMBRE:
-1. Corte de cabello hombre — $17.000. Incluye perfilado de cejas, lavado de cabello y aplicación de producto.
-2. Perfilado de barba — $10.000.
-3. Base de rizos permanente — $65.000.
-4. Mechas — desde $70.000.
-5. Decoloración global — $120.000.
+    def reiniciar_tras_fork(self):
+        """
+        Deja al worker recién creado con el buffer vacío y con locks,
+        hilo y archivo propios. Lo que el maestro tenía en memoria
+        sigue en sus archivos y se recupera cuando él termina o en el
+        próximo arranque.
+        """
 
-SERVICIOS MUJER:
-6. Corte de cabello mujer — $30.000. Incluye lavado de cabello, hidratación y brushing.
-7. Masaje de hidratación — $45.000.
-8. Botox capilar — desde $65.000.
-9. Alisado permanente — desde $70.000.
-10. Retoque de color de raíz — $50.000.
-11. Baño de color — $30.000.
-12. Balayage — estimado desde $150.000. Requiere diagnóstico capilar gratuito para definir el valor final.
+        self.filas = []
+        self.archivos = []
 
-HORARIO:
-Lunes a sábado, de 10:00 a 18:00.
-La última hora de inicio es a las 17:00.
-"""
+        self.archivo = None
+        self.ruta = None
 
-    mensajes = [
-        {
-            "role": "system",
-            "content": system_prompt
-        }
-    ]
+        self.lock = threading.Lock()
+        self.lock_vaciado = threading.Lock()
+        self.lock_descartes = threading.Lock()
+        self.evento = threading.Event()
 
-    ultimos = historial[-15:]
+        self.hilo = None
 
-    for item in ultimos:
+    def _asegurar_hilo(self):
 
-        if (
-            item.get("role")
-            in ("user", "assistant")
-            and item.get("content")
-        ):
+        if self.hilo is not None:
+            return
 
-            mensajes.append({
-                "role": item["role"],
-                "content": item["content"]
-            })
+        self.hilo = threading.Thread(
+            target=self._bucle,
+            name="buffer-mensajes",
+            daemon=True
+        )
 
-    # Evita duplicar el mismo mensaje de usuario
-    if not (
-        mensajes
-        and mensajes[-1]["role"] == "user"
-        and mensajes[-1]["content"] == pregunta
-    ):
+        self.hilo.start()
 
-        mensajes.append({
-            "role": "user",
-            "content": pregunta
-        })
+    def encolar(self, cliente_id, canal, role, contenido):
 
-    try:
+        fila = {
+            "cliente_id": cliente_id,
+            "canal": canal,
+            "role": role,
+            "contenido": contenido,
+            "created_at": datetime.now(pytz.utc).strftime(
+                "%Y-%m-%d %H:%M:%S+00:00"
+            ),
+        }
 
-        response = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=mensajes,
+        linea = json.dumps(
+            fila,
+            ensure_ascii=False,
+            separators=(",", ":")
         )
 
-        respuesta = (
-            response
-            .choices[0]
-            .message
-            .content
-            or ""
-        ).strip()
+        with self.lock:
 
-        if respuesta:
-            return respuesta
+            if self.archivo is None:
 
-        return (
-            "¿Te gustaría conocer los servicios "
-            "o reservar una hora? 😊"
-        )
+                self.ruta = f"{self.ruta_base}.{os.getpid()}.jsonl"
 
-    except Exception as e:
+                self.archivo = open(
+                    self.ruta,
+                    "a",
+                    encoding="utf-8"
+                )
 
-        print(
-            "OPENAI ERROR:",
-            repr(e)
-        )
+            self.archivo.write(linea + "\n")
+            self.archivo.flush()
 
-        import traceback
+            self.filas.append(fila)
 
-        print(
-            traceback.format_exc()
-        )
+            self._recortar()
 
-        return (
-            "Disculpa 🙏 Tuve un problema procesando "
-            "el mensaje. Intenta nuevamente."
-        )
+            lleno = len(self.filas) >= self.lote
 
+            self._asegurar_hilo()
 
-# ============================================================
-# ESTADO DE RESERVA
-# ============================================================
+        if lleno:
+            self.evento.set()
 
-def resetear_reserva(estado):
+    def _recortar(self):
+        """
+        Si hay más de max_pendientes filas, pasa las más antiguas al
+        archivo de descartados y reescribe los archivos de respaldo sin
+        ellas, para que recuperar() no las vuelva a insertar. Recorta
+        hasta el 90 % del cupo para no reescribir en cada mensaje. Se
+        llama con self.lock tomado.
+        """
 
-    telefono = (
-        estado
-        .get("datos_reserva", {})
-        .get("telefono")
-    )
+        if len(self.filas) <= self.max_pendientes:
+            return
 
-    estado["modo_agendar"] = False
-    estado["paso"] = "inicio"
-    estado["horas_ofrecidas"] = []
+        exceso = len(self.filas) - self.max_pendientes * 9 // 10
 
-    estado["datos_reserva"] = {
-        "servicio": None,
-        "fecha_hora": None,
-        "nombre": None,
-        "telefono": telefono,
-        "correo": None,
-        "fecha_preferida": None,
-        "mes_desde": None,
-    }
+        desbordadas = self.filas[:exceso]
+        self.filas = self.filas[exceso:]
 
+        # Primero el archivo de descartados: si el proceso muere entre
+        # ambos pasos, la fila queda repetida y no perdida.
+        self._descartar(desbordadas, "buffer lleno")
 
-# ============================================================
-# GOOGLE CALENDAR - ATENCIÓN PRESENCIAL
-# ============================================================
+        self._rotar()
 
-def crear_evento_diego(
-    inicio,
-    servicio_codigo,
-    nombre_cliente,
-    telefono_cliente,
-    correo_cliente
-):
+        anteriores = self.archivos
 
-    try:
+        try:
 
-        service = obtener_calendar_service()
+            destino = self._destino_flushing()
 
-        servicio = obtener_servicio(
-            servicio_codigo
-        )
+            self._escribir(destino, self.filas)
 
-        fin = inicio + timedelta(
-            minutes=DURACION_RESERVA
-        )
+        except OSError as e:
 
-        evento = {
+            print(
+                "ERROR ARCHIVO MENSAJES PENDIENTES:",
+                repr(e)
+            )
 
-            "summary":
-                f"{servicio['nombre']} - {nombre_cliente}",
+            return
 
-            "description":
-                (
-                    "Reserva creada por el "
-                    "Asistente Virtual de "
-                    f"Estilista {ESTILISTA_NOMBRE}.\n\n"
-                    f"Cliente: {nombre_cliente}\n"
-                    f"Teléfono: {telefono_cliente}\n"
-                    f"Correo: {correo_cliente}\n"
-                    f"Servicio: {servicio['nombre']}\n"
-                    f"Valor: {precio_texto_servicio(servicio)}\n"
-                    f"Duración: {DURACION_RESERVA} minutos\n"
-                    "Origen: Asistente Virtual"
-                ),
+        self.archivos = [destino]
 
-            "start": {
-                "dateTime": inicio.isoformat(),
-                "timeZone": TIMEZONE,
-            },
+        for archivo in anteriores:
 
-            "end": {
-                "dateTime": fin.isoformat(),
-                "timeZone": TIMEZONE,
-            },
+            try:
+                os.remove(archivo)
+            except OSError:
+                pass
 
-            "attendees": [
-                {
-                    "email": correo_cliente,
-                    "displayName": nombre_cliente,
-                }
-            ],
+    def _descartar(self, filas, motivo):
 
-            "extendedProperties": {
+        descartado_en = datetime.now(pytz.utc).strftime(
+            "%Y-%m-%d %H:%M:%S+00:00"
+        )
 
-                "private": {
+        lineas = "".join(
+            json.dumps(
+                {
+                    **fila,
+                    "motivo": motivo,
+                    "descartado_en": descartado_en,
+                },
+                ensure_ascii=False,
+                separators=(",", ":")
+            ) + "\n"
+            for fila in filas
+        )
 
-                    "cliente":
-                        nombre_cliente,
+        with self.lock_descartes:
 
-                    "telefono":
-                        telefono_cliente,
+            try:
 
-                    "correo":
-                        correo_cliente,
+                with open(
+                    self.ruta_descartados,
+                    "a",
+                    encoding="utf-8"
+                ) as archivo:
 
-                    "servicio":
-                        servicio["nombre"],
+                    archivo.write(lineas)
 
-                    "origen":
-                        (
-                            f"Asistente Virtual "
-                            f"{ESTILISTA_NOMBRE}"
-                        ),
-                }
-            },
-        }
+            except OSError as e:
 
-        resultado = (
-            service
-            .events()
-            .insert(
-                calendarId=CALENDAR_ID,
-                body=evento,
-                sendUpdates="all",
-            )
-            .execute()
-        )
+                print(
+                    "ERROR ARCHIVO MENSAJES DESCARTADOS:",
+                    repr(e)
+                )
 
-        # Atención presencial: no se crea Google Meet.
-        meet_url = None
+            self.descartadas += len(filas)
 
         print(
-            "EVENTO GOOGLE CREADO:",
-            resultado.get("id")
+            "MENSAJES DESCARTADOS:",
+            len(filas),
+            motivo
         )
 
-        return {
-            "ok": True,
-            "evento_id":
-                resultado.get("id"),
-            "link":
-                resultado.get("htmlLink"),
-            "meet_url":
-                meet_url,
-        }
+    def _guardar_por_fila(self, filas):
+        """
+        Reintenta un lote fallido fila por fila. Devuelve cuántas se
+        insertaron y las que quedan pendientes para el próximo ciclo.
+        """
 
-    except Exception as e:
+        insertadas = 0
+        pendientes = []
 
-        print(
-            "ERROR GOOGLE EVENT:",
-            repr(e)
-        )
+        for posicion, fila in enumerate(filas):
 
-        return {
-            "ok": False,
-            "error": str(e)
-        }
+            try:
 
+                guardar_mensajes_lote([fila])
 
-# ============================================================
-# RESERVA SEGURA SIN POSTGRESQL
-# ============================================================
+                insertadas += 1
+                continue
 
-def crear_reserva_segura(
-    inicio,
-    datos,
-    cliente_id,
-    canal
-):
+            except Exception as e:
+                error = e
 
-    try:
+            if not base_datos_disponible():
 
-        # Volver a comprobar disponibilidad real en Google Calendar
-        # justo antes de crear la cita.
-        disponible = verificar_disponibilidad(
-            inicio,
-            DURACION_RESERVA
-        )
+                # La base está caída: no es culpa de la fila.
+                pendientes.extend(filas[posicion:])
+                break
 
-        if disponible is not True:
-            return {
-                "ok": False,
-                "ocupada": True,
-            }
+            fila["intentos"] = fila.get("intentos", 0) + 1
 
-        resultado = crear_evento_diego(
-            inicio=inicio,
-            servicio_codigo=datos["servicio"],
-            nombre_cliente=datos["nombre"],
-            telefono_cliente=datos["telefono"],
-            correo_cliente=datos["correo"],
-        )
+            if fila["intentos"] >= self.max_reintentos:
 
-        if not resultado["ok"]:
-            return {
-                "ok": False,
-                "error": resultado.get("error")
-            }
+                self._descartar(
+                    [fila],
+                    repr(error)
+                )
 
-        return {
-            "ok": True,
-            "evento_id": resultado["evento_id"],
-            "meet_url": resultado["meet_url"],
-        }
+            else:
+                pendientes.append(fila)
 
-    except Exception as e:
-        print(
-            "ERROR RESERVA SEGURA SIN DB:",
-            repr(e)
+        return insertadas, pendientes
+
+    def _destino_flushing(self):
+        """
+        Nombre libre para un archivo .flushing de este proceso. Se
+        llama con self.lock tomado.
+        """
+
+        self.rotaciones += 1
+
+        return (
+            f"{self.ruta_base}.{os.getpid()}."
+            f"{self.rotaciones}.flushing"
         )
-        return {
-            "ok": False,
-            "error": str(e)
-        }
 
+    @staticmethod
+    def _escribir(destino, filas):
 
-# ============================================================
-# PROCESAR AGENDA
-# ============================================================
+        with open(
+            destino + ".tmp",
+            "w",
+            encoding="utf-8"
+        ) as archivo:
 
-def procesar_agenda(
-    estado,
-    texto,
-    cliente_id,
-    canal
-):
+            for fila in filas:
 
-    datos = estado["datos_reserva"]
+                archivo.write(
+                    json.dumps(
+                        fila,
+                        ensure_ascii=False,
+                        separators=(",", ":")
+                    ) + "\n"
+                )
 
-    texto = (
-        texto or ""
-    ).strip()
+        os.replace(destino + ".tmp", destino)
 
-    texto_n = normalizar_texto(texto)
+    def _reescribir(self, filas):
+        """
+        Deja las filas pendientes en un archivo .flushing nuevo para
+        poder borrar los del lote sin perderlas ni duplicar las que
+        ya se insertaron.
+        """
 
-    fecha_exacta_detectada = detectar_fecha_solicitada(
-        texto,
-        None
-    )
+        with self.lock:
+            destino = self._destino_flushing()
 
-    mes_detectado = detectar_mes_solicitado(
-        texto
-    )
+        self._escribir(destino, filas)
 
-    if fecha_exacta_detectada and texto_menciona_fecha_o_mes(texto):
-        datos["fecha_preferida"] = fecha_exacta_detectada.isoformat()
-        datos["mes_desde"] = None
+        return destino
 
-    elif mes_detectado:
-        datos["mes_desde"] = mes_detectado.isoformat()
-        datos["fecha_preferida"] = None
+    def _rotar(self):
+        """
+        Cierra el archivo actual y lo renombra a .flushing. Se llama
+        con self.lock tomado.
+        """
 
+        if self.archivo is None:
+            return
 
-    # ========================================================
-    # CANCELAR
-    # ========================================================
+        self.archivo.close()
+        self.archivo = None
 
-    if usuario_no_quiere(texto):
+        destino = self._destino_flushing()
 
-        resetear_reserva(
-            estado
-        )
+        os.replace(self.ruta, destino)
 
-        return (
-            "No hay problema  "
-            "Cuando quieras conocer los servicios "
-            "o reservar una hora con Diego, "
-            "aquí estaré. ¡Que estés muy bien! "
-        )
+        self.archivos.append(destino)
 
+    def vaciar(self):
 
-    # ========================================================
-    # SERVICIO
-    # ========================================================
+        with self.lock_vaciado:
 
-    if not datos["servicio"]:
+            with self.lock:
 
-        servicio = detectar_servicio(
-            texto
-        )
+                if not self.filas:
+                    return 0
 
-        corte_ambiguo = (
-            "corte" in texto_n
-            or "cortar" in texto_n
-            or "cortarme" in texto_n
-        ) and (
-            "pelo" in texto_n
-            or "cabello" in texto_n
-            or texto_n in {"corte", "quiero corte", "quiero un corte"}
-        )
+                self._rotar()
 
-        if not servicio and texto_n in {"hombre", "varon", "masculino"}:
-            servicio = "corte_hombre"
+                filas = self.filas
+                archivos = self.archivos
 
-        if not servicio and texto_n in {"mujer", "dama", "femenino"}:
-            servicio = "corte_mujer"
+                self.filas = []
+                self.archivos = []
 
-        if not servicio and corte_ambiguo:
-            return (
-                "Perfecto ✂️ ¿El corte es para hombre o mujer?\n\n"
-                "Respóndeme HOMBRE o MUJER.\n"
-                "Mantendré la fecha o el mes que me indicaste."
-            )
+            try:
 
-        if servicio:
+                guardar_mensajes_lote(filas)
 
-            datos["servicio"] = servicio
+                insertadas = len(filas)
+                pendientes = []
 
-            servicio_info = obtener_servicio(
-                servicio
-            )
+            except Exception as e:
 
-            # ====================================================
-            # EL CLIENTE YA INDICÓ UNA HORA
-            # Ejemplo: "quiero un corte a las 3"
-            # ====================================================
+                self.errores += 1
 
-            hora_solicitada = (
-                construir_fecha_hora_solicitada(
-                    texto
+                print(
+                    "ERROR DB LOTE MENSAJES:",
+                    repr(e)
                 )
-            )
 
-            if hora_solicitada:
+                insertadas, pendientes = self._guardar_por_fila(
+                    filas
+                )
 
-                if canal == "whatsapp":
+            if pendientes:
 
-                    enviar_mensaje_progreso_twilio(
-                        cliente_id,
-                        (
-                            "🔎 Estoy revisando si esa hora "
-                            "está disponible en mi agenda. "
-                            "Dame un momento 😊"
-                        )
-                    )
+                if len(pendientes) < len(filas):
 
-                disponible = verificar_disponibilidad(
-                    hora_solicitada,
-                    DURACION_RESERVA
-                )
+                    try:
+                        archivos_pendientes = [
+                            self._reescribir(pendientes)
+                        ]
 
-                if disponible is None:
+                    except OSError as e:
 
-                    return (
-                        "No pude comprobar la agenda "
-                        "en este momento 😕.\n\n"
-                        "Intenta nuevamente en unos segundos."
-                    )
+                        print(
+                            "ERROR ARCHIVO MENSAJES PENDIENTES:",
+                            repr(e)
+                        )
 
-                if disponible is True:
+                        archivos_pendientes = []
 
-                    datos["fecha_hora"] = (
-                        hora_solicitada.isoformat()
-                    )
+                else:
+                    archivos_pendientes = archivos
 
-                    estado["paso"] = "nombre"
+                # Se reintenta en el próximo ciclo, respetando el
+                # orden original.
+                with self.lock:
 
-                    precio = precio_texto_servicio(
-                        servicio_info
-                    )
+                    self.filas = pendientes + self.filas
+                    self.archivos = archivos_pendientes + self.archivos
 
-                    return (
-                        "¡Sí! Esa hora está disponible 😊\n\n"
-                        f"💈 {servicio_info['nombre']}\n"
-                        f"💰 {precio}\n"
-                        f"📅 {formato_fecha_larga(hora_solicitada)}\n\n"
-                        "¿Me indicas tu nombre para continuar "
-                        "con la reserva?"
-                    )
+                    self._recortar()
 
-                # La hora solicitada está ocupada:
-                # mostrar alternativas reales.
-                if canal == "whatsapp":
+                if archivos_pendientes is archivos:
+                    return insertadas
 
-                    enviar_mensaje_progreso_twilio(
-                        cliente_id,
-                        (
-                            "Esa hora está ocupada. "
-                            "Estoy buscando las alternativas "
-                            "más próximas 😊"
-                        )
-                    )
+            for archivo in archivos:
 
-                horas = buscar_proximas_15_horas()
+                try:
+                    os.remove(archivo)
+                except OSError:
+                    pass
 
-                if horas is None:
-                    return (
-                        "No pude consultar la agenda en este momento 😕.\n\n"
-                        "Revisa la conexión con Google Calendar e intenta nuevamente."
-                    )
+            self.insertadas += insertadas
+            self.lotes += 1
 
-                if not horas:
+            return insertadas
 
-                    return (
-                        f"La hora solicitada para "
-                        f"{servicio_info['nombre']} está ocupada "
-                        "y por ahora no encontré otras horas "
-                        "disponibles."
-                    )
+    def _bucle(self):
 
-                estado["horas_ofrecidas"] = [
-                    h.isoformat()
-                    for h in horas
-                ]
+        while True:
 
-                estado["paso"] = "seleccionar_hora"
+            self.evento.wait(self.intervalo)
+            self.evento.clear()
 
-                return (
-                    f"La hora que pediste "
-                    f"({formato_fecha_larga(hora_solicitada)}) "
-                    "no está disponible 😕.\n\n"
-                    "Estas son las próximas opciones disponibles:\n\n"
-                    f"{formatear_opciones_horas(horas)}\n\n"
-                    "Respóndeme con el número de la opción "
-                    "que prefieras."
-                )
+            self.vaciar()
 
-            # ====================================================
-            # NO INDICÓ HORA: respetar fecha o mes solicitado
-            # ====================================================
+    def recuperar(self):
+        """
+        Vuelve a encolar las filas que un proceso anterior dejó en
+        disco sin confirmar. Ignora los archivos de workers vivos.
 
-            if canal == "whatsapp":
+        Cada archivo se reclama con un rename atómico a un nombre con
+        el PID propio antes de leerlo: si dos workers arrancan a la
+        vez, solo uno lo consigue y el otro lo salta.
+        """
 
-                enviar_mensaje_progreso_twilio(
-                    cliente_id,
-                    (
-                        "🔎 Estoy buscando disponibilidad real "
-                        "en mi agenda. Dame un momento 😊"
-                    )
-                )
+        directorio = os.path.dirname(self.ruta_base) or "."
+        prefijo = os.path.basename(self.ruta_base) + "."
 
-            if datos.get("fecha_preferida"):
+        recuperadas = 0
 
-                fecha_preferida = datetime.fromisoformat(
-                    datos["fecha_preferida"]
-                )
+        for nombre in sorted(os.listdir(directorio)):
 
-                horas = buscar_horas_disponibles_dia(
-                    fecha_preferida
-                )
+            if not nombre.startswith(prefijo):
+                continue
 
-                if horas is None:
-                    return (
-                        "No pude consultar Google Calendar en este momento 😕.\n\n"
-                        "Intenta nuevamente en unos segundos."
-                    )
+            if not nombre.endswith((".jsonl", ".flushing")):
+                continue
 
-                if not es_dia_atencion(fecha_preferida):
-                    return (
-                        f"El {DIAS_NOMBRES[fecha_preferida.weekday()]} "
-                        f"{fecha_preferida.day}/{fecha_preferida.month} no atendemos.\n\n"
-                        "Atendemos de lunes a sábado entre 10:00 y 18:00.\n\n"
-                        "Puedes indicarme otra fecha o escribir MENÚ."
-                    )
+            pid = nombre[len(prefijo):].split(".")[0]
 
-                if not horas:
-                    desde = (
-                        fecha_preferida
-                        + timedelta(days=1)
-                    ).replace(
-                        hour=0,
-                        minute=0,
-                        second=0,
-                        microsecond=0
-                    )
+            if not pid.isdigit() or int(pid) == os.getpid():
+                continue
 
-                    horas = buscar_proximas_15_horas(
-                        desde=desde
-                    )
+            try:
+                os.kill(int(pid), 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except OSError:
+                continue
 
-                    if horas is None:
-                        return (
-                            "Ese día está completo y no pude consultar "
-                            "las horas siguientes en este momento 😕."
-                        )
+            ruta = os.path.join(directorio, nombre)
 
-                    if not horas:
-                        return (
-                            f"El {fecha_preferida.day}/{fecha_preferida.month} "
-                            "está completo y no encontré horas posteriores disponibles."
-                        )
+            with self.lock:
+                destino = self._destino_flushing()
 
-                    prefijo = (
-                        f"El {fecha_preferida.day}/{fecha_preferida.month} "
-                        "está completo 😕.\n\n"
-                        "Estas son las próximas 15 horas disponibles desde el día siguiente:\n\n"
-                    )
+            try:
 
-                else:
-                    prefijo = (
-                        f"Sí 😊 Para el {fecha_preferida.day}/{fecha_preferida.month} "
-                        "tengo estas horas disponibles:\n\n"
-                    )
+                os.rename(ruta, destino)
 
-            elif datos.get("mes_desde"):
+            except FileNotFoundError:
 
-                desde_mes = datetime.fromisoformat(
-                    datos["mes_desde"]
-                )
+                # Otro worker lo reclamó primero.
+                continue
 
-                horas = buscar_proximas_15_horas(
-                    desde=desde_mes
+            except OSError as e:
+
+                print(
+                    "ERROR RECUPERANDO MENSAJES:",
+                    nombre,
+                    repr(e)
                 )
 
-                if horas is None:
-                    return (
-                        "No pude consultar Google Calendar en este momento 😕.\n\n"
-                        "Intenta nuevamente en unos segundos."
-                    )
+                continue
 
-                if not horas:
-                    return (
-                        f"No encontré horas disponibles desde "
-                        f"{MESES_NOMBRES[desde_mes.month - 1]} por ahora."
-                    )
+            filas = []
 
-                prefijo = (
-                    f"Perfecto 😊 Estas son las primeras 15 horas disponibles "
-                    f"desde {MESES_NOMBRES[desde_mes.month - 1]}:\n\n"
-                )
+            with open(destino, encoding="utf-8") as archivo:
 
-            else:
+                for linea in archivo:
 
-                horas = buscar_proximas_15_horas()
+                    try:
+                        filas.append(json.loads(linea))
+                    except ValueError:
+                        # Última línea cortada por la caída.
+                        pass
 
-                if horas is None:
-                    return (
-                        "Elegiste el servicio, pero no pude consultar "
-                        "Google Calendar en este momento 😕.\n\n"
-                        "Intenta nuevamente en unos segundos."
-                    )
+            with self.lock:
 
-                if not horas:
-                    return (
-                        f"Perfecto. Elegiste {servicio_info['nombre']}.\n\n"
-                        "Pero por ahora no encontré horas disponibles."
-                    )
+                self.filas = filas + self.filas
+                self.archivos.append(destino)
 
-                prefijo = "Estas son las próximas 15 horas disponibles:\n\n"
+                self._recortar()
 
-            estado["horas_ofrecidas"] = [
-                h.isoformat()
-                for h in horas
-            ]
+            recuperadas += len(filas)
 
-            estado["paso"] = "seleccionar_hora"
+        if recuperadas:
 
-            precio = precio_texto_servicio(
-                servicio_info
+            print(
+                "MENSAJES RECUPERADOS DEL DISCO:",
+                recuperadas
             )
 
-            return (
-                f"💈 {servicio_info['nombre']}\n"
-                f"💰 {precio}\n\n"
-                f"{prefijo}"
-                f"{formatear_opciones_horas(horas)}\n\n"
-                "Respóndeme con el número de la hora que prefieras.\n"
-                "También puedes escribir otra fecha, otro mes o MENÚ."
-            )
+            self.vaciar()
 
-        return mostrar_servicios()
+        return recuperadas
 
+    def cerrar(self):
 
-    # ========================================================
-    # HORA
-    # ========================================================
+        self.vaciar()
 
-    if estado["paso"] == "seleccionar_hora":
+        with self.lock:
 
-        # ====================================================
-        # EL CLIENTE PUEDE CAMBIAR DE DÍA EN LENGUAJE NATURAL
-        # Ejemplos:
-        # "mañana no hay?"
-        # "¿y el viernes?"
-        # "tienes disponibilidad el miércoles?"
-        # ====================================================
+            if self.archivo is not None and not self.filas:
 
-        fecha_consultada = detectar_fecha_solicitada(
-            texto,
-            None
-        )
+                self.archivo.close()
+                self.archivo = None
 
-        mes_consultado = detectar_mes_solicitado(
-            texto
-        )
+                try:
+                    os.remove(self.ruta)
+                except OSError:
+                    pass
 
-        texto_n = normalizar_texto(texto)
+                self.ruta = None
 
-        if mes_consultado:
+    def metricas(self):
 
-            if canal == "whatsapp":
-                enviar_mensaje_progreso_twilio(
-                    cliente_id,
-                    "🔎 Estoy revisando la disponibilidad desde ese mes 😊"
-                )
+        with self.lock:
 
-            horas_mes = buscar_proximas_15_horas(
-                desde=mes_consultado
-            )
+            return {
+                "pendientes": len(self.filas),
+                "archivos_pendientes": len(self.archivos),
+                "insertadas": self.insertadas,
+                "lotes": self.lotes,
+                "errores": self.errores,
+                "descartadas": self.descartadas,
+            }
 
-            if horas_mes is None:
-                return (
-                    "No pude consultar Google Calendar en este momento 😕.\n\n"
-                    "Intenta nuevamente en unos segundos."
-                )
 
-            if not horas_mes:
-                return (
-                    f"No encontré horas disponibles desde "
-                    f"{MESES_NOMBRES[mes_consultado.month - 1]} por ahora."
-                )
+BUFFER_MENSAJES = BufferMensajes(
+    DB_MENSAJES_SPILL_PATH,
+    DB_MENSAJES_LOTE,
+    DB_MENSAJES_INTERVALO_SECONDS,
+    DB_MENSAJES_MAX_PENDIENTES,
+    DB_MENSAJES_MAX_REINTENTOS,
+    DB_MENSAJES_DESCARTADOS_PATH
+)
 
-            estado["horas_ofrecidas"] = [
-                h.isoformat()
-                for h in horas_mes
-            ]
+atexit.register(BUFFER_MENSAJES.cerrar)
 
-            datos["mes_desde"] = mes_consultado.isoformat()
-            datos["fecha_preferida"] = None
+os.register_at_fork(
+    after_in_child=BUFFER_MENSAJES.reiniciar_tras_fork
+)
 
-            return (
-                f"Estas son las primeras 15 horas disponibles desde "
-                f"{MESES_NOMBRES[mes_consultado.month - 1]}:\n\n"
-                f"{formatear_opciones_horas(horas_mes)}\n\n"
-                "Respóndeme con el número de la hora que prefieras.\n"
+
+# ============================================================
+# CONFIGURACIÓN DEL NEGOCIO
+# ============================================================
+
+ESTILISTA_NOMBRE = os.getenv(
+    "ESTILISTA_NOMBRE",
+    "Diego"
+)
+
+NEGOCIO_NOMBRE = os.getenv(
+    "NEGOCIO_NOMBRE",
+    "Estilista Diego"
+)
+
+TIMEZONE = os.getenv(
+    "TIMEZONE",
+    "America/Santiago"
+)
+
+CALENDAR_ID = os.getenv(
+    "GOOGLE_CALENDAR_ID",
+    "primary"
+)
+
+
+# ============================================================
+# HORARIO
+# ============================================================
+
+HORA_APERTURA = 10
+HORA_CIERRE = 18
+
+DURACION_RESERVA = 60
+
+DIAS_ATENCION = {
+    0: "lunes",
+    1: "martes",
+    2: "miércoles",
+    3: "jueves",
+    4: "viernes",
+    5: "sábado",
+}
+
+HORAS_DISPONIBLES = list(
+    range(
+        HORA_APERTURA,
+        HORA_CIERRE
+    )
+)
+
+# Excepciones por fecha sobre el horario semanal, en JSON:
+# {"2026-09-18": null, "2026-12-24": [10, 14]}
+# null = cerrado (feriado); [apertura, cierre] = horario especial.
+HORARIO_EXCEPCIONES_JSON = os.getenv(
+    "HORARIO_EXCEPCIONES",
+    ""
+)
+
+# Días hacia adelante que se precalculan en el horario compilado.
+HORARIO_HORIZONTE_DIAS = int(
+    os.getenv(
+        "HORARIO_HORIZONTE_DIAS",
+        "400"
+    )
+)
+
+
+# ============================================================
+# SERVICIOS
+# ============================================================
+
+SERVICIOS = {
+
+    "corte_hombre": {
+        "numero": 1,
+        "grupo": "hombre",
+        "nombre": "Corte de cabello hombre",
+        "duracion": 60,
+        "precio": 17000,
+        "precio_texto": "$17.000",
+        "detalle": "Incluye perfilado de cejas, lavado de cabello y aplicación de producto.",
+    },
+
+    "perfilado_barba": {
+        "numero": 2,
+        "grupo": "hombre",
+        "nombre": "Perfilado de barba",
+        "duracion": 60,
+        "precio": 10000,
+        "precio_texto": "$10.000",
+    },
+
+    "base_rizos": {
+        "numero": 3,
+        "grupo": "hombre",
+        "nombre": "Base de rizos permanente",
+        "duracion": 60,
+        "precio": 65000,
+        "precio_texto": "$65.000",
+    },
+
+    "mechas_hombre": {
+        "numero": 4,
+        "grupo": "hombre",
+        "nombre": "Mechas",
+        "duracion": 60,
+        "precio": 70000,
+        "precio_texto": "desde $70.000",
+    },
+
+    "decoloracion_global": {
+        "numero": 5,
+        "grupo": "hombre",
+        "nombre": "Decoloración global",
+        "duracion": 60,
+        "precio": 120000,
+        "precio_texto": "$120.000",
+    },
+
+    "corte_mujer": {
+        "numero": 6,
+        "grupo": "mujer",
+        "nombre": "Corte de cabello mujer",
+        "duracion": 60,
+        "precio": 30000,
+        "precio_texto": "$30.000",
+        "detalle": "Incluye lavado de cabello, hidratación y brushing.",
+    },
+
+    "masaje_hidratacion": {
+        "numero": 7,
+        "grupo": "mujer",
+        "nombre": "Masaje de hidratación",
+        "duracion": 60,
+        "precio": 45000,
+        "precio_texto": "$45.000",
+    },
+
+    "botox_capilar": {
+        "numero": 8,
+        "grupo": "mujer",
+        "nombre": "Botox capilar",
+        "duracion": 60,
+        "precio": 65000,
+        "precio_texto": "desde $65.000",
+    },
+
+    "alisado_permanente": {
+        "numero": 9,
+        "grupo": "mujer",
+        "nombre": "Alisado permanente",
+        "duracion": 60,
+        "precio": 70000,
+        "precio_texto": "desde $70.000",
+    },
+
+    "retoque_raiz": {
+        "numero": 10,
+        "grupo": "mujer",
+        "nombre": "Retoque de color de raíz",
+        "duracion": 60,
+        "precio": 50000,
+        "precio_texto": "$50.000",
+    },
+
+    "bano_color": {
+        "numero": 11,
+        "grupo": "mujer",
+        "nombre": "Baño de color",
+        "duracion": 60,
+        "precio": 30000,
+        "precio_texto": "$30.000",
+    },
+
+    "diagnostico_balayage": {
+        "numero": 12,
+        "grupo": "mujer",
+        "nombre": "Diagnóstico capilar gratuito para Balayage",
+        "duracion": 60,
+        "precio": 0,
+        "precio_texto": "Diagnóstico gratuito · Balayage estimado desde $150.000",
+        "detalle": "El valor final del Balayage se define después del diagnóstico capilar.",
+    },
+}
+
+SERVICIO_POR_NUMERO = {
+    servicio["numero"]: codigo
+    for codigo, servicio in SERVICIOS.items()
+}
+
+
+# ============================================================
+# GOOGLE
+# ============================================================
+
+GOOGLE_CLIENT_ID = os.getenv(
+    "GOOGLE_CLIENT_ID"
+)
+
+GOOGLE_CLIENT_SECRET = os.getenv(
+    "GOOGLE_CLIENT_SECRET"
+)
+
+GOOGLE_REFRESH_TOKEN = os.getenv(
+    "GOOGLE_REFRESH_TOKEN"
+)
+
+GOOGLE_REDIRECT_URI = os.getenv(
+    "GOOGLE_REDIRECT_URI",
+    "https://chatbot-laortiga-9.onrender.com/callback"
+)
+
+SCOPES = [
+    "https://www.googleapis.com/auth/calendar"
+]
+
+
+# ============================================================
+# GOOGLE FLOW
+# ============================================================
+
+def crear_google_flow():
+
+    return Flow.from_client_config(
+        {
+            "web": {
+                "client_id": GOOGLE_CLIENT_ID,
+                "client_secret": GOOGLE_CLIENT_SECRET,
+                "auth_uri":
+                    "https://accounts.google.com/o/oauth2/auth",
+                "token_uri":
+                    "https://oauth2.googleapis.com/token",
+                "redirect_uris": [
+                    GOOGLE_REDIRECT_URI
+                ],
+            }
+        },
+        scopes=SCOPES,
+        redirect_uri=GOOGLE_REDIRECT_URI
+    )
+
+
+def obtener_credentials_diego():
+
+    if not GOOGLE_REFRESH_TOKEN:
+        raise Exception(
+            "Falta GOOGLE_REFRESH_TOKEN."
+        )
+
+    return Credentials(
+        token=None,
+        refresh_token=GOOGLE_REFRESH_TOKEN,
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=GOOGLE_CLIENT_ID,
+        client_secret=GOOGLE_CLIENT_SECRET,
+        scopes=SCOPES,
+    )
+
+
+# Las credenciales (y su access token) se comparten en todo el
+# proceso y solo se refrescan cerca de su expiración. Cada hilo
+# guarda su propio objeto service, porque httplib2 no es
+# thread-safe, y lo reutiliza junto con su conexión HTTP.
+
+CALENDAR_TOKEN_MARGEN_SECONDS = int(
+    os.getenv(
+        "CALENDAR_TOKEN_MARGEN_SECONDS",
+        "300"
+    )
+)
+
+CALENDAR_SERVICE_LOCK = threading.Lock()
+
+CALENDAR_SERVICE_LOCAL = threading.local()
+
+CALENDAR_SERVICE_STATE = {
+    "credentials": None,
+    "http_refresh": None,
+}
+
+CALENDAR_SERVICE_STATS = {
+    "refrescos_token": 0,
+    "refrescos_evitados": 0,
+    "servicios_construidos": 0,
+    "construcciones_evitadas": 0,
+}
+
+
+def obtener_credentials_vigentes():
+    """
+    Devuelve las credenciales compartidas con un access token
+    válido por al menos CALENDAR_TOKEN_MARGEN_SECONDS.
+    """
+
+    with CALENDAR_SERVICE_LOCK:
+
+        credentials = CALENDAR_SERVICE_STATE["credentials"]
+
+        if credentials is None:
+
+            credentials = obtener_credentials_diego()
+
+            CALENDAR_SERVICE_STATE["credentials"] = credentials
+
+            # Sesión HTTP reutilizada para los refrescos de token.
+            CALENDAR_SERVICE_STATE["http_refresh"] = GoogleAuthRequest(
+                session=requests.Session()
+            )
+
+        # google-auth guarda expiry como UTC sin zona horaria.
+        vigente = (
+            credentials.token
+            and credentials.expiry
+            and credentials.expiry - datetime.utcnow()
+            > timedelta(seconds=CALENDAR_TOKEN_MARGEN_SECONDS)
+        )
+
+        if vigente:
+
+            CALENDAR_SERVICE_STATS["refrescos_evitados"] += 1
+
+        else:
+
+            credentials.refresh(
+                CALENDAR_SERVICE_STATE["http_refresh"]
+            )
+
+            CALENDAR_SERVICE_STATS["refrescos_token"] += 1
+
+        return credentials
+
+
+def obtener_calendar_service():
+
+    credentials = obtener_credentials_vigentes()
+
+    service = getattr(
+        CALENDAR_SERVICE_LOCAL,
+        "service",
+        None
+    )
+
+    if (
+        service is not None
+        and CALENDAR_SERVICE_LOCAL.credentials is credentials
+    ):
+
+        with CALENDAR_SERVICE_LOCK:
+            CALENDAR_SERVICE_STATS["construcciones_evitadas"] += 1
+
+        return service
+
+    service = build(
+        "calendar",
+        "v3",
+        credentials=credentials,
+        cache_discovery=False,
+    )
+
+    CALENDAR_SERVICE_LOCAL.service = service
+    CALENDAR_SERVICE_LOCAL.credentials = credentials
+
+    with CALENDAR_SERVICE_LOCK:
+        CALENDAR_SERVICE_STATS["servicios_construidos"] += 1
+
+    return service
+
+
+def estadisticas_calendar_service():
+
+    with CALENDAR_SERVICE_LOCK:
+        return dict(CALENDAR_SERVICE_STATS)
+
+
+# ============================================================
+# FECHA / HORA
+# ============================================================
+
+# La zona se resuelve una sola vez; pytz.timezone() busca en su
+# registro en cada llamada.
+ZONA = pytz.timezone(TIMEZONE)
+
+
+def obtener_zona():
+    return ZONA
+
+
+def en_zona_local(fecha):
+    """
+    Lleva una fecha aware a TIMEZONE. Siempre pasa por normalize():
+    una fecha de la misma zona puede traer el offset equivocado si se
+    le sumó un timedelta que cruza un cambio de horario.
+    """
+
+    return ZONA.normalize(
+        fecha.astimezone(pytz.utc)
+    )
+
+
+def ahora_local():
+
+    return datetime.now(
+        obtener_zona()
+    )
+
+
+# Marcas diacríticas combinantes (tilde, diéresis, la virgulilla de
+# la ñ, etc.) que quedan separadas de su letra después de NFD.
+REGEX_DIACRITICOS = re.compile("[\u0300-\u036f]+")
+
+NORMALIZAR_CACHE_LARGO = 40
+
+
+def plegar_texto(texto):
+
+    texto = texto.strip().lower()
+
+    if texto.isascii():
+        return texto
+
+    return REGEX_DIACRITICOS.sub(
+        "",
+        unicodedata.normalize("NFD", texto)
+    )
+
+
+# Los mensajes cortos se repiten mucho ("1", "hola", "menu", "si").
+plegar_texto_corto = lru_cache(maxsize=4096)(plegar_texto)
+
+
+def normalizar_texto(texto):
+    """
+    Minúsculas, sin espacios en los extremos y sin tildes, diéresis
+    ni eñes, tanto en caracteres compuestos como combinantes:
+    "MAÑANA" -> "manana".
+    """
+
+    texto = texto or ""
+
+    if len(texto) <= NORMALIZAR_CACHE_LARGO:
+        return plegar_texto_corto(texto)
+
+    return plegar_texto(texto)
+
+
+DIAS_NOMBRES = [
+    "lunes",
+    "martes",
+    "miércoles",
+    "jueves",
+    "viernes",
+    "sábado",
+    "domingo",
+]
+
+
+MESES_NOMBRES = [
+    "enero", "febrero", "marzo", "abril", "mayo", "junio",
+    "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"
+]
+
+MESES_MAP = {
+    "enero": 1,
+    "febrero": 2,
+    "marzo": 3,
+    "abril": 4,
+    "mayo": 5,
+    "junio": 6,
+    "julio": 7,
+    "agosto": 8,
+    "septiembre": 9,
+    "setiembre": 9,
+    "octubre": 10,
+    "noviembre": 11,
+    "diciembre": 12,
+}
+
+
+def compilar_alternativa(patrones, palabras_completas=False):
+    """
+    Une una lista de frases en una sola expresión regular.
+
+    Sin palabras_completas equivale a any(p in texto for p in
+    patrones); con palabras_completas, a buscar cada frase entre
+    límites de palabra.
+    """
+
+    # Las frases largas primero: no cambian el resultado, pero evitan
+    # retroceder cuando una frase es prefijo de otra.
+    alternativas = "|".join(
+        re.escape(patron)
+        for patron in sorted(
+            set(patrones),
+            key=len,
+            reverse=True
+        )
+    )
+
+    if palabras_completas:
+        return re.compile(rf"\b(?:{alternativas})\b")
+
+    return re.compile(alternativas)
+
+
+def es_comando_menu(texto, texto_n=None):
+    if texto_n is None:
+        texto_n = normalizar_texto(texto)
+    comandos = {
+        "menu",
+        "menu principal",
+        "volver al menu",
+        "volver al menu principal",
+        "inicio",
+        "volver",
+    }
+    return texto_n in comandos
+
+
+def detectar_mes_solicitado(texto):
+    """
+    Detecta un mes indicado sin un día específico.
+    Ejemplos:
+    - "en septiembre"
+    - "quiero hora para octubre"
+
+    Devuelve el primer día del mes solicitado, en el año correcto.
+    Si el mes de este año ya pasó, usa el año siguiente.
+    Si el mensaje contiene un día explícito, devuelve None para que
+    detectar_fecha_solicitada() procese la fecha exacta.
+    """
+    zona = obtener_zona()
+
+    return resolver_mes(
+        tokenizar_fecha_hora(
+            normalizar_texto(texto)
+        ),
+        datetime.now(zona),
+        zona
+    )
+
+
+def texto_menciona_fecha_o_mes(texto):
+    texto_n = normalizar_texto(texto)
+
+    return bool(
+        REGEX_INTENCIONES["fecha_o_mes"].search(texto_n)
+    )
+
+
+def es_dia_atencion(fecha):
+
+    fecha = en_zona_local(fecha)
+
+    return bool(
+        horario_del_dia(fecha.date())[0]
+    )
+
+
+def formato_fecha_corta(fecha):
+
+    fecha = en_zona_local(fecha)
+
+    return (
+        f"{DIAS_NOMBRES[fecha.weekday()]} "
+        f"{fecha.day}/{fecha.month} "
+        f"{fecha.hour:02d}:{fecha.minute:02d}"
+    )
+
+
+def formatear_fechas_cortas(fechas):
+    """
+    Formatea una lista de horas de una vez, con los nombres y la zona
+    en variables locales. Mismo formato que formato_fecha_corta.
+    """
+
+    dias = DIAS_NOMBRES
+    zona = ZONA
+    utc = pytz.utc
+
+    textos = []
+
+    for fecha in fechas:
+
+        # Igual que en_zona_local: sin atajo para fechas que ya están
+        # en la zona, que pueden traer el offset de antes de un
+        # cambio de horario.
+        fecha = zona.normalize(fecha.astimezone(utc))
+
+        textos.append(
+            f"{dias[fecha.weekday()]} "
+            f"{fecha.day}/{fecha.month} "
+            f"{fecha.hour:02d}:{fecha.minute:02d}"
+        )
+
+    return textos
+
+
+def formato_fecha_larga(fecha):
+
+    fecha = en_zona_local(fecha)
+
+    return (
+        f"{DIAS_NOMBRES[fecha.weekday()]} "
+        f"{fecha.day} de "
+        f"{MESES_NOMBRES[fecha.month - 1]} "
+        f"a las {fecha.hour:02d}:{fecha.minute:02d}"
+    )
+
+
+# ============================================================
+# HORARIO COMPILADO
+# ============================================================
+
+# El horario semanal y las excepciones se expanden una vez a horas
+# de inicio concretas (timezone-aware) para HORARIO_HORIZONTE_DIAS.
+# Se recompila automáticamente en el primer uso después de la
+# medianoche en TIMEZONE.
+
+def cargar_excepciones_horario(texto):
+    """
+    Lee HORARIO_EXCEPCIONES. Una entrada con fecha u horas inválidas
+    se descarta con un aviso; las demás se mantienen.
+    """
+
+    if not texto:
+        return {}
+
+    try:
+        entradas = json.loads(texto).items()
+
+    except Exception as e:
+
+        print(
+            "ERROR LEYENDO HORARIO_EXCEPCIONES:",
+            repr(e)
+        )
+
+        return {}
+
+    excepciones = {}
+
+    for fecha_texto, horario in entradas:
+
+        try:
+
+            fecha = datetime.fromisoformat(fecha_texto).date()
+
+            if horario is None:
+                excepciones[fecha] = None
+                continue
+
+            apertura = int(horario[0])
+            cierre = int(horario[1])
+
+            # dt_time() no acepta 24: el cierre más tardío es 23:00.
+            if not 0 <= apertura < cierre <= 23:
+                raise ValueError(
+                    f"horario fuera de rango: {horario}"
+                )
+
+            excepciones[fecha] = (apertura, cierre)
+
+        except Exception as e:
+
+            print(
+                "ERROR EN HORARIO_EXCEPCIONES, SE IGNORA:",
+                fecha_texto,
+                repr(e)
+            )
+
+    return excepciones
+
+
+HORARIO_EXCEPCIONES = cargar_excepciones_horario(
+    HORARIO_EXCEPCIONES_JSON
+)
+
+HORARIO_COMPILADO = {
+    "fecha": None,
+    "por_dia": {},
+    "inicios": [],
+    "timestamps": np.array([], dtype=np.int64),
+}
+
+HORARIO_LOCK = threading.Lock()
+
+
+def compilar_dia(fecha):
+    """
+    Devuelve (inicios, cierre) para una fecha: las horas de inicio
+    de reserva de ese día y el datetime de cierre. Un día sin
+    atención devuelve ([], None).
+    """
+
+    if fecha in HORARIO_EXCEPCIONES:
+        horario = HORARIO_EXCEPCIONES[fecha]
+    elif fecha.weekday() in DIAS_ATENCION:
+        horario = (HORA_APERTURA, HORA_CIERRE)
+    else:
+        horario = None
+
+    if not horario:
+        return [], None
+
+    apertura, cierre = horario
+
+    zona = obtener_zona()
+
+    cierre_dt = zona.localize(
+        datetime.combine(
+            fecha,
+            dt_time(cierre)
+        )
+    )
+
+    duracion = timedelta(
+        minutes=DURACION_RESERVA
+    )
+
+    inicios = []
+
+    for hora in range(apertura, cierre):
+
+        inicio = zona.localize(
+            datetime.combine(
+                fecha,
+                dt_time(hora)
+            )
+        )
+
+        # No permitir reservas que terminen después del cierre.
+        if inicio + duracion <= cierre_dt:
+            inicios.append(inicio)
+
+    return inicios, cierre_dt
+
+
+def compilar_horario():
+
+    hoy = ahora_local().date()
+
+    por_dia = {}
+    inicios = []
+
+    for offset in range(HORARIO_HORIZONTE_DIAS):
+
+        fecha = hoy + timedelta(days=offset)
+
+        por_dia[fecha] = compilar_dia(fecha)
+
+        inicios.extend(por_dia[fecha][0])
+
+    return {
+        "fecha": hoy,
+        "por_dia": por_dia,
+        "inicios": inicios,
+        "timestamps": np.asarray(
+            [
+                int(inicio.timestamp())
+                for inicio in inicios
+            ],
+            dtype=np.int64
+        ),
+    }
+
+
+def obtener_horario_compilado():
+
+    global HORARIO_COMPILADO
+
+    hoy = ahora_local().date()
+
+    if HORARIO_COMPILADO["fecha"] == hoy:
+        return HORARIO_COMPILADO
+
+    with HORARIO_LOCK:
+
+        if HORARIO_COMPILADO["fecha"] != hoy:
+
+            HORARIO_COMPILADO = compilar_horario()
+
+            print(
+                "HORARIO COMPILADO:",
+                len(HORARIO_COMPILADO["inicios"]),
+                "HORAS DESDE",
+                hoy.isoformat()
+            )
+
+    return HORARIO_COMPILADO
+
+
+def horario_del_dia(fecha):
+    """
+    (inicios, cierre) de una fecha local, desde el horario
+    compilado o calculado al vuelo si está fuera del horizonte.
+    """
+
+    dia = obtener_horario_compilado()["por_dia"].get(fecha)
+
+    if dia is not None:
+        return dia
+
+    return compilar_dia(fecha)
+
+
+def candidatos_en_rango(desde, dias):
+    """
+    Horas de inicio del horario desde el día local de "desde"
+    durante "dias" días, como (lista de datetimes, timestamps int64).
+    """
+
+    horario = obtener_horario_compilado()
+
+    primer_dia = desde.astimezone(obtener_zona()).date()
+    ultimo_dia = primer_dia + timedelta(days=dias)
+
+    compilados = horario["por_dia"]
+
+    if (
+        primer_dia in compilados
+        and ultimo_dia in compilados
+    ):
+
+        timestamps = horario["timestamps"]
+
+        desde_ts = obtener_zona().localize(
+            datetime.combine(primer_dia, dt_time(0))
+        ).timestamp()
+
+        hasta_ts = obtener_zona().localize(
+            datetime.combine(ultimo_dia, dt_time(0))
+        ).timestamp()
+
+        lo = int(np.searchsorted(timestamps, desde_ts, side="left"))
+        hi = int(np.searchsorted(timestamps, hasta_ts, side="left"))
+
+        return horario["inicios"][lo:hi], timestamps[lo:hi]
+
+    inicios = []
+
+    for offset in range(dias):
+        inicios.extend(
+            horario_del_dia(primer_dia + timedelta(days=offset))[0]
+        )
+
+    return inicios, np.asarray(
+        [
+            int(inicio.timestamp())
+            for inicio in inicios
+        ],
+        dtype=np.int64
+    )
+
+
+obtener_horario_compilado()
+
+
+# ============================================================
+# SERVICIOS
+# ============================================================
+
+def obtener_servicio(codigo):
+
+    return SERVICIOS.get(
+        codigo,
+        {
+            "nombre": "Servicio",
+            "duracion": 60,
+            "precio": 0,
+            "precio_texto": "Valor a confirmar",
+        }
+    )
+
+
+def precio_texto_servicio(servicio):
+
+    if servicio.get("precio_texto"):
+        return servicio["precio_texto"]
+
+    precio = servicio.get("precio", 0)
+
+    return (
+        f"${precio:,}"
+        .replace(",", ".")
+    )
+
+
+def mensaje_menu_principal():
+
+    return (
+        f"¡Hola! 👋 Soy el asistente virtual de {ESTILISTA_NOMBRE}.\n\n"
+        "¿Qué te gustaría hacer?\n\n"
+        "1. Conocer servicios y precios 💇‍♂️💇‍♀️\n"
+        "2. Agendar una hora 📅\n\n"
+        "Respóndeme con 1 o 2."
+    )
+
+
+def mostrar_servicios():
+
+    return (
+        "Estos son nuestros servicios y precios 👇\n\n"
+        "👨 HOMBRE\n"
+        "1. Corte de cabello hombre — $17.000\n"
+        "   Incluye perfilado de cejas, lavado de cabello y aplicación de producto.\n\n"
+        "2. Perfilado de barba — $10.000\n"
+        "3. Base de rizos permanente — $65.000\n"
+        "4. Mechas — desde $70.000\n"
+        "5. Decoloración global — $120.000\n\n"
+        "👩 MUJER\n"
+        "6. Corte de cabello mujer — $30.000\n"
+        "   Incluye lavado de cabello, hidratación y brushing.\n\n"
+        "7. Masaje de hidratación — $45.000\n"
+        "8. Botox capilar — desde $65.000\n"
+        "9. Alisado permanente — desde $70.000\n"
+        "10. Retoque de color de raíz — $50.000\n"
+        "11. Baño de color — $30.000\n"
+        "12. Balayage — valor estimado desde $150.000\n"
+        "    Requiere agendar un diagnóstico capilar gratuito para definir el valor final.\n\n"
+        "Para agendar, respóndeme con el número del servicio (1 al 12).\n"
+        "Si solo querías revisar precios, puedes escribir MENÚ para volver."
+    )
+
+
+def detectar_servicio_por_numero(texto):
+
+    match = re.fullmatch(
+        r"\s*(\d{1,2})\s*",
+        texto or ""
+    )
+
+    if not match:
+        return None
+
+    numero = int(match.group(1))
+
+    return SERVICIO_POR_NUMERO.get(numero)
+
+
+def detectar_servicio(texto, texto_n=None):
+    """
+    texto_n permite pasar el texto ya normalizado (como lo hace
+    analizar_mensaje) para no repetir normalizar_texto().
+    """
+
+    if texto_n is None:
+        texto_n = normalizar_texto(texto)
+
+    servicio_numero = detectar_servicio_por_numero(texto)
+
+    if servicio_numero:
+        return servicio_numero
+
+    # Servicios con nombres suficientemente específicos.
+    if "corte" in texto_n and (
+        "mujer" in texto_n
+        or "dama" in texto_n
+        or "femenino" in texto_n
+    ):
+        return "corte_mujer"
+
+    if "corte" in texto_n and (
+        "hombre" in texto_n
+        or "varon" in texto_n
+        or "masculino" in texto_n
+    ):
+        return "corte_hombre"
+
+    if "perfilado" in texto_n and "barba" in texto_n:
+        return "perfilado_barba"
+
+    if "barba" in texto_n:
+        return "perfilado_barba"
+
+    if "rizo" in texto_n or "permanente de rizo" in texto_n:
+        return "base_rizos"
+
+    if "mecha" in texto_n:
+        return "mechas_hombre"
+
+    if "decoloracion" in texto_n:
+        return "decoloracion_global"
+
+    if "masaje" in texto_n and "hidrat" in texto_n:
+        return "masaje_hidratacion"
+
+    if "botox" in texto_n:
+        return "botox_capilar"
+
+    if "alisado" in texto_n:
+        return "alisado_permanente"
+
+    if "retoque" in texto_n and "raiz" in texto_n:
+        return "retoque_raiz"
+
+    if "bano de color" in texto_n or ("bano" in texto_n and "color" in texto_n):
+        return "bano_color"
+
+    if "balayage" in texto_n:
+        return "diagnostico_balayage"
+
+    # "corte" a secas es ambiguo: no asumimos hombre o mujer.
+    return None
+
+
+# ============================================================
+# DETECTAR FECHA / HORA SOLICITADA EN TEXTO LIBRE
+# ============================================================
+
+# Un solo patrón reconoce todas las expresiones de fecha y hora que
+# entiende el bot. Cada alternativa va dentro de un lookahead, así
+# que el recorrido no consume texto: "a las 10 de octubre" entrega
+# tanto la hora ("a las 10") como la fecha ("10 de octubre"), igual
+# que si se buscara cada patrón por separado.
+#
+# Prioridades al combinar (las mismas de siempre):
+#   hora:  15:30  >  3 pm / 3:30 pm  >  "a las 3" (1..6 -> tarde)
+#   fecha: "2 de septiembre"  >  pasado mañana  >  mañana  >  hoy
+#          >  día de la semana (en orden lunes..domingo)
+#          >  próximo día de atención con esa hora
+#   mes:   solo si no hay día explícito; gana el primero de MESES_MAP.
+
+_MESES_PATRON = "|".join(MESES_MAP)
+
+DIAS_SEMANA_MAP = {
+    "lunes": 0,
+    "martes": 1,
+    "miercoles": 2,
+    "jueves": 3,
+    "viernes": 4,
+    "sabado": 5,
+    "domingo": 6,
+}
+
+REGEX_FECHA_HORA = re.compile(
+    r"(?=(?:"
+    r"(?P<dia_mes>\b(?:el\s+)?(?P<dia>[0-3]?\d)\s*(?:de\s+)?"
+    rf"(?P<mes_dia>{_MESES_PATRON})\b)"
+    r"|(?P<hhmm>(?:a\s+las?\s+)?\b(?P<hh>[01]?\d|2[0-3])[:.](?P<mm>[0-5]\d)\b)"
+    r"|(?P<ampm>(?:a\s+las?\s+)?\b(?P<h12>1[0-2]|[1-9])"
+    r"(?:[:.](?P<m12>[0-5]\d))?\s*(?P<periodo>am|pm)\b)"
+    r"|(?P<a_las>\ba\s+las?\s+(?P<hsimple>\d{1,2})\b)"
+    rf"|(?P<mes>\b(?:{_MESES_PATRON})\b)"
+    r"|(?P<relativo>pasado manana|manana|hoy)"
+    r"|(?P<dia_semana>"
+    + "|".join(DIAS_SEMANA_MAP)
+    + r")"
+    r"))"
+)
+
+FICHAS_UNICAS = ("dia_mes", "hhmm", "ampm", "a_las")
+
+
+def tokenizar_fecha_hora(texto_n):
+    """
+    Recorre el texto normalizado una vez y agrupa lo encontrado:
+    la primera coincidencia de cada patrón único y el conjunto de
+    meses, expresiones relativas y días de la semana.
+    """
+
+    fichas = {
+        "meses": set(),
+        "relativos": set(),
+        "dias_semana": set(),
+    }
+
+    for match in REGEX_FECHA_HORA.finditer(texto_n):
+
+        for tipo in FICHAS_UNICAS:
+
+            if match.group(tipo) is not None:
+
+                fichas.setdefault(tipo, match)
+                break
+
+        else:
+
+            if match.group("mes") is not None:
+                fichas["meses"].add(match.group("mes"))
+
+            elif match.group("relativo") is not None:
+                fichas["relativos"].add(match.group("relativo"))
+
+            elif match.group("dia_semana") is not None:
+                fichas["dias_semana"].add(match.group("dia_semana"))
+
+    return fichas
+
+
+def resolver_hora(fichas):
+
+    match = fichas.get("hhmm")
+
+    if match:
+        return int(match.group("hh")), int(match.group("mm"))
+
+    match = fichas.get("ampm")
+
+    if match:
+
+        hora = int(match.group("h12"))
+        minuto = int(match.group("m12") or 0)
+        periodo = match.group("periodo")
+
+        if periodo == "pm" and hora < 12:
+            hora += 12
+
+        if periodo == "am" and hora == 12:
+            hora = 0
+
+        return hora, minuto
+
+    match = fichas.get("a_las")
+
+    if match:
+
+        hora = int(match.group("hsimple"))
+
+        # Dentro del horario del negocio, 1..6 normalmente
+        # significa 13:00..18:00.
+        if 1 <= hora <= 6:
+            hora += 12
+
+        # "a las 30" no es una hora.
+        if hora > 23:
+            return None
+
+        return hora, 0
+
+    return None
+
+
+def localizar_dia(zona, dia, hora, minuto=0):
+    """
+    Fecha aware para el día y la hora locales dados. Se arma con
+    localize() y no sumando días a una fecha aware, que conservaría
+    el offset anterior a un cambio de horario.
+    """
+
+    return zona.normalize(
+        zona.localize(
+            datetime.combine(
+                dia,
+                dt_time(hora, minuto)
+            )
+        )
+    )
+
+
+def resolver_fecha(fichas, ahora, zona, hora_data=None):
+
+    def en_dias(dias):
+
+        return localizar_dia(
+            zona,
+            ahora.date() + timedelta(days=dias),
+            ahora.hour,
+            ahora.minute
+        )
+
+    match = fichas.get("dia_mes")
+
+    if match:
+
+        dia = int(match.group("dia"))
+        mes = MESES_MAP[match.group("mes_dia")]
+        anio = ahora.year
+
+        try:
+            candidato = zona.localize(
+                datetime(anio, mes, dia, 0, 0, 0)
+            )
+        except ValueError:
+            return None
+
+        if candidato.date() < ahora.date():
+
+            try:
+                candidato = zona.localize(
+                    datetime(anio + 1, mes, dia, 0, 0, 0)
+                )
+            except ValueError:
+                return None
+
+        return candidato
+
+    relativos = fichas["relativos"]
+
+    if "pasado manana" in relativos:
+        return en_dias(2)
+
+    if "manana" in relativos:
+        return en_dias(1)
+
+    if "hoy" in relativos:
+        return en_dias(0)
+
+    for nombre_dia, weekday in DIAS_SEMANA_MAP.items():
+
+        if nombre_dia not in fichas["dias_semana"]:
+            continue
+
+        diferencia = (
+            weekday
+            - ahora.weekday()
+        ) % 7
+
+        if diferencia == 0 and hora_data:
+
+            hora, minuto = hora_data
+
+            candidato_hoy = localizar_dia(
+                zona,
+                ahora.date(),
+                hora,
+                minuto
+            )
+
+            if candidato_hoy <= ahora:
+                diferencia = 7
+
+        return en_dias(diferencia)
+
+    if hora_data:
+
+        hora, minuto = hora_data
+
+        for offset in range(8):
+
+            candidato_fecha = localizar_dia(
+                zona,
+                ahora.date() + timedelta(days=offset),
+                hora,
+                minuto
+            )
+
+            if not es_dia_atencion(candidato_fecha):
+                continue
+
+            if candidato_fecha <= ahora:
+                continue
+
+            return candidato_fecha
+
+    return None
+
+
+def resolver_mes(fichas, ahora, zona):
+
+    if "dia_mes" in fichas:
+        return None
+
+    for nombre_mes, numero_mes in MESES_MAP.items():
+
+        if nombre_mes not in fichas["meses"]:
+            continue
+
+        anio = ahora.year
+
+        if numero_mes < ahora.month:
+            anio += 1
+
+        return zona.localize(
+            datetime(anio, numero_mes, 1, 0, 0, 0)
+        )
+
+    return None
+
+
+def interpretar_fecha_hora(texto, ahora=None, texto_n=None):
+    """
+    Interpreta en una pasada las expresiones de fecha y hora de un
+    mensaje ("el 2 de septiembre a las 3", "pasado mañana 15:30",
+    "viernes 4 pm"). ahora permite fijar el instante de referencia y
+    texto_n pasar el texto ya normalizado.
+
+    Devuelve un dict con:
+    - hora:       (hora, minuto) o None
+    - fecha:      día pedido, sin considerar la hora
+    - fecha_hora: fecha y hora combinadas, o None si falta la hora
+    - mes:        primer día del mes pedido sin día explícito
+    """
+
+    zona = obtener_zona()
+
+    if ahora is None:
+        ahora = datetime.now(zona)
+
+    if texto_n is None:
+        texto_n = normalizar_texto(texto)
+
+    fichas = tokenizar_fecha_hora(texto_n)
+
+    hora = resolver_hora(fichas)
+
+    fecha_hora = None
+
+    if hora:
+
+        fecha_con_hora = resolver_fecha(
+            fichas,
+            ahora,
+            zona,
+            hora
+        )
+
+        if fecha_con_hora:
+
+            fecha_hora = localizar_dia(
+                zona,
+                fecha_con_hora.date(),
+                hora[0],
+                hora[1]
+            )
+
+    return {
+        "hora": hora,
+        "fecha": resolver_fecha(fichas, ahora, zona),
+        "fecha_hora": fecha_hora,
+        "mes": resolver_mes(fichas, ahora, zona),
+    }
+
+
+def detectar_hora_solicitada(texto):
+    """
+    Interpreta expresiones como:
+    - a las 3
+    - a las 3:30
+    - 15:00
+    - 3 pm
+
+    Como el negocio atiende entre 10:00 y 18:00,
+    una hora simple como "3" se interpreta como 15:00.
+    """
+
+    return resolver_hora(
+        tokenizar_fecha_hora(
+            normalizar_texto(texto)
+        )
+    )
+
+
+def detectar_fecha_solicitada(texto, hora_data=None):
+    """
+    Detecta hoy, mañana, pasado mañana, días de la semana y fechas exactas
+    como "2 de septiembre" o "15 enero".
+    """
+
+    zona = obtener_zona()
+
+    return resolver_fecha(
+        tokenizar_fecha_hora(
+            normalizar_texto(texto)
+        ),
+        datetime.now(zona),
+        zona,
+        hora_data
+    )
+
+
+def construir_fecha_hora_solicitada(texto):
+    """
+    Devuelve un datetime timezone-aware si el mensaje contiene
+    una hora interpretable.
+    """
+
+    return interpretar_fecha_hora(texto)["fecha_hora"]
+
+
+# ============================================================
+# CACHE DE HORAS OCUPADAS
+# ============================================================
+
+# Intervalos ocupados de CALENDAR_ID en memoria del proceso.
+# Se llenan con UNA consulta amplia a events().list y sirven a
+# buscar_proximas_15_horas, buscar_horas_disponibles_dia y
+# verificar_disponibilidad. Se invalidan al crear un evento.
+
+BUSY_CACHE_TTL_SECONDS = int(
+    os.getenv(
+        "BUSY_CACHE_TTL_SECONDS",
+        "60"
+    )
+)
+
+BUSY_CACHE_DIAS = int(
+    os.getenv(
+        "BUSY_CACHE_DIAS",
+        "45"
+    )
+)
+
+BUSY_CACHE = {
+    "desde": None,
+    "hasta": None,
+    "indice": None,
+    "cargado_en": 0.0,
+}
+
+BUSY_CACHE_LOCK = threading.Lock()
+
+
+def convertir_evento_a_intervalo(evento, zona):
+    """
+    Convierte un evento de Google Calendar en una tupla
+    (inicio, fin) en la zona del negocio.
+
+    Los eventos de día completo bloquean desde las 00:00 del
+    primer día hasta las 00:00 del día siguiente al último.
+    Devuelve None si el evento no se puede interpretar.
+    """
+
+    start_data = evento.get(
+        "start",
+        {}
+    )
+
+    end_data = evento.get(
+        "end",
+        {}
+    )
+
+    start_str = start_data.get(
+        "dateTime"
+    )
+
+    end_str = end_data.get(
+        "dateTime"
+    )
+
+    try:
+
+        # Evento con hora específica.
+        if start_str and end_str:
+
+            inicio_evento = (
+                datetime
+                .fromisoformat(
+                    start_str.replace(
+                        "Z",
+                        "+00:00"
+                    )
+                )
+                .astimezone(zona)
+            )
+
+            fin_evento = (
+                datetime
+                .fromisoformat(
+                    end_str.replace(
+                        "Z",
+                        "+00:00"
+                    )
+                )
+                .astimezone(zona)
+            )
+
+            return inicio_evento, fin_evento
+
+        # Evento de día completo.
+        if (
+            start_data.get("date")
+            and end_data.get("date")
+        ):
+
+            inicio_evento = zona.localize(
+                datetime.combine(
+                    datetime.fromisoformat(
+                        start_data["date"]
+                    ).date(),
+                    datetime.min.time()
+                )
+            )
+
+            fin_evento = zona.localize(
+                datetime.combine(
+                    datetime.fromisoformat(
+                        end_data["date"]
+                    ).date(),
+                    datetime.min.time()
+                )
+            )
+
+            return inicio_evento, fin_evento
+
+    except Exception:
+
+        return None
+
+    return None
+
+
+def consultar_eventos_calendar(inicio, fin):
+    """
+    Lista todos los eventos de CALENDAR_ID entre inicio y fin,
+    recorriendo todas las páginas de resultados.
+    """
+
+    service = obtener_calendar_service()
+
+    eventos = []
+
+    page_token = None
+
+    while True:
+
+        eventos_resultado = (
+            service
+            .events()
+            .list(
+                calendarId=CALENDAR_ID,
+                timeMin=inicio.isoformat(),
+                timeMax=fin.isoformat(),
+                singleEvents=True,
+                orderBy="startTime",
+                maxResults=500,
+                pageToken=page_token,
+            )
+            .execute()
+        )
+
+        eventos.extend(
+            eventos_resultado.get(
+                "items",
+                []
+            )
+        )
+
+        page_token = eventos_resultado.get(
+            "nextPageToken"
+        )
+
+        if not page_token:
+            return eventos
+
+
+def invalidar_cache_ocupados():
+
+    with BUSY_CACHE_LOCK:
+
+        BUSY_CACHE["desde"] = None
+        BUSY_CACHE["hasta"] = None
+        BUSY_CACHE["indice"] = None
+        BUSY_CACHE["cargado_en"] = 0.0
+
+
+def obtener_indice_ocupados(inicio, fin):
+    """
+    Devuelve el índice de horas ocupadas (ver
+    construir_indice_ocupados) válido al menos para [inicio, fin).
+    Primero usa el espejo sincronizado de Google Calendar; si no
+    está disponible, lo sirve desde el cache por ventana mientras
+    esté vigente y cubra el rango pedido.
+
+    Si hay que ir a Google Calendar se carga una ventana amplia
+    (al menos BUSY_CACHE_DIAS días) para que las siguientes
+    consultas del mismo turno no vuelvan a la API.
+
+    Devuelve None si Google Calendar falla, para distinguir un
+    error técnico de "sin eventos".
+    """
+
+    zona = obtener_zona()
+
+    inicio = inicio.astimezone(zona)
+    fin = fin.astimezone(zona)
+
+    revisar_invalidacion_compartida()
+
+    asegurar_sincronizador_calendar()
+
+    indice = indice_desde_espejo(
+        inicio,
+        fin
+    )
+
+    if indice is not None:
+        return indice
+
+    # El lock también evita que varias peticiones simultáneas
+    # recarguen la misma ventana en paralelo.
+    with BUSY_CACHE_LOCK:
+
+        vigente = (
+            BUSY_CACHE["desde"] is not None
+            and time.monotonic() - BUSY_CACHE["cargado_en"]
+            < BUSY_CACHE_TTL_SECONDS
+            and BUSY_CACHE["desde"] <= inicio
+            and fin <= BUSY_CACHE["hasta"]
+        )
+
+        if not vigente:
+
+            hoy = ahora_local().replace(
+                hour=0,
+                minute=0,
+                second=0,
+                microsecond=0
+            )
+
+            horizonte = hoy + timedelta(
+                days=BUSY_CACHE_DIAS
+            )
+
+            # Consultas muy lejanas (por ejemplo un mes del
+            # próximo año) no arrastran todos los meses intermedios.
+            if inicio > horizonte:
+                desde_ventana = inicio
+            else:
+                desde_ventana = min(inicio, hoy)
+
+            hasta_ventana = max(
+                fin,
+                desde_ventana + timedelta(
+                    days=BUSY_CACHE_DIAS
+                )
+            )
+
+            try:
+
+                eventos = consultar_eventos_calendar(
+                    desde_ventana,
+                    hasta_ventana
+                )
+
+            except Exception as e:
+
+                print(
+                    "ERROR CONSULTANDO CALENDAR PARA DISPONIBILIDAD:",
+                    repr(e)
+                )
+
+                import traceback
+                print(traceback.format_exc())
+
+                return None
+
+            ocupados = []
+
+            for evento in eventos:
+
+                intervalo = convertir_evento_a_intervalo(
+                    evento,
+                    zona
+                )
+
+                if intervalo:
+                    ocupados.append(intervalo)
+
+            BUSY_CACHE["desde"] = desde_ventana
+            BUSY_CACHE["hasta"] = hasta_ventana
+            BUSY_CACHE["indice"] = construir_indice_ocupados(
+                ocupados
+            )
+            BUSY_CACHE["cargado_en"] = time.monotonic()
+
+            print(
+                "CALENDAR OK - CACHE OCUPADOS RECARGADO:",
+                len(ocupados),
+                "DESDE:",
+                desde_ventana.isoformat(),
+                "HASTA:",
+                hasta_ventana.isoformat(),
+            )
+
+        return BUSY_CACHE["indice"]
+
+
+# ============================================================
+# ESPEJO DE GOOGLE CALENDAR (SYNC INCREMENTAL)
+# ============================================================
+
+# Copia local de los eventos de CALENDAR_ID. Se carga con un
+# listado completo y luego un hilo en segundo plano la mantiene al
+# día pidiendo solo los cambios con syncToken. Mientras el espejo
+# esté al día, obtener_indice_ocupados() responde sin tocar la API.
+
+CALENDAR_SYNC_ENABLED = (
+    os.getenv(
+        "CALENDAR_SYNC_ENABLED",
+        "1"
+    )
+    == "1"
+)
+
+CALENDAR_SYNC_INTERVAL_SECONDS = int(
+    os.getenv(
+        "CALENDAR_SYNC_INTERVAL_SECONDS",
+        "30"
+    )
+)
+
+# Días cubiertos por el listado completo, contados desde hoy.
+CALENDAR_SYNC_DIAS = int(
+    os.getenv(
+        "CALENDAR_SYNC_DIAS",
+        "120"
+    )
+)
+
+# Si la última sincronización es más antigua que esto, el espejo
+# no se usa y se vuelve al cache por ventana.
+CALENDAR_SYNC_MAX_ATRASO_SECONDS = int(
+    os.getenv(
+        "CALENDAR_SYNC_MAX_ATRASO_SECONDS",
+        str(CALENDAR_SYNC_INTERVAL_SECONDS * 3)
+    )
+)
+
+CALENDAR_MIRROR = {
+    "eventos": {},
+    "indice": None,
+    "sync_token": None,
+    "desde": None,
+    "hasta": None,
+    "sincronizado_en": 0.0,
+}
+
+CALENDAR_MIRROR_LOCK = threading.Lock()
+
+# Solo una sincronización a la vez por proceso.
+CALENDAR_SYNC_LOCK = threading.Lock()
+
+CALENDAR_SYNC_THREAD = None
+
+CALENDAR_SYNC_EVENT = threading.Event()
+
+
+def aplicar_cambio_espejo(eventos, evento, zona):
+    """
+    Aplica un evento recibido de Google Calendar sobre el
+    diccionario de eventos del espejo.
+    """
+
+    evento_id = evento.get("id")
+
+    if not evento_id:
+        return
+
+    if evento.get("status") == "cancelled":
+        eventos.pop(evento_id, None)
+        return
+
+    intervalo = convertir_evento_a_intervalo(
+        evento,
+        zona
+    )
+
+    if intervalo:
+        eventos[evento_id] = intervalo
+    else:
+        eventos.pop(evento_id, None)
+
+
+def listar_eventos_sync(**parametros):
+    """
+    Recorre todas las páginas de events().list y devuelve
+    (eventos, next_sync_token).
+    """
+
+    service = obtener_calendar_service()
+
+    eventos = []
+
+    page_token = None
+
+    while True:
+
+        resultado = (
+            service
+            .events()
+            .list(
+                calendarId=CALENDAR_ID,
+                singleEvents=True,
+                maxResults=2500,
+                pageToken=page_token,
+                **parametros
+            )
+            .execute()
+        )
+
+        eventos.extend(
+            resultado.get(
+                "items",
+                []
+            )
+        )
+
+        page_token = resultado.get(
+            "nextPageToken"
+        )
+
+        if not page_token:
+            return (
+                eventos,
+                resultado.get("nextSyncToken")
+            )
+
+
+def sincronizacion_completa_calendar():
+
+    zona = obtener_zona()
+
+    desde = ahora_local().replace(
+        hour=0,
+        minute=0,
+        second=0,
+        microsecond=0
+    )
+
+    hasta = desde + timedelta(
+        days=CALENDAR_SYNC_DIAS
+    )
+
+    eventos, sync_token = listar_eventos_sync(
+        timeMin=desde.isoformat(),
+        timeMax=hasta.isoformat(),
+    )
+
+    nuevos = {}
+
+    for evento in eventos:
+        aplicar_cambio_espejo(
+            nuevos,
+            evento,
+            zona
+        )
+
+    with CALENDAR_MIRROR_LOCK:
+
+        CALENDAR_MIRROR["eventos"] = nuevos
+        CALENDAR_MIRROR["indice"] = None
+        CALENDAR_MIRROR["sync_token"] = sync_token
+        CALENDAR_MIRROR["desde"] = desde
+        CALENDAR_MIRROR["hasta"] = hasta
+        CALENDAR_MIRROR["sincronizado_en"] = time.monotonic()
+
+    print(
+        "CALENDAR SYNC COMPLETO:",
+        len(nuevos),
+        "EVENTOS HASTA",
+        hasta.isoformat()
+    )
+
+
+def sincronizacion_incremental_calendar(sync_token):
+    """
+    Pide solo los eventos creados, modificados o eliminados desde
+    el último syncToken. Devuelve False si Google invalidó el
+    token (HTTP 410) y hay que hacer un listado completo.
+    """
+
+    try:
+
+        eventos, nuevo_token = listar_eventos_sync(
+            syncToken=sync_token
+        )
+
+    except HttpError as e:
+
+        if e.resp.status == 410:
+
+            print(
+                "CALENDAR SYNC TOKEN EXPIRADO: "
+                "se hará una sincronización completa."
+            )
+
+            return False
+
+        raise
+
+    zona = obtener_zona()
+
+    with CALENDAR_MIRROR_LOCK:
+
+        for evento in eventos:
+            aplicar_cambio_espejo(
+                CALENDAR_MIRROR["eventos"],
+                evento,
+                zona
+            )
+
+        if eventos:
+            CALENDAR_MIRROR["indice"] = None
+
+        CALENDAR_MIRROR["sync_token"] = nuevo_token
+        CALENDAR_MIRROR["sincronizado_en"] = time.monotonic()
+
+    if eventos:
+
+        print(
+            "CALENDAR SYNC INCREMENTAL:",
+            len(eventos),
+            "CAMBIOS"
+        )
+
+    return True
+
+
+def sincronizar_calendar():
+
+    with CALENDAR_SYNC_LOCK:
+
+        with CALENDAR_MIRROR_LOCK:
+
+            sync_token = CALENDAR_MIRROR["sync_token"]
+            desde = CALENDAR_MIRROR["desde"]
+
+        hoy = ahora_local().replace(
+            hour=0,
+            minute=0,
+            second=0,
+            microsecond=0
+        )
+
+        # Una vez al día se rehace el listado completo para que el
+        # horizonte siga cubriendo CALENDAR_SYNC_DIAS desde hoy.
+        if (
+            sync_token
+            and desde is not None
+            and desde.date() == hoy.date()
+            and sincronizacion_incremental_calendar(sync_token)
+        ):
+            return
+
+        sincronizacion_completa_calendar()
+
+
+def bucle_sincronizacion_calendar():
+
+    while True:
+
+        try:
+            sincronizar_calendar()
+
+        except Exception as e:
+
+            print(
+                "ERROR SINCRONIZANDO CALENDAR:",
+                repr(e)
+            )
+
+        try:
+            renovar_canal_calendar_si_corresponde()
+
+        except Exception as e:
+
+            print(
+                "ERROR RENOVANDO CANAL CALENDAR:",
+                repr(e)
+            )
+
+        # Una notificación push despierta al hilo antes de tiempo.
+        CALENDAR_SYNC_EVENT.wait(
+            CALENDAR_SYNC_INTERVAL_SECONDS
+        )
+
+        CALENDAR_SYNC_EVENT.clear()
+
+
+def asegurar_sincronizador_calendar():
+    """
+    Arranca el hilo de sincronización la primera vez que se
+    necesita disponibilidad. Cada worker de gunicorn mantiene su
+    propio espejo.
+    """
+
+    global CALENDAR_SYNC_THREAD
+
+    if (
+        not CALENDAR_SYNC_ENABLED
+        or not GOOGLE_REFRESH_TOKEN
+    ):
+        return
+
+    if CALENDAR_SYNC_THREAD is not None:
+        return
+
+    with CALENDAR_SYNC_LOCK:
+
+        if CALENDAR_SYNC_THREAD is not None:
+            return
+
+        CALENDAR_SYNC_THREAD = threading.Thread(
+            target=bucle_sincronizacion_calendar,
+            name="calendar-sync",
+            daemon=True,
+        )
+
+        CALENDAR_SYNC_THREAD.start()
+
+
+def registrar_evento_en_espejo(evento):
+    """
+    Refleja de inmediato un evento recién creado, sin esperar a la
+    próxima sincronización incremental.
+    """
+
+    with CALENDAR_MIRROR_LOCK:
+
+        if CALENDAR_MIRROR["sync_token"] is None:
+            return
+
+        aplicar_cambio_espejo(
+            CALENDAR_MIRROR["eventos"],
+            evento,
+            obtener_zona()
+        )
+
+        CALENDAR_MIRROR["indice"] = None
+
+
+def solicitar_sincronizacion_calendar():
+    """
+    Marca el espejo como desactualizado y despierta al hilo de
+    sincronización. Hasta que termine, obtener_indice_ocupados() vuelve a
+    consultar la API en vez de usar datos viejos.
+    """
+
+    with CALENDAR_MIRROR_LOCK:
+        CALENDAR_MIRROR["sincronizado_en"] = 0.0
+
+    CALENDAR_SYNC_EVENT.set()
+
+
+def indice_desde_espejo(inicio, fin):
+    """
+    Devuelve el índice de horas ocupadas del espejo, o None si el
+    espejo no está al día o no cubre el rango. El índice se
+    reconstruye solo cuando el espejo cambió.
+    """
+
+    with CALENDAR_MIRROR_LOCK:
+
+        if CALENDAR_MIRROR["sync_token"] is None:
+            return None
+
+        if (
+            time.monotonic() - CALENDAR_MIRROR["sincronizado_en"]
+            > CALENDAR_SYNC_MAX_ATRASO_SECONDS
+        ):
+            return None
+
+        if not (
+            CALENDAR_MIRROR["desde"] <= inicio
+            and fin <= CALENDAR_MIRROR["hasta"]
+        ):
+            return None
+
+        if CALENDAR_MIRROR["indice"] is None:
+
+            CALENDAR_MIRROR["indice"] = construir_indice_ocupados(
+                CALENDAR_MIRROR["eventos"].values()
+            )
+
+        return CALENDAR_MIRROR["indice"]
+
+
+# ============================================================
+# NOTIFICACIONES PUSH DE GOOGLE CALENDAR
+# ============================================================
+
+# Si GOOGLE_CALENDAR_WEBHOOK_URL y GOOGLE_CALENDAR_WEBHOOK_TOKEN
+# están configuradas, se mantiene UN canal events.watch sobre
+# CALENDAR_ID para todos los workers. El canal vive en la tabla
+# calendar_canal: el worker que toma el turno de renovación lo
+# registra y los demás lo adoptan. Cada aviso sube la versión de
+# esa fila y cada worker, al verla cambiar, invalida su
+# disponibilidad en memoria. Sin base de datos no hay forma de
+# compartir el canal y las notificaciones quedan desactivadas.
+
+GOOGLE_CALENDAR_WEBHOOK_URL = os.getenv(
+    "GOOGLE_CALENDAR_WEBHOOK_URL"
+)
+
+GOOGLE_CALENDAR_WEBHOOK_TOKEN = os.getenv(
+    "GOOGLE_CALENDAR_WEBHOOK_TOKEN"
+)
+
+CALENDAR_CANAL_TTL_SECONDS = int(
+    os.getenv(
+        "CALENDAR_CANAL_TTL_SECONDS",
+        str(7 * 24 * 3600)
+    )
+)
+
+CALENDAR_CANAL_MARGEN_SECONDS = int(
+    os.getenv(
+        "CALENDAR_CANAL_MARGEN_SECONDS",
+        "3600"
+    )
+)
+
+# Cada cuánto, como máximo, un worker revisa si otro recibió un
+# aviso de cambios.
+CALENDAR_VERSION_INTERVALO_SECONDS = float(
+    os.getenv(
+        "CALENDAR_VERSION_INTERVALO_SECONDS",
+        "1"
+    )
+)
+
+CALENDAR_PUSH_ACTIVO = bool(GOOGLE_CALENDAR_WEBHOOK_URL)
+
+if CALENDAR_PUSH_ACTIVO and not GOOGLE_CALENDAR_WEBHOOK_TOKEN:
+
+    print(
+        "ADVERTENCIA: falta GOOGLE_CALENDAR_WEBHOOK_TOKEN, "
+        "notificaciones de Calendar desactivadas."
+    )
+
+    CALENDAR_PUSH_ACTIVO = False
+
+if CALENDAR_PUSH_ACTIVO and not DB_DIALECTO:
+
+    print(
+        "ADVERTENCIA: las notificaciones de Calendar requieren "
+        "DATABASE_URL para compartir el canal entre workers; "
+        "quedan desactivadas."
+    )
+
+    CALENDAR_PUSH_ACTIVO = False
+
+# Segundos que un worker se reserva para registrar el canal.
+CALENDAR_CANAL_TURNO_SECONDS = 120
+
+# Identifica a este proceso como dueño del canal que registró.
+CALENDAR_PROCESO_ID = uuid.uuid4().hex
+
+# Copia local del canal compartido.
+CALENDAR_CANAL = {
+    "id": None,
+    "resource_id": None,
+    "expira_en": 0.0,
+}
+
+CALENDAR_VERSION = {
+    "version": None,
+    "revisado_en": 0.0,
+}
+
+CALENDAR_VERSION_LOCK = threading.Lock()
+
+
+def actualizar_version_calendar(version):
+    """
+    Guarda la versión leída de calendar_canal y devuelve la anterior.
+    Con el lock, de varios hilos que leen la misma versión nueva solo
+    uno ve la anterior distinta y se encarga de invalidar.
+    """
+
+    with CALENDAR_VERSION_LOCK:
+
+        anterior = CALENDAR_VERSION["version"]
+
+        CALENDAR_VERSION["version"] = version
+
+    return anterior
+
+
+def ejecutar_canal_db(sql, parametros=(), leer=False):
+    """
+    Sentencia sobre calendar_canal con %s como marcador. Con
+    leer=True devuelve la primera fila; si no, las filas afectadas.
+    """
+
+    if DB_DIALECTO == "sqlite":
+        sql = sql.replace("%s", "?")
+
+    with db_connect() as conexion:
+
+        cursor = conexion.cursor()
+
+        try:
+
+            cursor.execute(sql, parametros)
+
+            if leer:
+                return cursor.fetchone()
+
+            return cursor.rowcount
+
+        finally:
+            cursor.close()
+
+
+def leer_canal_compartido():
+
+    fila = ejecutar_canal_db(
+        """
+        SELECT canal_id, resource_id, expira_en, version
+        FROM calendar_canal
+        WHERE id = 1
+        """,
+        leer=True
+    )
+
+    if not fila:
+        return None
+
+    return {
+        "id": fila[0],
+        "resource_id": fila[1],
+        "expira_en": float(fila[2] or 0),
+        "version": fila[3],
+    }
+
+
+def detener_canal_calendar(canal_id, resource_id):
+
+    if not (canal_id and resource_id):
+        return
+
+    try:
+
+        obtener_calendar_service().channels().stop(
+            body={
+                "id": canal_id,
+                "resourceId": resource_id,
+            }
+        ).execute()
+
+        print(
+            "CANAL CALENDAR DETENIDO:",
+            canal_id
+        )
+
+    except Exception as e:
+
+        print(
+            "ERROR DETENIENDO CANAL CALENDAR:",
+            repr(e)
+        )
+
+
+def registrar_canal_calendar(canal_anterior):
+
+    service = obtener_calendar_service()
+
+    body = {
+        "id": str(uuid.uuid4()),
+        "type": "web_hook",
+        "address": GOOGLE_CALENDAR_WEBHOOK_URL,
+        "token": GOOGLE_CALENDAR_WEBHOOK_TOKEN,
+        "params": {
+            "ttl": str(CALENDAR_CANAL_TTL_SECONDS),
+        },
+    }
+
+    try:
+
+        resultado = (
+            service
+            .events()
+            .watch(
+                calendarId=CALENDAR_ID,
+                body=body,
+            )
+            .execute()
+        )
+
+    except Exception:
+
+        # Libera el turno para que otro worker lo intente.
+        ejecutar_canal_db(
+            """
+            UPDATE calendar_canal SET renovando_hasta = 0
+            WHERE id = 1 AND duenio = %s
+            """,
+            (CALENDAR_PROCESO_ID,)
+        )
+
+        raise
+
+    # Google entrega la expiración en milisegundos.
+    expiracion_ms = resultado.get("expiration")
+
+    if expiracion_ms:
+        expira_en = int(expiracion_ms) / 1000
+    else:
+        expira_en = time.time() + CALENDAR_CANAL_TTL_SECONDS
+
+    CALENDAR_CANAL["id"] = resultado.get("id", body["id"])
+    CALENDAR_CANAL["resource_id"] = resultado.get("resourceId")
+    CALENDAR_CANAL["expira_en"] = expira_en
+
+    ejecutar_canal_db(
+        """
+        UPDATE calendar_canal SET
+            canal_id = %s,
+            resource_id = %s,
+            expira_en = %s,
+            renovando_hasta = 0
+        WHERE id = 1
+        """,
+        (
+            CALENDAR_CANAL["id"],
+            CALENDAR_CANAL["resource_id"],
+            expira_en,
+        )
+    )
+
+    print(
+        "CANAL CALENDAR REGISTRADO:",
+        CALENDAR_CANAL["id"],
+        "EXPIRA:",
+        datetime.fromtimestamp(expira_en).isoformat()
+    )
+
+    # El canal anterior se detiene después de abrir el nuevo para
+    # no perder avisos durante la renovación.
+    detener_canal_calendar(
+        canal_anterior["id"],
+        canal_anterior["resource_id"]
+    )
+
+
+def renovar_canal_calendar_si_corresponde():
+
+    if not CALENDAR_PUSH_ACTIVO:
+        return
+
+    canal = leer_canal_compartido()
+
+    if canal is None:
+        return
+
+    CALENDAR_CANAL["id"] = canal["id"]
+    CALENDAR_CANAL["resource_id"] = canal["resource_id"]
+    CALENDAR_CANAL["expira_en"] = canal["expira_en"]
+
+    if (
+        canal["id"]
+        and canal["expira_en"] - time.time()
+        > CALENDAR_CANAL_MARGEN_SECONDS
+    ):
+        return
+
+    # Solo el worker que toma el turno registra el canal nuevo.
+    ahora = time.time()
+
+    tomado = ejecutar_canal_db(
+        """
+        UPDATE calendar_canal SET
+            renovando_hasta = %s,
+            duenio = %s
+        WHERE id = 1 AND renovando_hasta < %s
+        """,
+        (
+            ahora + CALENDAR_CANAL_TURNO_SECONDS,
+            CALENDAR_PROCESO_ID,
+            ahora,
+        )
+    )
+
+    if tomado != 1:
+        return
+
+    registrar_canal_calendar(canal)
+
+
+def detener_canal_propio():
+    """
+    Al apagar el proceso, detiene el canal si lo registró él y lo
+    borra de la tabla para que otro worker registre uno nuevo.
+    """
+
+    if not CALENDAR_PUSH_ACTIVO:
+        return
+
+    try:
+
+        fila = ejecutar_canal_db(
+            """
+            SELECT canal_id, resource_id FROM calendar_canal
+            WHERE id = 1 AND duenio = %s
+            """,
+            (CALENDAR_PROCESO_ID,),
+            leer=True
+        )
+
+        if not fila or not fila[0]:
+            return
+
+        ejecutar_canal_db(
+            """
+            UPDATE calendar_canal SET
+                canal_id = NULL,
+                resource_id = NULL,
+                expira_en = 0,
+                duenio = NULL
+            WHERE id = 1 AND canal_id = %s
+            """,
+            (fila[0],)
+        )
+
+        detener_canal_calendar(fila[0], fila[1])
+
+    except Exception as e:
+
+        print(
+            "ERROR CERRANDO CANAL CALENDAR:",
+            repr(e)
+        )
+
+
+atexit.register(detener_canal_propio)
+
+
+def revisar_invalidacion_compartida():
+    """
+    Si otro worker recibió un aviso desde la última revisión,
+    invalida la disponibilidad en memoria de este worker.
+    """
+
+    if not CALENDAR_PUSH_ACTIVO:
+        return
+
+    ahora = time.monotonic()
+
+    with CALENDAR_VERSION_LOCK:
+
+        if (
+            ahora - CALENDAR_VERSION["revisado_en"]
+            < CALENDAR_VERSION_INTERVALO_SECONDS
+        ):
+            return
+
+        CALENDAR_VERSION["revisado_en"] = ahora
+
+    try:
+        canal = leer_canal_compartido()
+
+    except Exception as e:
+
+        print(
+            "ERROR LEYENDO CANAL CALENDAR:",
+            repr(e)
+        )
+
+        return
+
+    if canal is None:
+        return
+
+    anterior = actualizar_version_calendar(
+        canal["version"]
+    )
+
+    if (
+        anterior is not None
+        and canal["version"] != anterior
+    ):
+
+        invalidar_cache_ocupados()
+
+        solicitar_sincronizacion_calendar()
+
+
+@app.route(
+    "/google/calendar/notificaciones",
+    methods=["POST"]
+)
+def google_calendar_notificaciones():
+
+    if not CALENDAR_PUSH_ACTIVO:
+        return "", 404
+
+    token = request.headers.get(
+        "X-Goog-Channel-Token",
+        ""
+    )
+
+    estado_recurso = request.headers.get(
+        "X-Goog-Resource-State",
+        ""
+    )
+
+    canal_id = request.headers.get(
+        "X-Goog-Channel-ID",
+        ""
+    )
+
+    if not hmac.compare_digest(
+        token.encode("utf-8"),
+        GOOGLE_CALENDAR_WEBHOOK_TOKEN.encode("utf-8")
+    ):
+
+        print(
+            "NOTIFICACION CALENDAR RECHAZADA:",
+            canal_id
+        )
+
+        return "", 403
+
+    print(
+        "NOTIFICACION CALENDAR:",
+        estado_recurso,
+        canal_id,
+        request.headers.get(
+            "X-Goog-Message-Number",
+            ""
+        )
+    )
+
+    # "sync" es solo el aviso de que el canal quedó activo; llega
+    # antes de que el canal nuevo se guarde en la tabla.
+    if estado_recurso == "sync":
+        return "", 200
+
+    canal = leer_canal_compartido()
+
+    if not canal or canal_id != canal["id"]:
+
+        print(
+            "NOTIFICACION CALENDAR DE CANAL DESCONOCIDO:",
+            canal_id
+        )
+
+        return "", 404
+
+    ejecutar_canal_db(
+        "UPDATE calendar_canal SET version = version + 1 WHERE id = 1"
+    )
+
+    canal = leer_canal_compartido()
+
+    # Si otro hilo ya vio esta versión, ya invalidó y pidió la
+    # sincronización.
+    if (
+        canal
+        and actualizar_version_calendar(canal["version"])
+        == canal["version"]
+    ):
+        return "", 200
+
+    invalidar_cache_ocupados()
+
+    solicitar_sincronizacion_calendar()
+
+    return "", 200
+
+
+# ============================================================
+# GOOGLE CALENDAR DISPONIBILIDAD
+# ============================================================
+
+def verificar_disponibilidad(
+    inicio,
+    duracion=60,
+    usar_cache=True
+):
+    """
+    Comprueba si la hora está libre.
+
+    Por defecto responde desde el cache de horas ocupadas.
+    Con usar_cache=False consulta freebusy directamente en
+    Google Calendar; así lo hace crear_reserva_segura justo
+    antes de insertar el evento.
+    """
+
+    try:
+
+        zona = obtener_zona()
+
+        inicio = inicio.astimezone(zona)
+
+        # Solo se aceptan horas de inicio del horario compilado
+        # (días de atención, feriados y horarios especiales).
+        inicios_dia, cierre = horario_del_dia(
+            inicio.date()
+        )
+
+        if inicio not in inicios_dia:
+            return False
+
+        fin = inicio + timedelta(
+            minutes=duracion
+        )
+
+        if fin > cierre:
+            return False
+
+        if usar_cache:
+
+            indice = obtener_indice_ocupados(
+                inicio,
+                fin
+            )
+
+            if indice is None:
+                return None
+
+            return not intervalo_ocupado(
+                indice,
+                inicio,
+                fin
+            )
+
+        service = obtener_calendar_service()
+
+        resultado = (
+            service
+            .freebusy()
+            .query(
+                body={
+                    "timeMin": inicio.isoformat(),
+                    "timeMax": fin.isoformat(),
+                    "items": [
+                        {
+                            "id": CALENDAR_ID
+                        }
+                    ],
+                }
+            )
+            .execute()
+        )
+
+        calendario = (
+            resultado
+            .get("calendars", {})
+            .get(CALENDAR_ID, {})
+        )
+
+        busy = calendario.get(
+            "busy",
+            []
+        )
+
+        return len(busy) == 0
+
+    except Exception as e:
+
+        print(
+            "ERROR FREEBUSY:",
+            repr(e)
+        )
+
+        return None
+
+
+# ============================================================
+# ÍNDICE DE HORAS OCUPADAS
+# ============================================================
+
+# Los intervalos ocupados se fusionan y ordenan una vez; después
+# cada hora candidata se revisa con bisect en O(log n) en vez de
+# recorrer todos los eventos.
+
+def construir_indice_ocupados(ocupados):
+    """
+    Devuelve {"inicios": [...], "fines": [...]} con los intervalos
+    ocupados fusionados, ordenados y expresados como timestamps.
+    """
+
+    ordenados = sorted(
+        (
+            inicio_ocupado.timestamp(),
+            fin_ocupado.timestamp()
+        )
+        for inicio_ocupado, fin_ocupado in ocupados
+        if fin_ocupado >= inicio_ocupado
+    )
+
+    inicios = []
+    fines = []
+
+    for inicio_ocupado, fin_ocupado in ordenados:
+
+        if fines and inicio_ocupado <= fines[-1]:
+
+            fines[-1] = max(
+                fines[-1],
+                fin_ocupado
+            )
+
+        else:
+
+            inicios.append(inicio_ocupado)
+            fines.append(fin_ocupado)
+
+    return {
+        "inicios": inicios,
+        "fines": fines,
+    }
+
+
+def intervalo_ocupado(indice, inicio, fin):
+    """
+    True si [inicio, fin) se cruza con algún intervalo ocupado.
+    """
+
+    # Primer intervalo que termina después del inicio pedido.
+    posicion = bisect.bisect_right(
+        indice["fines"],
+        inicio.timestamp()
+    )
+
+    return (
+        posicion < len(indice["inicios"])
+        and indice["inicios"][posicion] < fin.timestamp()
+    )
+
+
+def candidatos_dia(inicio_dia, ahora):
+    """
+    Horas de inicio del horario compilado para el día que todavía
+    no han pasado.
+    """
+
+    fecha = inicio_dia.astimezone(obtener_zona()).date()
+
+    for inicio in horario_del_dia(fecha)[0]:
+
+        if inicio > ahora:
+            yield inicio
+
+
+def candidatos_desde(desde, ahora, dias=32):
+    """
+    Horas de inicio del horario compilado a partir de "desde" y
+    durante los días indicados, en orden.
+    """
+
+    for inicio in candidatos_en_rango(desde, dias)[0]:
+
+        if inicio <= ahora or inicio < desde:
+            continue
+
+        yield inicio
+
+
+# Motor para búsquedas de varios días: "numpy" (vectorizado) o
+# "python" (candidato por candidato). Ambos devuelven lo mismo.
+MOTOR_DISPONIBILIDAD = os.getenv(
+    "MOTOR_DISPONIBILIDAD",
+    "numpy"
+)
+
+
+def indice_como_arrays(indice):
+    """
+    Versión NumPy del índice, calculada una sola vez por índice.
+    """
+
+    arrays = indice.get("arrays")
+
+    if arrays is None:
+
+        arrays = (
+            np.asarray(indice["inicios"], dtype=np.float64),
+            np.asarray(indice["fines"], dtype=np.float64),
+        )
+
+        indice["arrays"] = arrays
+
+    return arrays
+
+
+def buscar_horas_libres_numpy(indice, desde, ahora, dias=32, limite=15):
+    """
+    Equivalente vectorizado de
+    iterar_horas_libres(indice, candidatos_desde(desde, ahora, dias)).
+
+    Toma las horas de inicio del horario compilado como un array
+    int64 de segundos, descarta en bloque las pasadas y las
+    ocupadas con searchsorted y devuelve las primeras "limite".
+    """
+
+    candidatos, inicios = candidatos_en_rango(
+        desde,
+        dias
+    )
+
+    duracion = DURACION_RESERVA * 60
+
+    inicios_ocupados, fines_ocupados = indice_como_arrays(indice)
+
+    posicion = np.searchsorted(
+        fines_ocupados,
+        inicios,
+        side="right"
+    )
+
+    siguiente_inicio = np.append(
+        inicios_ocupados,
+        np.inf
+    )[posicion]
+
+    libres = np.flatnonzero(
+        (inicios > ahora.timestamp())
+        & (inicios >= desde.timestamp())
+        & (siguiente_inicio >= inicios + duracion)
+    )[:limite]
+
+    return [
+        candidatos[posicion_libre]
+        for posicion_libre in libres
+    ]
+
+
+def iterar_horas_libres(indice, candidatos):
+    """
+    Entrega, en orden, las horas candidatas que no se cruzan con
+    ningún intervalo ocupado.
+    """
+
+    duracion = timedelta(
+        minutes=DURACION_RESERVA
+    )
+
+    for inicio in candidatos:
+
+        if not intervalo_ocupado(
+            indice,
+            inicio,
+            inicio + duracion
+        ):
+            yield inicio
+
+
+# ============================================================
+# 15 PRÓXIMAS HORAS
+# ============================================================
+
+# Hilos para adelantar consultas de agenda que pueden no
+# necesitarse (ver adelantar_alternativas). Cada pedido ocupa a lo
+# sumo uno.
+AGENDA_WORKERS = int(
+    os.getenv("AGENDA_WORKERS", "4")
+)
+
+EJECUTOR_AGENDA = ThreadPoolExecutor(
+    max_workers=AGENDA_WORKERS,
+    thread_name_prefix="agenda",
+)
+
+def buscar_proximas_15_horas(desde=None):
+
+    """
+    Busca las próximas 15 horas disponibles usando el cache de
+    horas ocupadas, que hace como máximo UNA consulta a Google
+    Calendar para evitar timeouts de Twilio.
+
+    Si recibe "desde", comienza a buscar desde esa fecha/hora.
+    """
+
+    ahora = ahora_local()
+    zona = obtener_zona()
+
+    if desde is None:
+        desde = ahora
+    else:
+        desde = desde.astimezone(zona)
+
+    if desde < ahora:
+        desde = ahora
+
+    # Revisamos hasta 31 días hacia adelante.
+    inicio_rango = desde
+
+    fin_rango = (
+        desde
+        + timedelta(days=31)
+    ).replace(
+        hour=23,
+        minute=59,
+        second=59,
+        microsecond=0
+    )
+
+    indice = obtener_indice_ocupados(
+        inicio_rango,
+        fin_rango
+    )
+
+    # None permite distinguir un error técnico de "sin horas disponibles".
+    if indice is None:
+        return None
+
+    print(
+        "CALENDAR OK - BLOQUES OCUPADOS:",
+        len(indice["inicios"]),
+        "DESDE:",
+        inicio_rango.isoformat(),
+        "HASTA:",
+        fin_rango.isoformat(),
+    )
+
+    if MOTOR_DISPONIBILIDAD == "numpy":
+
+        resultados = buscar_horas_libres_numpy(
+            indice,
+            desde,
+            ahora
+        )
+
+    else:
+
+        resultados = []
+
+        for inicio in iterar_horas_libres(
+            indice,
+            candidatos_desde(
+                desde,
+                ahora
+            )
+        ):
+
+            resultados.append(
+                inicio
+            )
+
+            if len(resultados) >= 15:
+                break
+
+    if len(resultados) >= 15:
+
+        print(
+            "15 HORAS DISPONIBLES:",
+            [
+                h.isoformat()
+                for h in resultados
+            ]
+        )
+
+    return resultados
+
+
+def buscar_horas_disponibles_dia(fecha_obj):
+    """
+    Devuelve todas las horas enteras disponibles del día solicitado
+    dentro del horario 10:00 a 18:00, usando el cache de horas
+    ocupadas.
+    """
+
+    zona = obtener_zona()
+    ahora = ahora_local()
+
+    fecha_obj = fecha_obj.astimezone(zona)
+
+    inicio_dia = fecha_obj.replace(
+        hour=0,
+        minute=0,
+        second=0,
+        microsecond=0
+    )
+
+    fin_dia = (
+        inicio_dia
+        + timedelta(days=1)
+    )
+
+    if not es_dia_atencion(inicio_dia):
+        return []
+
+    # Un evento de día completo queda como un intervalo que cubre
+    # todo el día, así que bloquea todas las horas.
+    indice = obtener_indice_ocupados(
+        inicio_dia,
+        fin_dia
+    )
+
+    if indice is None:
+        return None
+
+    return list(
+        iterar_horas_libres(
+            indice,
+            candidatos_dia(
+                inicio_dia,
+                ahora
+            )
+        )
+    )
+
+
+def formatear_opciones_horas(horas):
+
+    return "\n".join(
+        f"{i}. {texto}"
+        for i, texto in enumerate(
+            formatear_fechas_cortas(horas),
+            start=1
+        )
+    )
+
+
+# ============================================================
+# DETECTAR INTENCIONES
+# ============================================================
+
+PATRONES_SERVICIOS = [
+    "servicios",
+    "servicio",
+    "precios",
+    "precio",
+    "cuanto cuesta",
+    "cuanto sale",
+    "valor",
+    "valores",
+    "tarifa",
+    "lista de precios",
+    "que hacen",
+]
+
+PATRONES_AGENDAR = [
+    "agendar",
+    "agenda",
+    "reservar",
+    "reserva",
+    "reservame",
+    "quiero una hora",
+    "quiero agendar",
+    "quiero reservar",
+    "sacar hora",
+    "sacar una hora",
+    "pedir hora",
+    "cita",
+    "turno",
+    "disponibilidad",
+    "horas disponibles",
+    "hora disponible",
+    "que horas tienes",
+    "que hora tienes",
+    "tienes hora",
+    "tienes horas",
+    "hay hora",
+    "hay horas",
+    "disponible manana",
+    "disponible hoy",
+    "quiero cortarme",
+    "quiero cortar",
+    "cortarme el pelo",
+    "cortarme el cabello",
+    "cortar el pelo",
+    "cortar el cabello",
+    "quiero un corte",
+    "quiero corte",
+    "necesito un corte",
+]
+
+PATRONES_NO_QUIERE = [
+    "no quiero",
+    "no gracias",
+    "gracias no",
+    "dejalo",
+    "olvidalo",
+    "cancelar",
+    "cancela",
+    "no por ahora",
+    "despues",
+    "no necesito",
+]
+
+PALABRAS_FECHA = [
+    "hoy",
+    "manana",
+    "pasado manana",
+    "lunes",
+    "martes",
+    "miercoles",
+    "jueves",
+    "viernes",
+    "sabado",
+    "domingo",
+] + list(MESES_MAP.keys())
+
+# Una expresión por intención: cada una recorre el texto una sola vez
+# en vez de probar frase por frase.
+REGEX_INTENCIONES = {
+    "servicios": compilar_alternativa(PATRONES_SERVICIOS),
+    "agendar": compilar_alternativa(PATRONES_AGENDAR),
+    "no_quiere": compilar_alternativa(PATRONES_NO_QUIERE),
+    "fecha_o_mes": compilar_alternativa(
+        PALABRAS_FECHA,
+        palabras_completas=True
+    ),
+}
+
+
+def detectar_intenciones(texto_n):
+    """
+    Devuelve las intenciones presentes en un texto ya normalizado.
+    """
+
+    return {
+        intencion
+        for intencion, regex in REGEX_INTENCIONES.items()
+        if regex.search(texto_n)
+    }
+
+
+def pregunta_servicios(texto):
+
+    texto_n = normalizar_texto(texto)
+
+    return bool(
+        REGEX_INTENCIONES["servicios"].search(texto_n)
+    )
+
+
+def es_intencion_agendar(texto):
+
+    texto_n = normalizar_texto(texto)
+
+    return bool(
+        REGEX_INTENCIONES["agendar"].search(texto_n)
+    )
+
+
+def es_saludo_o_menu(texto):
+
+    texto_n = normalizar_texto(texto)
+
+    return texto_n in {
+        "hola",
+        "holi",
+        "holaa",
+        "buenas",
+        "buenos dias",
+        "buenas tardes",
+        "buenas noches",
+        "menu",
+        "inicio",
+        "volver",
+    }
+
+
+def usuario_no_quiere(texto):
+
+    texto_n = normalizar_texto(texto)
+
+    return bool(
+        REGEX_INTENCIONES["no_quiere"].search(texto_n)
+    )
+
+
+# ============================================================
+# ANÁLISIS DEL MENSAJE
+# ============================================================
+
+ANALISIS_STATS = {
+    "mensajes": 0,
+    "total_ms": 0.0,
+    "max_ms": 0.0,
+}
+
+ANALISIS_LOCK = threading.Lock()
+
+
+def analizar_mensaje(texto):
+    """
+    Interpreta un mensaje una sola vez por turno. El flujo del
+    webhook, el chat web y procesar_agenda leen de este dict en vez
+    de volver a normalizar y detectar sobre el mismo texto.
+    """
+
+    inicio = time.perf_counter()
+
+    texto = (
+        texto or ""
+    ).strip()
+
+    texto_n = normalizar_texto(texto)
+
+    fecha_hora = interpretar_fecha_hora(
+        texto,
+        texto_n=texto_n
+    )
+
+    analisis = {
+        "texto": texto,
+        "texto_n": texto_n,
+        "comando_menu": es_comando_menu(texto, texto_n),
+        "intenciones": detectar_intenciones(texto_n),
+        "servicio": detectar_servicio(texto, texto_n),
+        "hora": fecha_hora["hora"],
+        "fecha": fecha_hora["fecha"],
+        "mes": fecha_hora["mes"],
+        "fecha_hora": fecha_hora["fecha_hora"],
+    }
+
+    duracion_ms = (
+        time.perf_counter() - inicio
+    ) * 1000
+
+    analisis["duracion_ms"] = duracion_ms
+
+    with ANALISIS_LOCK:
+
+        ANALISIS_STATS["mensajes"] += 1
+        ANALISIS_STATS["total_ms"] += duracion_ms
+        ANALISIS_STATS["max_ms"] = max(
+            ANALISIS_STATS["max_ms"],
+            duracion_ms
+        )
+
+    return analisis
+
+
+def estadisticas_analisis():
+
+    with ANALISIS_LOCK:
+
+        mensajes = ANALISIS_STATS["mensajes"]
+
+        return {
+            "mensajes": mensajes,
+            "promedio_ms": round(
+                ANALISIS_STATS["total_ms"] / mensajes,
+                3
+            ) if mensajes else 0.0,
+            "max_ms": round(ANALISIS_STATS["max_ms"], 3),
+        }
+
+
+# ============================================================
+# CACHÉ DE RESPUESTAS OPENAI
+# ============================================================
+
+# Saludos y preguntas frecuentes ("¿atienden los domingos?",
+# "¿dónde están?") llegan a OpenAI una y otra vez con la misma
+# respuesta. La clave es la pregunta normalizada más un hash del
+# prompt de sistema, así un cambio de precios u horario invalida
+# todo lo guardado, y del último mensaje del bot, porque "sí" o
+# "el segundo" significan algo distinto en cada conversación.
+OPENAI_CACHE_TTL_SECONDS = int(
+    os.getenv("OPENAI_CACHE_TTL_SECONDS", "3600")
+)
+OPENAI_CACHE_MAX = int(
+    os.getenv("OPENAI_CACHE_MAX", "1000")
+)
+
+# Solo se guardan preguntas cortas; las largas suelen depender de
+# la conversación y casi nunca se repiten. 0 desactiva la caché.
+OPENAI_CACHE_MAX_CHARS = int(
+    os.getenv("OPENAI_CACHE_MAX_CHARS", "120")
+)
+
+# Nivel opcional de casi duplicados: vectores de n-gramas de
+# caracteres calculados con NumPy y similitud coseno. Desactivado
+# por defecto porque "¿atienden el sábado?" y "¿atienden el
+# domingo?" se parecen mucho y tienen respuestas distintas.
+OPENAI_CACHE_SIMILITUD = os.getenv(
+    "OPENAI_CACHE_SIMILITUD",
+    "0"
+) == "1"
+OPENAI_CACHE_SIMILITUD_MIN = float(
+    os.getenv("OPENAI_CACHE_SIMILITUD_MIN", "0.92")
+)
+OPENAI_CACHE_NGRAMAS_DIM = 256
+
+REGEX_NO_ALFANUMERICO = re.compile(r"[^a-z0-9]+")
+
+
+def normalizar_pregunta_cache(pregunta):
+    """
+    "¡Hola!  ¿Atienden los DOMINGOS?" -> "hola atienden los domingos"
+    """
+
+    return REGEX_NO_ALFANUMERICO.sub(
+        " ",
+        normalizar_texto(pregunta)
+    ).strip()
+
+
+@lru_cache(maxsize=8)
+def hash_prompt(system_prompt):
+
+    return hashlib.sha1(
+        system_prompt.encode("utf-8")
+    ).hexdigest()[:16]
+
+
+def vector_ngramas(texto, dim=OPENAI_CACHE_NGRAMAS_DIM):
+    """
+    Trigramas de caracteres (con bordes de palabra) repartidos con
+    hash en un vector de "dim" posiciones y normalizado a largo 1.
+    """
+
+    texto = f" {texto} "
+
+    posiciones = [
+        hash(texto[i:i + 3]) % dim
+        for i in range(len(texto) - 2)
+    ]
+
+    vector = np.bincount(
+        posiciones,
+        minlength=dim
+    ).astype(np.float32)
+
+    norma = np.linalg.norm(vector)
+
+    if norma:
+        vector /= norma
+
+    return vector
+
+
+class CacheRespuestasOpenAI:
+    """
+    LRU con TTL de respuestas de OpenAI. Cada entrada recuerda los
+    tokens y la latencia de la llamada original, para informar lo
+    ahorrado con cada acierto.
+    """
+
+    def __init__(
+        self,
+        max_entradas,
+        ttl_segundos,
+        similitud=False,
+        similitud_min=0.92,
+        dim=OPENAI_CACHE_NGRAMAS_DIM
+    ):
+
+        self.max_entradas = max_entradas
+        self.ttl_segundos = ttl_segundos
+        self.similitud = similitud
+        self.similitud_min = similitud_min
+        self.dim = dim
+
+        # (hash_prompt, pregunta) -> entrada, de la menos a la más
+        # reciente.
+        self.entradas = OrderedDict()
+
+        # Nivel de casi duplicados: una fila por entrada y las filas
+        # libres se reutilizan al expulsar.
+        self.vectores = None
+        self.claves_fila = []
+        self.filas_libres = []
+
+        if similitud:
+
+            self.vectores = np.zeros(
+                (max_entradas, dim),
+                dtype=np.float32
+            )
+
+            self.claves_fila = [None] * max_entradas
+            self.filas_libres = list(range(max_entradas - 1, -1, -1))
+
+        self.lock = threading.Lock()
+
+        self.stats = {
+            "consultas": 0,
+            "aciertos_exactos": 0,
+            "aciertos_similares": 0,
+            "guardadas": 0,
+            "expulsadas": 0,
+            "expiradas": 0,
+            "tokens_ahorrados": 0,
+            "latencia_ahorrada_ms": 0.0,
+        }
+
+    def _quitar(self, clave):
+
+        entrada = self.entradas.pop(clave)
+
+        fila = entrada["fila"]
+
+        if fila is not None:
+
+            self.vectores[fila] = 0
+            self.claves_fila[fila] = None
+            self.filas_libres.append(fila)
+
+    def _purgar_expiradas(self, ahora):
+
+        while self.entradas:
+
+            clave, entrada = next(
+                iter(self.entradas.items())
+            )
+
+            if ahora - entrada["guardada"] <= self.ttl_segundos:
+                break
+
+            self._quitar(clave)
+            self.stats["expiradas"] += 1
+
+    def _buscar_similar(self, prompt, pregunta):
+
+        if not self.entradas:
+            return None
+
+        puntajes = self.vectores @ vector_ngramas(
+            pregunta,
+            self.dim
+        )
+
+        candidatas = np.flatnonzero(
+            puntajes >= self.similitud_min
+        )
+
+        # De la más parecida a la menos; las de otro prompt de
+        # sistema no cuentan.
+        for fila in candidatas[np.argsort(-puntajes[candidatas])]:
+
+            clave = self.claves_fila[fila]
+
+            if clave is not None and clave[0] == prompt:
+                return clave
+
+        return None
+
+    def obtener(self, prompt, pregunta):
+
+        ahora = time.monotonic()
+
+        with self.lock:
+
+            self.stats["consultas"] += 1
+
+            self._purgar_expiradas(ahora)
+
+            clave = (prompt, pregunta)
+
+            if clave in self.entradas:
+
+                self.stats["aciertos_exactos"] += 1
+
+            elif self.similitud:
+
+                clave = self._buscar_similar(prompt, pregunta)
+
+                if clave is None:
+                    return None
+
+                self.stats["aciertos_similares"] += 1
+
+            else:
+
+                return None
+
+            self.entradas.move_to_end(clave)
+
+            entrada = self.entradas[clave]
+
+            self.stats["tokens_ahorrados"] += entrada["tokens"]
+            self.stats["latencia_ahorrada_ms"] += entrada["latencia_ms"]
+
+            return entrada["respuesta"]
+
+    def guardar(
+        self,
+        prompt,
+        pregunta,
+        respuesta,
+        tokens=0,
+        latencia_ms=0.0
+    ):
+
+        if self.max_entradas <= 0:
+            return
+
+        ahora = time.monotonic()
+
+        with self.lock:
+
+            clave = (prompt, pregunta)
+
+            if clave in self.entradas:
+                self._quitar(clave)
+
+            self._purgar_expiradas(ahora)
+
+            while len(self.entradas) >= self.max_entradas:
+
+                self._quitar(next(iter(self.entradas)))
+                self.stats["expulsadas"] += 1
+
+            fila = None
+
+            if self.similitud:
+
+                fila = self.filas_libres.pop()
+
+                self.vectores[fila] = vector_ngramas(
+                    pregunta,
+                    self.dim
+                )
+
+                self.claves_fila[fila] = clave
+
+            self.entradas[clave] = {
+                "respuesta": respuesta,
+                "tokens": tokens,
+                "latencia_ms": latencia_ms,
+                "guardada": ahora,
+                "fila": fila,
+            }
+
+            self.stats["guardadas"] += 1
+
+    def metricas(self):
+
+        with self.lock:
+
+            consultas = self.stats["consultas"]
+
+            aciertos = (
+                self.stats["aciertos_exactos"]
+                + self.stats["aciertos_similares"]
+            )
+
+            return {
+                "entradas": len(self.entradas),
+                "max_entradas": self.max_entradas,
+                "similitud": self.similitud,
+                **self.stats,
+                "latencia_ahorrada_ms": round(
+                    self.stats["latencia_ahorrada_ms"],
+                    1
+                ),
+                "tasa_aciertos": round(
+                    aciertos / consultas,
+                    3
+                ) if consultas else 0.0,
+            }
+
+
+CACHE_OPENAI = CacheRespuestasOpenAI(
+    OPENAI_CACHE_MAX,
+    OPENAI_CACHE_TTL_SECONDS,
+    similitud=OPENAI_CACHE_SIMILITUD,
+    similitud_min=OPENAI_CACHE_SIMILITUD_MIN
+)
+
+
+def clave_cache_openai(mensajes, pregunta):
+    """
+    ("hash del prompt:hash del último mensaje del bot", pregunta
+    normalizada), o None si la pregunta no se guarda en caché.
+    """
+
+    if not (
+        0 < len(pregunta) <= OPENAI_CACHE_MAX_CHARS
+    ):
+        return None
+
+    pregunta_n = normalizar_pregunta_cache(pregunta)
+
+    if not pregunta_n:
+        return None
+
+    ultimo_bot = next(
+        (
+            m["content"]
+            for m in reversed(mensajes)
+            if m["role"] == "assistant"
+        ),
+        ""
+    )
+
+    contexto = hashlib.sha1(
+        ultimo_bot.encode("utf-8")
+    ).hexdigest()[:16]
+
+    return (
+        f"{hash_prompt(mensajes[0]['content'])}:{contexto}",
+        pregunta_n
+    )
+
+
+# ============================================================
+# OPENAI - CONVERSACIÓN NATURAL
+# ============================================================
+
+RESPUESTA_SIN_OPENAI = (
+    "¡Hola! 😊 Qué gusto saludarte. "
+    "Si quieres, puedo mostrarte los servicios "
+    "o ayudarte a reservar una hora."
+)
+
+RESPUESTA_OPENAI_VACIA = (
+    "¿Te gustaría conocer los servicios "
+    "o reservar una hora? 😊"
+)
+
+RESPUESTA_OPENAI_ERROR = (
+    "Disculpa 🙏 Tuve un problema procesando "
+    "el mensaje. Intenta nuevamente."
+)
+
+
+# Presupuesto aproximado de tokens para el historial que acompaña
+# a cada pregunta (el prompt de sistema va aparte).
+OPENAI_HISTORIAL_TOKENS = int(
+    os.getenv("OPENAI_HISTORIAL_TOKENS", "800")
+)
+
+# Listas numeradas del bot (servicios, horas) con al menos estas
+# opciones se resumen en una línea al mandarlas como historial.
+OPENAI_LISTA_MIN_OPCIONES = 4
+
+REGEX_OPCION_LISTA = re.compile(r"\s*\d{1,2}\.\s")
+
+
+def construir_system_prompt():
+    """
+    Prompt de sistema armado desde SERVICIOS y el horario. Se
+    construye una sola vez al cargar el módulo.
+    """
+
+    grupos = {
+        "hombre": [],
+        "mujer": [],
+    }
+
+    for servicio in sorted(
+        SERVICIOS.values(),
+        key=lambda s: s["numero"]
+    ):
+
+        linea = (
+            f"{servicio['numero']}. {servicio['nombre']}"
+            f" — {servicio['precio_texto']}."
+        )
+
+        if servicio.get("detalle"):
+            linea += f" {servicio['detalle']}"
+
+        grupos[servicio["grupo"]].append(linea)
+
+    dias = sorted(DIAS_ATENCION)
+
+    ultima_hora = HORA_CIERRE - DURACION_RESERVA // 60
+
+    servicios_hombre = "\n".join(grupos["hombre"])
+    servicios_mujer = "\n".join(grupos["mujer"])
+
+    return f"""
+Eres el asistente virtual de {ESTILISTA_NOMBRE}.
+
+Responde en español de Chile, de forma breve, clara y amable.
+
+REGLAS ESTRICTAS:
+- No inventes servicios, precios, promociones, horarios ni disponibilidad.
+- No agregues recomendaciones largas ni información que el cliente no pidió.
+- No divagues ni cambies de tema.
+- Tu objetivo es llevar al cliente a una de dos opciones:
+  1) conocer servicios y precios;
+  2) agendar una hora.
+- Si la consulta no corresponde a estas opciones, responde brevemente y vuelve a ofrecerlas.
+- Nunca confirmes una hora por tu cuenta. La aplicación consulta la agenda real.
+- Nunca hables de APIs, programación, Twilio, bases de datos ni sistemas internos.
+
+SERVICIOS HOMBRE:
+{servicios_hombre}
+
+SERVICIOS MUJER:
+{servicios_mujer}
+
+HORARIO:
+{DIAS_ATENCION[dias[0]].capitalize()} a {DIAS_ATENCION[dias[-1]]}, de {HORA_APERTURA}:00 a {HORA_CIERRE}:00.
+La última hora de inicio es a las {ultima_hora}:00.
+"""
+
+
+SYSTEM_PROMPT = construir_system_prompt()
+
+
+def estimar_tokens(texto):
+    """
+    Aproximación de ~4 caracteres por token, suficiente para
+    repartir el presupuesto sin cargar un tokenizador.
+    """
+
+    return len(texto) // 4 + 1
+
+
+@lru_cache(maxsize=256)
+def compactar_mensaje_bot(texto):
+    """
+    Reemplaza las listas numeradas largas de un mensaje del bot
+    (servicios, horas disponibles) por una línea que dice cuántas
+    opciones se mostraron. El resto del mensaje queda igual.
+    """
+
+    lineas = texto.split("\n")
+
+    opciones = sum(
+        1
+        for linea in lineas
+        if REGEX_OPCION_LISTA.match(linea)
+    )
+
+    if opciones < OPENAI_LISTA_MIN_OPCIONES:
+        return texto
+
+    compactas = []
+
+    # Opciones de la lista en curso; las líneas en blanco y las de
+    # detalle con sangría no la cortan.
+    en_lista = 0
+
+    for linea in lineas:
+
+        if REGEX_OPCION_LISTA.match(linea):
+            en_lista += 1
+            continue
+
+        if en_lista and (
+            not linea.strip()
+            or linea.startswith(" ")
+        ):
+            continue
+
+        if en_lista:
+            compactas.append(f"[Lista de {en_lista} opciones]")
+            compactas.append("")
+            en_lista = 0
+
+        compactas.append(linea)
+
+    if en_lista:
+        compactas.append(f"[Lista de {en_lista} opciones]")
+
+    return re.sub(
+        r"\n{3,}",
+        "\n\n",
+        "\n".join(compactas)
+    ).strip()
+
+
+def seleccionar_historial(historial, presupuesto):
+    """
+    Mensajes más recientes del historial que caben en "presupuesto"
+    tokens aproximados, en orden cronológico.
+    """
+
+    seleccionados = []
+    usados = 0
+
+    for item in reversed(historial):
+
+        rol = item.get("role")
+        contenido = item.get("content")
+
+        if rol not in ("user", "assistant") or not contenido:
+            continue
+
+        if rol == "assistant":
+            contenido = compactar_mensaje_bot(contenido)
+
+        # Unos pocos tokens extra por mensaje por el formato.
+        tokens = estimar_tokens(contenido) + 4
+
+        if usados + tokens > presupuesto:
+            break
+
+        seleccionados.append({
+            "role": rol,
+            "content": contenido
+        })
+
+        usados += tokens
+
+    seleccionados.reverse()
+
+    return seleccionados
+
+
+def construir_mensajes_openai(
+    historial,
+    pregunta
+):
+
+    mensajes = [
+        {
+            "role": "system",
+            "content": SYSTEM_PROMPT
+        }
+    ]
+
+    # La pregunta actual ya suele estar al final del historial.
+    if (
+        historial
+        and historial[-1].get("role") == "user"
+        and historial[-1].get("content") == pregunta
+    ):
+        historial = historial[:-1]
+
+    mensajes.extend(
+        seleccionar_historial(
+            historial,
+            OPENAI_HISTORIAL_TOKENS
+        )
+    )
+
+    mensajes.append({
+        "role": "user",
+        "content": pregunta
+    })
+
+    return mensajes
+
+
+def registrar_tokens_prompt(mensajes, usage=None):
+
+    print(
+        "OPENAI PROMPT:",
+        len(mensajes),
+        "mensajes, ~",
+        sum(
+            estimar_tokens(m["content"])
+            for m in mensajes
+        ),
+        "tokens estimados,",
+        getattr(usage, "prompt_tokens", None),
+        "tokens reales"
+    )
+
+
+def responder_openai(
+    historial,
+    pregunta
+):
+
+    if not client:
+        return RESPUESTA_SIN_OPENAI
+
+    mensajes = construir_mensajes_openai(
+        historial,
+        pregunta
+    )
+
+    clave_cache = clave_cache_openai(
+        mensajes,
+        pregunta
+    )
+
+    if clave_cache:
+
+        respuesta = CACHE_OPENAI.obtener(*clave_cache)
+
+        if respuesta:
+            return respuesta
+
+    try:
+
+        inicio = time.perf_counter()
+
+        response = crear_completion(
+            model=OPENAI_MODEL,
+            messages=mensajes,
+        )
+
+        registrar_tokens_prompt(
+            mensajes,
+            response.usage
+        )
+
+        respuesta = (
+            response
+            .choices[0]
+            .message
+            .content
+            or ""
+        ).strip()
+
+        if respuesta:
+
+            if clave_cache:
+
+                CACHE_OPENAI.guardar(
+                    *clave_cache,
+                    respuesta,
+                    tokens=getattr(
+                        response.usage,
+                        "total_tokens",
+                        0
+                    ) or 0,
+                    latencia_ms=(
+                        time.perf_counter() - inicio
+                    ) * 1000
+                )
+
+            return respuesta
+
+        return RESPUESTA_OPENAI_VACIA
+
+    except CircuitoAbierto:
+
+        return RESPUESTA_SIN_OPENAI
+
+    except Exception as e:
+
+        print(
+            "OPENAI ERROR:",
+            repr(e)
+        )
+
+        import traceback
+
+        print(
+            traceback.format_exc()
+        )
+
+        return RESPUESTA_OPENAI_ERROR
+
+
+def responder_openai_stream(
+    historial,
+    pregunta
+):
+    """
+    Igual que responder_openai, pero entrega el texto por trozos a
+    medida que OpenAI lo genera.
+    """
+
+    if not client:
+        yield RESPUESTA_SIN_OPENAI
+        return
+
+    mensajes = construir_mensajes_openai(
+        historial,
+        pregunta
+    )
+
+    clave_cache = clave_cache_openai(
+        mensajes,
+        pregunta
+    )
+
+    if clave_cache:
+
+        respuesta = CACHE_OPENAI.obtener(*clave_cache)
+
+        if respuesta:
+            yield respuesta
+            return
+
+    entregado = False
+
+    try:
+
+        inicio = time.perf_counter()
+
+        stream = crear_completion(
+            model=OPENAI_MODEL,
+            messages=mensajes,
+            stream=True,
+        )
+
+        trozos = []
+
+        for chunk in stream:
+
+            if not chunk.choices:
+                continue
+
+            trozo = chunk.choices[0].delta.content
+
+            if trozo:
+                entregado = True
+                trozos.append(trozo)
+                yield trozo
+
+        # Con stream=True el SDK no informa el uso de tokens; se
+        # estima con el mismo cálculo del presupuesto de historial.
+        registrar_tokens_prompt(mensajes)
+
+        respuesta = "".join(trozos).strip()
+
+        if not entregado:
+            yield RESPUESTA_OPENAI_VACIA
+
+        elif clave_cache:
+
+            CACHE_OPENAI.guardar(
+                *clave_cache,
+                respuesta,
+                tokens=sum(
+                    estimar_tokens(m["content"])
+                    for m in mensajes
+                ) + estimar_tokens(respuesta),
+                latencia_ms=(
+                    time.perf_counter() - inicio
+                ) * 1000
+            )
+
+    except CircuitoAbierto:
+
+        yield RESPUESTA_SIN_OPENAI
+
+    except Exception as e:
+
+        print(
+            "OPENAI STREAM ERROR:",
+            repr(e)
+        )
+
+        # Si ya se mostró parte de la respuesta, se deja así.
+        if not entregado:
+            yield RESPUESTA_OPENAI_ERROR
+
+
+# ============================================================
+# ESTADO DE RESERVA
+# ============================================================
+
+def resetear_reserva(estado):
+
+    telefono = (
+        estado
+        .get("datos_reserva", {})
+        .get("telefono")
+    )
+
+    estado["modo_agendar"] = False
+    estado["paso"] = "inicio"
+    estado["horas_ofrecidas"] = []
+
+    estado["datos_reserva"] = {
+        "servicio": None,
+        "fecha_hora": None,
+        "nombre": None,
+        "telefono": telefono,
+        "correo": None,
+        "fecha_preferida": None,
+        "mes_desde": None,
+    }
+
+
+# ============================================================
+# GOOGLE CALENDAR - ATENCIÓN PRESENCIAL
+# ============================================================
+
+def crear_evento_diego(
+    inicio,
+    servicio_codigo,
+    nombre_cliente,
+    telefono_cliente,
+    correo_cliente
+):
+
+    try:
+
+        service = obtener_calendar_service()
+
+        servicio = obtener_servicio(
+            servicio_codigo
+        )
+
+        fin = inicio + timedelta(
+            minutes=DURACION_RESERVA
+        )
+
+        evento = {
+
+            "summary":
+                f"{servicio['nombre']} - {nombre_cliente}",
+
+            "description":
+                (
+                    "Reserva creada por el "
+                    "Asistente Virtual de "
+                    f"Estilista {ESTILISTA_NOMBRE}.\n\n"
+                    f"Cliente: {nombre_cliente}\n"
+                    f"Teléfono: {telefono_cliente}\n"
+                    f"Correo: {correo_cliente}\n"
+                    f"Servicio: {servicio['nombre']}\n"
+                    f"Valor: {precio_texto_servicio(servicio)}\n"
+                    f"Duración: {DURACION_RESERVA} minutos\n"
+                    "Origen: Asistente Virtual"
+                ),
+
+            "start": {
+                "dateTime": inicio.isoformat(),
+                "timeZone": TIMEZONE,
+            },
+
+            "end": {
+                "dateTime": fin.isoformat(),
+                "timeZone": TIMEZONE,
+            },
+
+            "attendees": [
+                {
+                    "email": correo_cliente,
+                    "displayName": nombre_cliente,
+                }
+            ],
+
+            "extendedProperties": {
+
+                "private": {
+
+                    "cliente":
+                        nombre_cliente,
+
+                    "telefono":
+                        telefono_cliente,
+
+                    "correo":
+                        correo_cliente,
+
+                    "servicio":
+                        servicio["nombre"],
+
+                    "origen":
+                        (
+                            f"Asistente Virtual "
+                            f"{ESTILISTA_NOMBRE}"
+                        ),
+                }
+            },
+        }
+
+        resultado = (
+            service
+            .events()
+            .insert(
+                calendarId=CALENDAR_ID,
+                body=evento,
+                sendUpdates="all",
+            )
+            .execute()
+        )
+
+        # Atención presencial: no se crea Google Meet.
+        meet_url = None
+
+        # La agenda cambió: la próxima consulta recarga el cache.
+        invalidar_cache_ocupados()
+
+        registrar_evento_en_espejo(resultado)
+
+        print(
+            "EVENTO GOOGLE CREADO:",
+            resultado.get("id")
+        )
+
+        return {
+            "ok": True,
+            "evento_id":
+                resultado.get("id"),
+            "link":
+                resultado.get("htmlLink"),
+            "meet_url":
+                meet_url,
+        }
+
+    except Exception as e:
+
+        print(
+            "ERROR GOOGLE EVENT:",
+            repr(e)
+        )
+
+        return {
+            "ok": False,
+            "error": str(e)
+        }
+
+
+def adelantar_alternativas():
+    """
+    Empieza a buscar las próximas 15 horas en EJECUTOR_AGENDA
+    mientras el hilo del pedido comprueba la hora solicitada. Si
+    está ocupada, las alternativas quedan listas tras la consulta más
+    lenta y no tras la suma de ambas. Si está libre, se cancela el
+    future (o se ignora su resultado si ya empezó).
+
+    Con el cache de horas ocupadas vacío, BUSY_CACHE_LOCK hace que
+    las dos consultas compartan una sola carga de Google Calendar.
+    """
+
+    return EJECUTOR_AGENDA.submit(
+        buscar_proximas_15_horas
+    )
+
+
+# ============================================================
+# RESERVA SEGURA SIN POSTGRESQL
+# ============================================================
+
+def crear_reserva_segura(
+    inicio,
+    datos,
+    cliente_id,
+    canal
+):
+
+    try:
+
+        # Volver a comprobar disponibilidad real en Google Calendar
+        # justo antes de crear la cita, sin pasar por el cache.
+        disponible = verificar_disponibilidad(
+            inicio,
+            DURACION_RESERVA,
+            usar_cache=False
+        )
+
+        if disponible is not True:
+            return {
+                "ok": False,
+                "ocupada": True,
+            }
+
+        resultado = crear_evento_diego(
+            inicio=inicio,
+            servicio_codigo=datos["servicio"],
+            nombre_cliente=datos["nombre"],
+            telefono_cliente=datos["telefono"],
+            correo_cliente=datos["correo"],
+        )
+
+        if not resultado["ok"]:
+            return {
+                "ok": False,
+                "error": resultado.get("error")
+            }
+
+        return {
+            "ok": True,
+            "evento_id": resultado["evento_id"],
+            "meet_url": resultado["meet_url"],
+        }
+
+    except Exception as e:
+        print(
+            "ERROR RESERVA SEGURA SIN DB:",
+            repr(e)
+        )
+        return {
+            "ok": False,
+            "error": str(e)
+        }
+
+
+# ============================================================
+# PROCESAR AGENDA
+# ============================================================
+
+def procesar_agenda(
+    estado,
+    texto,
+    cliente_id,
+    canal,
+    analisis=None
+):
+
+    datos = estado["datos_reserva"]
+
+    if analisis is None:
+        analisis = analizar_mensaje(texto)
+
+    texto = analisis["texto"]
+
+    texto_n = analisis["texto_n"]
+
+    fecha_exacta_detectada = analisis["fecha"]
+
+    mes_detectado = analisis["mes"]
+
+    menciona_fecha = (
+        "fecha_o_mes" in analisis["intenciones"]
+    )
+
+    if fecha_exacta_detectada and menciona_fecha:
+        datos["fecha_preferida"] = fecha_exacta_detectada.isoformat()
+        datos["mes_desde"] = None
+
+    elif mes_detectado:
+        datos["mes_desde"] = mes_detectado.isoformat()
+        datos["fecha_preferida"] = None
+
+
+    # ========================================================
+    # CANCELAR
+    # ========================================================
+
+    if "no_quiere" in analisis["intenciones"]:
+
+        resetear_reserva(
+            estado
+        )
+
+        return (
+            "No hay problema  "
+            "Cuando quieras conocer los servicios "
+            "o reservar una hora con Diego, "
+            "aquí estaré. ¡Que estés muy bien! "
+        )
+
+
+    # ========================================================
+    # SERVICIO
+    # ========================================================
+
+    if not datos["servicio"]:
+
+        servicio = analisis["servicio"]
+
+        corte_ambiguo = (
+            "corte" in texto_n
+            or "cortar" in texto_n
+            or "cortarme" in texto_n
+        ) and (
+            "pelo" in texto_n
+            or "cabello" in texto_n
+            or texto_n in {"corte", "quiero corte", "quiero un corte"}
+        )
+
+        if not servicio and texto_n in {"hombre", "varon", "masculino"}:
+            servicio = "corte_hombre"
+
+        if not servicio and texto_n in {"mujer", "dama", "femenino"}:
+            servicio = "corte_mujer"
+
+        if not servicio and corte_ambiguo:
+            return (
+                "Perfecto ✂️ ¿El corte es para hombre o mujer?\n\n"
+                "Respóndeme HOMBRE o MUJER.\n"
+                "Mantendré la fecha o el mes que me indicaste."
+            )
+
+        if servicio:
+
+            datos["servicio"] = servicio
+
+            servicio_info = obtener_servicio(
+                servicio
+            )
+
+            # ====================================================
+            # EL CLIENTE YA INDICÓ UNA HORA
+            # Ejemplo: "quiero un corte a las 3"
+            # ====================================================
+
+            hora_solicitada = analisis["fecha_hora"]
+
+            if hora_solicitada:
+
+                # La búsqueda de alternativas parte antes del aviso
+                # de progreso, que solo se encola.
+                futuro_horas = adelantar_alternativas()
+
+                if canal == "whatsapp":
+
+                    enviar_mensaje_progreso_twilio(
+                        cliente_id,
+                        (
+                            "🔎 Estoy revisando si esa hora "
+                            "está disponible en mi agenda. "
+                            "Dame un momento 😊"
+                        )
+                    )
+
+                disponible = verificar_disponibilidad(
+                    hora_solicitada,
+                    DURACION_RESERVA
+                )
+
+                if disponible is not False:
+                    futuro_horas.cancel()
+
+                if disponible is None:
+
+                    return (
+                        "No pude comprobar la agenda "
+                        "en este momento 😕.\n\n"
+                        "Intenta nuevamente en unos segundos."
+                    )
+
+                if disponible is True:
+
+                    datos["fecha_hora"] = (
+                        hora_solicitada.isoformat()
+                    )
+
+                    estado["paso"] = "nombre"
+
+                    precio = precio_texto_servicio(
+                        servicio_info
+                    )
+
+                    return (
+                        "¡Sí! Esa hora está disponible 😊\n\n"
+                        f"💈 {servicio_info['nombre']}\n"
+                        f"💰 {precio}\n"
+                        f"📅 {formato_fecha_larga(hora_solicitada)}\n\n"
+                        "¿Me indicas tu nombre para continuar "
+                        "con la reserva?"
+                    )
+
+                # La hora solicitada está ocupada:
+                # mostrar alternativas reales.
+                if (
+                    canal == "whatsapp"
+                    and not futuro_horas.done()
+                ):
+
+                    enviar_mensaje_progreso_twilio(
+                        cliente_id,
+                        (
+                            "Esa hora está ocupada. "
+                            "Estoy buscando las alternativas "
+                            "más próximas 😊"
+                        )
+                    )
+
+                horas = futuro_horas.result()
+
+                if horas is None:
+                    return (
+                        "No pude consultar la agenda en este momento 😕.\n\n"
+                        "Revisa la conexión con Google Calendar e intenta nuevamente."
+                    )
+
+                if not horas:
+
+                    return (
+                        f"La hora solicitada para "
+                        f"{servicio_info['nombre']} está ocupada "
+                        "y por ahora no encontré otras horas "
+                        "disponibles."
+                    )
+
+                estado["horas_ofrecidas"] = [
+                    h.isoformat()
+                    for h in horas
+                ]
+
+                estado["paso"] = "seleccionar_hora"
+
+                return (
+                    f"La hora que pediste "
+                    f"({formato_fecha_larga(hora_solicitada)}) "
+                    "no está disponible 😕.\n\n"
+                    "Estas son las próximas opciones disponibles:\n\n"
+                    f"{formatear_opciones_horas(horas)}\n\n"
+                    "Respóndeme con el número de la opción "
+                    "que prefieras."
+                )
+
+            # ====================================================
+            # NO INDICÓ HORA: respetar fecha o mes solicitado
+            # ====================================================
+
+            if canal == "whatsapp":
+
+                enviar_mensaje_progreso_twilio(
+                    cliente_id,
+                    (
+                        "🔎 Estoy buscando disponibilidad real "
+                        "en mi agenda. Dame un momento 😊"
+                    )
+                )
+
+            if datos.get("fecha_preferida"):
+
+                fecha_preferida = datetime.fromisoformat(
+                    datos["fecha_preferida"]
+                )
+
+                horas = buscar_horas_disponibles_dia(
+                    fecha_preferida
+                )
+
+                if horas is None:
+                    return (
+                        "No pude consultar Google Calendar en este momento 😕.\n\n"
+                        "Intenta nuevamente en unos segundos."
+                    )
+
+                if not es_dia_atencion(fecha_preferida):
+                    return (
+                        f"El {DIAS_NOMBRES[fecha_preferida.weekday()]} "
+                        f"{fecha_preferida.day}/{fecha_preferida.month} no atendemos.\n\n"
+                        "Atendemos de lunes a sábado entre 10:00 y 18:00.\n\n"
+                        "Puedes indicarme otra fecha o escribir MENÚ."
+                    )
+
+                if not horas:
+                    desde = (
+                        fecha_preferida
+                        + timedelta(days=1)
+                    ).replace(
+                        hour=0,
+                        minute=0,
+                        second=0,
+                        microsecond=0
+                    )
+
+                    horas = buscar_proximas_15_horas(
+                        desde=desde
+                    )
+
+                    if horas is None:
+                        return (
+                            "Ese día está completo y no pude consultar "
+                            "las horas siguientes en este momento 😕."
+                        )
+
+                    if not horas:
+                        return (
+                            f"El {fecha_preferida.day}/{fecha_preferida.month} "
+                            "está completo y no encontré horas posteriores disponibles."
+                        )
+
+                    prefijo = (
+                        f"El {fecha_preferida.day}/{fecha_preferida.month} "
+                        "está completo 😕.\n\n"
+                        "Estas son las próximas 15 horas disponibles desde el día siguiente:\n\n"
+                    )
+
+                else:
+                    prefijo = (
+                        f"Sí 😊 Para el {fecha_preferida.day}/{fecha_preferida.month} "
+                        "tengo estas horas disponibles:\n\n"
+                    )
+
+            elif datos.get("mes_desde"):
+
+                desde_mes = datetime.fromisoformat(
+                    datos["mes_desde"]
+                )
+
+                horas = buscar_proximas_15_horas(
+                    desde=desde_mes
+                )
+
+                if horas is None:
+                    return (
+                        "No pude consultar Google Calendar en este momento 😕.\n\n"
+                        "Intenta nuevamente en unos segundos."
+                    )
+
+                if not horas:
+                    return (
+                        f"No encontré horas disponibles desde "
+                        f"{MESES_NOMBRES[desde_mes.month - 1]} por ahora."
+                    )
+
+                prefijo = (
+                    f"Perfecto 😊 Estas son las primeras 15 horas disponibles "
+                    f"desde {MESES_NOMBRES[desde_mes.month - 1]}:\n\n"
+                )
+
+            else:
+
+                horas = buscar_proximas_15_horas()
+
+                if horas is None:
+                    return (
+                        "Elegiste el servicio, pero no pude consultar "
+                        "Google Calendar en este momento 😕.\n\n"
+                        "Intenta nuevamente en unos segundos."
+                    )
+
+                if not horas:
+                    return (
+                        f"Perfecto. Elegiste {servicio_info['nombre']}.\n\n"
+                        "Pero por ahora no encontré horas disponibles."
+                    )
+
+                prefijo = "Estas son las próximas 15 horas disponibles:\n\n"
+
+            estado["horas_ofrecidas"] = [
+                h.isoformat()
+                for h in horas
+            ]
+
+            estado["paso"] = "seleccionar_hora"
+
+            precio = precio_texto_servicio(
+                servicio_info
+            )
+
+            return (
+                f"💈 {servicio_info['nombre']}\n"
+                f"💰 {precio}\n\n"
+                f"{prefijo}"
+                f"{formatear_opciones_horas(horas)}\n\n"
+                "Respóndeme con el número de la hora que prefieras.\n"
+                "También puedes escribir otra fecha, otro mes o MENÚ."
+            )
+
+        return mostrar_servicios()
+
+
+    # ========================================================
+    # HORA
+    # ========================================================
+
+    if estado["paso"] == "seleccionar_hora":
+
+        # ====================================================
+        # EL CLIENTE PUEDE CAMBIAR DE DÍA EN LENGUAJE NATURAL
+        # Ejemplos:
+        # "mañana no hay?"
+        # "¿y el viernes?"
+        # "tienes disponibilidad el miércoles?"
+        # ====================================================
+
+        fecha_consultada = fecha_exacta_detectada
+
+        mes_consultado = mes_detectado
+
+        if mes_consultado:
+
+            if canal == "whatsapp":
+                enviar_mensaje_progreso_twilio(
+                    cliente_id,
+                    "🔎 Estoy revisando la disponibilidad desde ese mes 😊"
+                )
+
+            horas_mes = buscar_proximas_15_horas(
+                desde=mes_consultado
+            )
+
+            if horas_mes is None:
+                return (
+                    "No pude consultar Google Calendar en este momento 😕.\n\n"
+                    "Intenta nuevamente en unos segundos."
+                )
+
+            if not horas_mes:
+                return (
+                    f"No encontré horas disponibles desde "
+                    f"{MESES_NOMBRES[mes_consultado.month - 1]} por ahora."
+                )
+
+            estado["horas_ofrecidas"] = [
+                h.isoformat()
+                for h in horas_mes
+            ]
+
+            datos["mes_desde"] = mes_consultado.isoformat()
+            datos["fecha_preferida"] = None
+
+            return (
+                f"Estas son las primeras 15 horas disponibles desde "
+                f"{MESES_NOMBRES[mes_consultado.month - 1]}:\n\n"
+                f"{formatear_opciones_horas(horas_mes)}\n\n"
+                "Respóndeme con el número de la hora que prefieras.\n"
                 "También puedes indicar una fecha exacta, por ejemplo "
                 "\"2 de septiembre\", o escribir MENÚ."
             )
 
-        menciona_dia = texto_menciona_fecha_o_mes(
-            texto
-        )
+        menciona_dia = menciona_fecha
+
+        if (
+            fecha_consultada
+            and menciona_dia
+        ):
+
+            if canal == "whatsapp":
+
+                enviar_mensaje_progreso_twilio(
+                    cliente_id,
+                    (
+                        "🔎 Estoy revisando la disponibilidad "
+                        "de ese día en mi agenda. "
+                        "Dame un momento 😊"
+                    )
+                )
+
+            horas_dia = buscar_horas_disponibles_dia(
+                fecha_consultada
+            )
+
+            if horas_dia is None:
+
+                return (
+                    "No pude comprobar la agenda "
+                    "en este momento 😕.\n\n"
+                    "Intenta nuevamente en unos segundos."
+                )
+
+            if not es_dia_atencion(
+                fecha_consultada
+            ):
+
+                return (
+                    f"El {DIAS_NOMBRES[fecha_consultada.weekday()]} "
+                    "no atendemos.\n\n"
+                    "Atendemos de lunes a sábado "
+                    "entre 10:00 y 18:00.\n\n"
+                    "¿Qué otro día quieres revisar?"
+                )
+
+            if not horas_dia:
+
+                siguiente_dia = (
+                    fecha_consultada
+                    + timedelta(days=1)
+                ).replace(
+                    hour=0,
+                    minute=0,
+                    second=0,
+                    microsecond=0
+                )
+
+                if canal == "whatsapp":
+
+                    enviar_mensaje_progreso_twilio(
+                        cliente_id,
+                        (
+                            "Ese día está completo. "
+                            "Estoy buscando las próximas "
+                            "horas disponibles 😊"
+                        )
+                    )
+
+                horas_siguientes = buscar_proximas_15_horas(
+                    desde=siguiente_dia
+                )
+
+                if horas_siguientes is None:
+                    return (
+                        "No pude consultar las horas siguientes en Google Calendar 😕.\n\n"
+                        "Intenta nuevamente en unos segundos."
+                    )
+
+                if not horas_siguientes:
+
+                    return (
+                        f"Para el "
+                        f"{DIAS_NOMBRES[fecha_consultada.weekday()]} "
+                        f"{fecha_consultada.day}/{fecha_consultada.month} "
+                        "no tengo horas disponibles 😕.\n\n"
+                        "Tampoco encontré horas disponibles "
+                        "en los días siguientes por ahora."
+                    )
+
+                estado["horas_ofrecidas"] = [
+                    h.isoformat()
+                    for h in horas_siguientes
+                ]
+
+                estado["paso"] = "seleccionar_hora"
+
+                return (
+                    f"Para el "
+                    f"{DIAS_NOMBRES[fecha_consultada.weekday()]} "
+                    f"{fecha_consultada.day}/{fecha_consultada.month} "
+                    "no tengo horas disponibles 😕.\n\n"
+                    "Estas son las próximas 15 horas disponibles "
+                    "desde el día siguiente:\n\n"
+                    f"{formatear_opciones_horas(horas_siguientes)}\n\n"
+                    "Respóndeme con el número de la hora "
+                    "que prefieras, del 1 al 15."
+                )
+
+            estado["horas_ofrecidas"] = [
+                h.isoformat()
+                for h in horas_dia
+            ]
+
+            return (
+                f"Sí 😊 Para el "
+                f"{DIAS_NOMBRES[fecha_consultada.weekday()]} "
+                f"{fecha_consultada.day}/{fecha_consultada.month} "
+                "tengo estas horas disponibles:\n\n"
+                f"{formatear_opciones_horas(horas_dia)}\n\n"
+                "Respóndeme con el número de la hora "
+                "que prefieras."
+            )
+
+        match = re.fullmatch(
+            r"\s*(\d{1,2})\s*",
+            texto
+        )
+
+        if not match:
+
+            return (
+                "Puedes responder con el número de una hora "
+                "o pedirme otra fecha o mes 😊\n\n"
+                "Por ejemplo:\n"
+                "• 1\n"
+                "• 2 de septiembre\n"
+                "• septiembre\n"
+                "• ¿Mañana tienes disponibilidad?\n\n"
+                "Escribe MENÚ cuando quieras volver al menú principal."
+            )
+
+        numero = int(
+            match.group(1)
+        )
+
+        horas_guardadas = (
+            estado
+            .get(
+                "horas_ofrecidas",
+                []
+            )
+        )
+
+        if (
+            numero < 1
+            or numero > len(horas_guardadas)
+        ):
+
+            return (
+                f"Elige un número entre 1 y "
+                f"{len(horas_guardadas)}, por favor ."
+            )
+
+        fecha_hora = datetime.fromisoformat(
+            horas_guardadas[numero - 1]
+        )
+
+        # ====================================================
+        # SEGUNDA COMPROBACIÓN EN GOOGLE CALENDAR
+        # ====================================================
+
+        if canal == "whatsapp":
+
+            enviar_mensaje_progreso_twilio(
+                cliente_id,
+                (
+                    "🔎 Perfecto. Estoy verificando nuevamente "
+                    "esa hora en la agenda antes de continuar 😊"
+                )
+            )
+
+        disponible = verificar_disponibilidad(
+            fecha_hora,
+            DURACION_RESERVA
+        )
+
+        if disponible is None:
+
+            return (
+                "No pude comprobar la agenda "
+                "en este momento .\n\n"
+                "Intenta nuevamente en unos segundos."
+            )
+
+        if not disponible:
+
+            horas = buscar_proximas_15_horas()
+
+            if horas is None:
+                return (
+                    "Esa hora ya no está disponible y no pude actualizar "
+                    "la agenda en este momento 😕. Intenta nuevamente."
+                )
+
+            estado["horas_ofrecidas"] = [
+                h.isoformat()
+                for h in horas
+            ]
+
+            return (
+                "Esa hora acaba de ocuparse .\n\n"
+                "Actualicé las horas disponibles:\n\n"
+                f"{formatear_opciones_horas(horas)}\n\n"
+                "¿Cuál prefieres?"
+            )
+
+        datos["fecha_hora"] = (
+            fecha_hora.isoformat()
+        )
+
+        estado["paso"] = "nombre"
+
+        return (
+            "¡Perfecto! 😊\n\n"
+            "La hora sigue disponible:\n"
+            f"📅 {formato_fecha_larga(fecha_hora)}\n\n"
+            "Ahora necesito tus datos para cerrar la cita.\n\n"
+            "¿Me indicas tu nombre?"
+        )
+
+
+    # ========================================================
+    # NOMBRE
+    # ========================================================
+
+    if estado["paso"] == "nombre":
+
+        if len(texto) < 2:
+
+            return (
+                "¿Me indicas tu nombre, por favor? "
+            )
+
+        datos["nombre"] = texto
+
+        actualizar_conversacion_datos(
+            cliente_id,
+            canal,
+            nombre=texto
+        )
+
+        if (
+            canal == "whatsapp"
+            and datos.get("telefono")
+        ):
+
+            actualizar_conversacion_datos(
+                cliente_id,
+                canal,
+                telefono=datos["telefono"]
+            )
+
+            estado["paso"] = "correo"
+
+            return (
+                f"Perfecto, {texto} 😊\n\n"
+                "Ya tengo tu número de WhatsApp.\n\n"
+                "¿Cuál es tu correo electrónico?\n\n"
+                "Lo usaremos para enviarte la invitación "
+                "de Google Calendar con los datos de tu cita presencial."
+            )
+
+        estado["paso"] = "telefono"
+
+        return (
+            f"Perfecto, {texto} 😊\n\n"
+            "¿Cuál es tu número de teléfono? "
+        )
+
+
+    # ========================================================
+    # TELÉFONO
+    # ========================================================
+
+    if estado["paso"] == "telefono":
+
+        # En WhatsApp/Twilio el número ya viene identificado
+        # automáticamente en el campo From.
+        if (
+            canal == "whatsapp"
+            and datos.get("telefono")
+        ):
+
+            actualizar_conversacion_datos(
+                cliente_id,
+                canal,
+                telefono=datos["telefono"]
+            )
+
+            estado["paso"] = "correo"
+
+            return (
+                "Perfecto 😊\n\n"
+                "Ya tengo tu número de WhatsApp.\n\n"
+                "¿Cuál es tu correo electrónico?\n\n"
+                "Lo usaremos para enviarte la invitación "
+                "de Google Calendar con los datos de tu cita presencial."
+            )
+
+        telefono_limpio = re.sub(
+            r"[^\d+]",
+            "",
+            texto
+        )
+
+        if len(
+            re.sub(
+                r"\D",
+                "",
+                telefono_limpio
+            )
+        ) < 8:
+
+            return (
+                "¿Me indicas un número de teléfono "
+                "válido, por favor? "
+            )
+
+        datos["telefono"] = telefono_limpio
+
+        actualizar_conversacion_datos(
+            cliente_id,
+            canal,
+            telefono=telefono_limpio
+        )
+
+        estado["paso"] = "correo"
+
+        return (
+            "Perfecto 😊\n\n"
+            "¿Cuál es tu correo electrónico?\n\n"
+            "Lo usaremos para enviarte la invitación "
+            "de Google Calendar con los datos de tu cita presencial."
+        )
+
+
+    # ========================================================
+    # CORREO
+    # ========================================================
+
+    if estado["paso"] == "correo":
+
+        correo = texto.lower().strip()
+
+        patron_correo = (
+            r"^[^@\s]+@[^@\s]+\.[^@\s]+$"
+        )
+
+        if not re.match(
+            patron_correo,
+            correo
+        ):
+
+            return (
+                "Parece que el correo no está correcto .\n\n"
+                "Escríbelo nuevamente, por ejemplo:\n"
+                "nombre@gmail.com"
+            )
+
+        datos["correo"] = correo
+
+        actualizar_conversacion_datos(
+            cliente_id,
+            canal,
+            correo=correo
+        )
+
+        estado["paso"] = "confirmar"
+
+        if canal == "whatsapp":
+
+            enviar_mensaje_progreso_twilio(
+                cliente_id,
+                (
+                    "📅 Gracias. Estoy haciendo la última validación "
+                    "en la agenda y cerrando tu cita. Dame un momento 😊"
+                )
+            )
+
+        return completar_reserva(
+            estado,
+            cliente_id,
+            canal
+        )
+
+
+    return completar_reserva(
+        estado,
+        cliente_id,
+        canal
+    )
+
+
+# ============================================================
+# COMPLETAR RESERVA
+# ============================================================
+
+def completar_reserva(
+    estado,
+    cliente_id,
+    canal
+):
+
+    datos = estado["datos_reserva"]
+
+    if not datos["servicio"]:
+
+        estado["paso"] = "servicio"
+
+        return mostrar_servicios()
+
+    if not datos["fecha_hora"]:
+
+        estado["paso"] = "seleccionar_hora"
+
+        horas = buscar_proximas_15_horas()
+
+        if horas is None:
+            return (
+                "No pude consultar la agenda en este momento 😕. "
+                "Intenta nuevamente en unos segundos."
+            )
+
+        estado["horas_ofrecidas"] = [
+            h.isoformat()
+            for h in horas
+        ]
+
+        return (
+            "Estas son las próximas 15 horas disponibles:\n\n"
+            f"{formatear_opciones_horas(horas)}\n\n"
+            "Respóndeme con el número de la hora que prefieras."
+        )
+
+    if not datos["nombre"]:
+
+        estado["paso"] = "nombre"
+
+        return (
+            "¿Me indicas tu nombre? "
+        )
+
+    if not datos["telefono"]:
+
+        estado["paso"] = "telefono"
+
+        return (
+            "¿Cuál es tu número de teléfono? "
+        )
+
+    if not datos["correo"]:
+
+        estado["paso"] = "correo"
+
+        return (
+            "¿Cuál es tu correo electrónico? "
+        )
+
+    inicio = datetime.fromisoformat(
+        datos["fecha_hora"]
+    )
+
+    # ========================================================
+    # RESERVA SEGURA
+    # ========================================================
+
+    resultado = crear_reserva_segura(
+        inicio=inicio,
+        datos=datos,
+        cliente_id=cliente_id,
+        canal=canal
+    )
+
+    if resultado.get("ocupada"):
+
+        datos["fecha_hora"] = None
+
+        estado["paso"] = "seleccionar_hora"
+
+        horas = buscar_proximas_15_horas()
+
+        if horas is None:
+            return (
+                "No pude actualizar la agenda en este momento 😕. "
+                "Intenta nuevamente en unos segundos."
+            )
+
+        estado["horas_ofrecidas"] = [
+            h.isoformat()
+            for h in horas
+        ]
+
+        return (
+            "Justo esa hora acaba de ocuparse 😕.\n\n"
+            "Volví a consultar la agenda y estas son las "
+            "próximas 15 horas disponibles:\n\n"
+            f"{formatear_opciones_horas(horas)}\n\n"
+            "Respóndeme con el número de la nueva hora "
+            "que prefieras."
+        )
+
+    if not resultado["ok"]:
+
+        print(
+            "ERROR RESERVANDO:",
+            resultado.get("error")
+        )
+
+        return (
+            "No pude completar la reserva "
+            "en este momento .\n\n"
+            "Intenta nuevamente en unos segundos."
+        )
+
+    servicio = obtener_servicio(
+        datos["servicio"]
+    )
+
+    meet_url = resultado.get(
+        "meet_url"
+    )
+
+    actualizar_conversacion_datos(
+        cliente_id,
+        canal,
+        nombre=datos["nombre"],
+        telefono=datos["telefono"],
+        correo=datos["correo"],
+        servicio=servicio["nombre"],
+        fecha_reserva=inicio,
+        meet_url=meet_url,
+        estado="reserva_confirmada"
+    )
+
+    guardar_reserva_db(
+        cliente_id,
+        canal,
+        datos,
+        inicio,
+        inicio + timedelta(minutes=DURACION_RESERVA),
+        resultado.get("evento_id"),
+        meet_url
+    )
+
+    fecha_texto = formato_fecha_larga(
+        inicio
+    )
+
+    # ========================================================
+    # GUARDAR MENSAJE DE CONFIRMACIÓN
+    # ========================================================
+
+    # Antes de resetear guardamos el estado.
+    telefono_guardar = datos["telefono"]
+
+    resetear_reserva(
+        estado
+    )
+
+    estado["datos_reserva"]["telefono"] = (
+        telefono_guardar
+    )
+
+    precio = precio_texto_servicio(
+        servicio
+    )
+
+    respuesta = (
+        " ¡Reserva confirmada!\n\n"
+        f" Servicio: {servicio['nombre']}\n"
+        f" Valor: {precio}\n"
+        f" Cliente: {datos['nombre']}\n"
+        f" Teléfono: {datos['telefono']}\n"
+        f" Correo: {datos['correo']}\n"
+        f" {fecha_texto}\n\n"
+        f"Tu hora quedó agendada directamente "
+        f"en la agenda de {ESTILISTA_NOMBRE}.\n\n"
+    )
+
+    respuesta += (
+        "La invitación de Google Calendar fue enviada "
+        "al correo indicado.\n\n"
+    )
+
+    respuesta += (
+        "La atención dura 1 hora.\n\n"
+        "📍 Dirección de atención:\n"
+        "2 Norte 280\n\n"
+        "💳 Datos de transferencia:\n"
+        "Nombre: Diego\n"
+        "RUT: 18.149.067-5\n"
+        "Banco: BancoEstado\n"
+        "Tipo de cuenta: Cuenta Vista\n"
+        "N° de cuenta: 18149067\n\n"
+        "¡Te esperamos! 😊"
+    )
+
+    return respuesta
+
+
+# ============================================================
+# EJECUCIÓN EN SEGUNDO PLANO
+# ============================================================
+
+class EjecutorPorClave:
+    """
+    Pool de hilos acotado que ejecuta las tareas de una misma clave
+    en orden estricto y las de claves distintas en paralelo.
+    """
+
+    def __init__(
+        self,
+        nombre,
+        max_hilos,
+        max_pendientes
+    ):
+
+        self.nombre = nombre
+        self.max_pendientes = max_pendientes
+
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_hilos,
+            thread_name_prefix=nombre,
+        )
+
+        self.colas = {}
+        self.pendientes = 0
+        self.lock = threading.Lock()
+
+    def enviar(self, clave, funcion, *args):
+        """
+        Encola funcion(*args) detrás de las tareas anteriores de la
+        misma clave. Devuelve False si el ejecutor está lleno.
+
+        max_pendientes solo limita las claves nuevas: una clave que
+        ya tiene cola siempre encola, porque si el llamador atendiera
+        la tarea por su cuenta podría adelantarse a las anteriores.
+        """
+
+        with self.lock:
+
+            cola = self.colas.get(clave)
+
+            if cola is not None:
+
+                # Ya hay un hilo drenando esta clave.
+                self.pendientes += 1
+                cola.append((funcion, args))
+                return True
+
+            if self.pendientes >= self.max_pendientes:
+                return False
+
+            self.pendientes += 1
+
+            self.colas[clave] = deque([(funcion, args)])
+
+        self.pool.submit(
+            self._drenar,
+            clave
+        )
+
+        return True
+
+    def _drenar(self, clave):
+
+        while True:
+
+            with self.lock:
+
+                cola = self.colas[clave]
+
+                if not cola:
+                    del self.colas[clave]
+                    return
+
+                funcion, args = cola.popleft()
+
+            try:
+                funcion(*args)
+
+            except Exception as e:
+
+                print(
+                    f"ERROR EN {self.nombre.upper()}:",
+                    repr(e)
+                )
+
+            finally:
+
+                with self.lock:
+                    self.pendientes -= 1
+
+    def metricas(self):
+
+        with self.lock:
+
+            profundidades = [
+                len(cola)
+                for cola in self.colas.values()
+            ]
+
+        return {
+            "pendientes": self.pendientes,
+            "max_pendientes": self.max_pendientes,
+            "claves_activas": len(profundidades),
+            "max_profundidad": max(profundidades, default=0),
+        }
+
+
+# ============================================================
+# BLOQUEO POR CONVERSACIÓN
+# ============================================================
+
+# Un lock por conversación: los mensajes de un mismo número se
+# procesan de a uno (no se mezclan "paso" ni "horas_ofrecidas") y
+# los de clientes distintos siguen en paralelo. Los locks sin uso se
+# eliminan después de CONVERSACION_LOCK_IDLE_SECONDS.
+
+CONVERSACION_LOCK_IDLE_SECONDS = int(
+    os.getenv(
+        "CONVERSACION_LOCK_IDLE_SECONDS",
+        "600"
+    )
+)
+
+CONVERSACION_LOCKS = {}
+
+CONVERSACION_LOCKS_LOCK = threading.Lock()
+
+CONVERSACION_LOCKS_LIMPIEZA = {
+    "ultima": time.monotonic(),
+}
+
+
+def limpiar_locks_conversacion(ahora):
+    """
+    Elimina los locks sin uso. Se ejecuta como máximo una vez por
+    minuto y siempre con CONVERSACION_LOCKS_LOCK tomado.
+    """
+
+    if ahora - CONVERSACION_LOCKS_LIMPIEZA["ultima"] < 60:
+        return
+
+    CONVERSACION_LOCKS_LIMPIEZA["ultima"] = ahora
+
+    for clave in [
+        clave
+        for clave, entrada in CONVERSACION_LOCKS.items()
+        if entrada["en_uso"] == 0
+        and ahora - entrada["ultimo_uso"]
+        > CONVERSACION_LOCK_IDLE_SECONDS
+    ]:
+        del CONVERSACION_LOCKS[clave]
+
+
+@contextmanager
+def bloqueo_conversacion(clave):
+
+    with CONVERSACION_LOCKS_LOCK:
+
+        ahora = time.monotonic()
+
+        limpiar_locks_conversacion(ahora)
+
+        entrada = CONVERSACION_LOCKS.get(clave)
+
+        if entrada is None:
+
+            entrada = {
+                "lock": threading.Lock(),
+                "en_uso": 0,
+                "ultimo_uso": ahora,
+            }
+
+            CONVERSACION_LOCKS[clave] = entrada
+
+        # Cuenta al que procesa y a los que esperan su turno.
+        entrada["en_uso"] += 1
+
+    entrada["lock"].acquire()
+
+    try:
+        yield
+
+    finally:
+
+        entrada["lock"].release()
+
+        with CONVERSACION_LOCKS_LOCK:
+
+            entrada["en_uso"] -= 1
+            entrada["ultimo_uso"] = time.monotonic()
+
+
+def metricas_locks_conversacion():
+
+    with CONVERSACION_LOCKS_LOCK:
+
+        en_uso = [
+            entrada["en_uso"]
+            for entrada in CONVERSACION_LOCKS.values()
+        ]
+
+    return {
+        "claves": len(en_uso),
+        "procesando": sum(1 for n in en_uso if n > 0),
+        "en_espera": sum(max(n - 1, 0) for n in en_uso),
+        "max_profundidad": max(en_uso, default=0),
+    }
+
+
+# ============================================================
+# SQL COMPARTIDO ENTRE WORKERS
+# ============================================================
+
+# Conexiones para el estado que comparten los workers de gunicorn
+# (sesiones y deduplicación). Cada hilo usa su propia conexión,
+# salvo que se entregue "prestar": un contextmanager como
+# db_connect() que presta una conexión del pool por sentencia.
+
+class ClienteSQL:
+
+    def __init__(
+        self,
+        nombre,
+        conectar,
+        marcador,
+        prestar=None
+    ):
+
+        self.nombre = nombre
+        self.conectar = conectar
+        self.marcador = marcador
+        self.prestar = prestar
+
+        self.local = threading.local()
+
+    def _conexion(self):
+
+        conexion = getattr(self.local, "conexion", None)
+
+        if conexion is None:
+
+            conexion = self.conectar()
+            self.local.conexion = conexion
+
+        return conexion
+
+    def ejecutar(self, sql, parametros=(), leer=False):
+        """
+        Ejecuta y confirma una sentencia. Con leer=True devuelve la
+        primera fila; si no, la cantidad de filas afectadas.
+        """
+
+        sql = sql.replace("?", self.marcador)
+
+        if self.prestar is not None:
+
+            with self.prestar() as conexion:
+
+                return self._ejecutar_en(
+                    conexion,
+                    sql,
+                    parametros,
+                    leer
+                )
+
+        conexion = self._conexion()
+
+        try:
+
+            resultado = self._ejecutar_en(
+                conexion,
+                sql,
+                parametros,
+                leer
+            )
+
+            conexion.commit()
+
+            return resultado
+
+        except Exception:
+
+            # Una conexión rota no se reutiliza; el próximo uso
+            # del hilo abre una nueva.
+            self.local.conexion = None
+
+            try:
+                conexion.close()
+            except Exception:
+                pass
+
+            raise
+
+    def _ejecutar_en(self, conexion, sql, parametros, leer):
+
+        cursor = conexion.cursor()
+
+        try:
+
+            cursor.execute(sql, parametros)
+
+            if leer:
+                return cursor.fetchone()
+
+            return cursor.rowcount
+
+        finally:
+            cursor.close()
+
+
+def crear_cliente_sql(backend, ruta_sqlite, database_url):
+
+    if backend == "sqlite":
+
+        import sqlite3
+
+        def conectar():
+
+            conexion = sqlite3.connect(
+                ruta_sqlite,
+                timeout=10
+            )
+
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+
+            return conexion
+
+        return ClienteSQL(
+            "sqlite",
+            conectar,
+            "?"
+        )
+
+    if backend == "postgres":
+
+        if not database_url:
+            raise Exception(
+                "El backend postgres requiere una URL de base de datos."
+            )
+
+        # Sobre la misma base que DATABASE_URL se comparte su pool en
+        # vez de abrir una conexión más por hilo.
+        if (
+            DB_DIALECTO == "postgres"
+            and database_url == DATABASE_URL
+        ):
+
+            return ClienteSQL(
+                "postgres",
+                None,
+                "%s",
+                prestar=db_connect
+            )
+
+        import psycopg2
+
+        def conectar():
+            return psycopg2.connect(database_url)
+
+        return ClienteSQL(
+            "postgres",
+            conectar,
+            "%s"
+        )
+
+    return None
+
+
+# ============================================================
+# SESIONES WHATSAPP Y CHAT WEB
+# ============================================================
+
+# El estado de cada número de WhatsApp y de cada visitante del chat
+# web (cuya cookie solo guarda cliente_id) vive en un almacén
+# intercambiable:
+#   memoria  -> LRU con expiración, acotado a WA_SESSION_MAX números.
+#   sqlite   -> archivo local, compartido entre workers de un servidor.
+#   postgres -> compartido entre servidores y persistente a reinicios.
+# El chat web usa un almacén aparte (tabla web_sesiones, cupo
+# WEB_SESSION_MAX), para que los visitantes anónimos no expulsen a
+# los clientes de WhatsApp.
+# El estado se guarda como JSON compacto y el historial se recorta a
+# los últimos WA_HISTORIAL_MAX / WEB_HISTORIAL_MAX mensajes.
+
+WA_SESSION_STORE = os.getenv(
+    "WA_SESSION_STORE",
+    "memoria"
+).strip().lower()
+
+WA_SESSION_TTL_SECONDS = int(
+    os.getenv(
+        "WA_SESSION_TTL_SECONDS",
+        str(7 * 24 * 60 * 60)
+    )
+)
+
+WA_SESSION_MAX = int(
+    os.getenv(
+        "WA_SESSION_MAX",
+        "5000"
+    )
+)
+
+WA_HISTORIAL_MAX = int(
+    os.getenv(
+        "WA_HISTORIAL_MAX",
+        "30"
+    )
+)
+
+WEB_HISTORIAL_MAX = int(
+    os.getenv(
+        "WEB_HISTORIAL_MAX",
+        "30"
+    )
+)
+
+WA_SESSION_SQLITE_PATH = os.getenv(
+    "WA_SESSION_SQLITE_PATH",
+    "sesiones_whatsapp.sqlite3"
+)
+
+WA_SESSION_DATABASE_URL = os.getenv(
+    "WA_SESSION_DATABASE_URL",
+    os.getenv("DATABASE_URL")
+)
 
-        if (
-            fecha_consultada
-            and menciona_dia
-        ):
+WEB_SESSION_STORE = os.getenv(
+    "WEB_SESSION_STORE",
+    WA_SESSION_STORE
+).strip().lower()
 
-            if canal == "whatsapp":
+WEB_SESSION_TTL_SECONDS = int(
+    os.getenv(
+        "WEB_SESSION_TTL_SECONDS",
+        str(24 * 60 * 60)
+    )
+)
 
-                enviar_mensaje_progreso_twilio(
-                    cliente_id,
-                    (
-                        "🔎 Estoy revisando la disponibilidad "
-                        "de ese día en mi agenda. "
-                        "Dame un momento 😊"
-                    )
-                )
+WEB_SESSION_MAX = int(
+    os.getenv(
+        "WEB_SESSION_MAX",
+        "2000"
+    )
+)
 
-            horas_dia = buscar_horas_disponibles_dia(
-                fecha_consultada
-            )
+def nueva_wa_session(wa_id):
 
-            if horas_dia is None:
+    return {
 
-                return (
-                    "No pude comprobar la agenda "
-                    "en este momento 😕.\n\n"
-                    "Intenta nuevamente en unos segundos."
-                )
+        "historial": [],
 
-            if not es_dia_atencion(
-                fecha_consultada
-            ):
+        "modo_agendar": False,
 
-                return (
-                    f"El {DIAS_NOMBRES[fecha_consultada.weekday()]} "
-                    "no atendemos.\n\n"
-                    "Atendemos de lunes a sábado "
-                    "entre 10:00 y 18:00.\n\n"
-                    "¿Qué otro día quieres revisar?"
-                )
+        "paso": "menu_principal",
 
-            if not horas_dia:
+        "horas_ofrecidas": [],
 
-                siguiente_dia = (
-                    fecha_consultada
-                    + timedelta(days=1)
-                ).replace(
-                    hour=0,
-                    minute=0,
-                    second=0,
-                    microsecond=0
-                )
+        "datos_reserva": {
 
-                if canal == "whatsapp":
+            "servicio": None,
+            "fecha_hora": None,
+            "nombre": None,
+            "telefono": wa_id,
+            "correo": None,
+            "fecha_preferida": None,
+            "mes_desde": None,
+        },
+    }
 
-                    enviar_mensaje_progreso_twilio(
-                        cliente_id,
-                        (
-                            "Ese día está completo. "
-                            "Estoy buscando las próximas "
-                            "horas disponibles 😊"
-                        )
-                    )
 
-                horas_siguientes = buscar_proximas_15_horas(
-                    desde=siguiente_dia
-                )
+def nueva_web_session():
 
-                if horas_siguientes is None:
-                    return (
-                        "No pude consultar las horas siguientes en Google Calendar 😕.\n\n"
-                        "Intenta nuevamente en unos segundos."
-                    )
+    return {
 
-                if not horas_siguientes:
+        "historial": [],
 
-                    return (
-                        f"Para el "
-                        f"{DIAS_NOMBRES[fecha_consultada.weekday()]} "
-                        f"{fecha_consultada.day}/{fecha_consultada.month} "
-                        "no tengo horas disponibles 😕.\n\n"
-                        "Tampoco encontré horas disponibles "
-                        "en los días siguientes por ahora."
-                    )
+        "modo_agendar": False,
 
-                estado["horas_ofrecidas"] = [
-                    h.isoformat()
-                    for h in horas_siguientes
-                ]
+        "paso": "inicio",
 
-                estado["paso"] = "seleccionar_hora"
+        "horas_ofrecidas": [],
 
-                return (
-                    f"Para el "
-                    f"{DIAS_NOMBRES[fecha_consultada.weekday()]} "
-                    f"{fecha_consultada.day}/{fecha_consultada.month} "
-                    "no tengo horas disponibles 😕.\n\n"
-                    "Estas son las próximas 15 horas disponibles "
-                    "desde el día siguiente:\n\n"
-                    f"{formatear_opciones_horas(horas_siguientes)}\n\n"
-                    "Respóndeme con el número de la hora "
-                    "que prefieras, del 1 al 15."
-                )
+        "datos_reserva": {
 
-            estado["horas_ofrecidas"] = [
-                h.isoformat()
-                for h in horas_dia
-            ]
+            "servicio": None,
+            "fecha_hora": None,
+            "nombre": None,
+            "telefono": None,
+            "correo": None,
+        },
+    }
 
-            return (
-                f"Sí 😊 Para el "
-                f"{DIAS_NOMBRES[fecha_consultada.weekday()]} "
-                f"{fecha_consultada.day}/{fecha_consultada.month} "
-                "tengo estas horas disponibles:\n\n"
-                f"{formatear_opciones_horas(horas_dia)}\n\n"
-                "Respóndeme con el número de la hora "
-                "que prefieras."
-            )
 
-        match = re.fullmatch(
-            r"\s*(\d{1,2})\s*",
-            texto
-        )
+def serializar_sesion(estado):
 
-        if not match:
+    return json.dumps(
+        estado,
+        ensure_ascii=False,
+        separators=(",", ":")
+    )
 
-            return (
-                "Puedes responder con el número de una hora "
-                "o pedirme otra fecha o mes 😊\n\n"
-                "Por ejemplo:\n"
-                "• 1\n"
-                "• 2 de septiembre\n"
-                "• septiembre\n"
-                "• ¿Mañana tienes disponibilidad?\n\n"
-                "Escribe MENÚ cuando quieras volver al menú principal."
-            )
 
-        numero = int(
-            match.group(1)
-        )
+def deserializar_sesion(texto):
 
-        horas_guardadas = (
-            estado
-            .get(
-                "horas_ofrecidas",
-                []
-            )
-        )
+    return json.loads(texto)
 
-        if (
-            numero < 1
-            or numero > len(horas_guardadas)
-        ):
 
-            return (
-                f"Elige un número entre 1 y "
-                f"{len(horas_guardadas)}, por favor ."
-            )
+class AlmacenSesiones:
+    """
+    Interfaz de los almacenes de sesiones. Guardan el estado ya
+    serializado, así cada lectura entrega una copia independiente.
+    """
 
-        fecha_hora = datetime.fromisoformat(
-            horas_guardadas[numero - 1]
-        )
+    nombre = "base"
 
-        # ====================================================
-        # SEGUNDA COMPROBACIÓN EN GOOGLE CALENDAR
-        # ====================================================
+    def cargar(self, clave):
+        raise NotImplementedError
 
-        if canal == "whatsapp":
+    def guardar(self, clave, texto):
+        raise NotImplementedError
 
-            enviar_mensaje_progreso_twilio(
-                cliente_id,
-                (
-                    "🔎 Perfecto. Estoy verificando nuevamente "
-                    "esa hora en la agenda antes de continuar 😊"
-                )
-            )
+    def eliminar(self, clave):
+        raise NotImplementedError
 
-        disponible = verificar_disponibilidad(
-            fecha_hora,
-            DURACION_RESERVA
-        )
+    def metricas(self):
+        return {
+            "backend": self.nombre,
+        }
 
-        if disponible is None:
 
-            return (
-                "No pude comprobar la agenda "
-                "en este momento .\n\n"
-                "Intenta nuevamente en unos segundos."
-            )
+class AlmacenSesionesMemoria(AlmacenSesiones):
 
-        if not disponible:
+    nombre = "memoria"
 
-            horas = buscar_proximas_15_horas()
+    def __init__(
+        self,
+        max_sesiones,
+        ttl_segundos
+    ):
 
-            if horas is None:
-                return (
-                    "Esa hora ya no está disponible y no pude actualizar "
-                    "la agenda en este momento 😕. Intenta nuevamente."
-                )
+        self.max_sesiones = max_sesiones
+        self.ttl_segundos = ttl_segundos
 
-            estado["horas_ofrecidas"] = [
-                h.isoformat()
-                for h in horas
-            ]
+        # clave -> (ultimo_uso, texto), de la menos a la más reciente.
+        self.sesiones = OrderedDict()
 
-            return (
-                "Esa hora acaba de ocuparse .\n\n"
-                "Actualicé las horas disponibles:\n\n"
-                f"{formatear_opciones_horas(horas)}\n\n"
-                "¿Cuál prefieres?"
+        self.lock = threading.Lock()
+
+        self.expulsadas = 0
+        self.expiradas = 0
+
+    def _purgar_expiradas(self, ahora):
+
+        # Como el orden es por último uso, las vencidas están al
+        # comienzo y basta con mirar el primer elemento.
+        while self.sesiones:
+
+            clave, (ultimo_uso, _) = next(
+                iter(self.sesiones.items())
             )
 
-        datos["fecha_hora"] = (
-            fecha_hora.isoformat()
-        )
+            if ahora - ultimo_uso <= self.ttl_segundos:
+                break
 
-        estado["paso"] = "nombre"
+            del self.sesiones[clave]
+            self.expiradas += 1
 
-        return (
-            "¡Perfecto! 😊\n\n"
-            "La hora sigue disponible:\n"
-            f"📅 {formato_fecha_larga(fecha_hora)}\n\n"
-            "Ahora necesito tus datos para cerrar la cita.\n\n"
-            "¿Me indicas tu nombre?"
-        )
+    def cargar(self, clave):
 
+        ahora = time.monotonic()
 
-    # ========================================================
-    # NOMBRE
-    # ========================================================
+        with self.lock:
 
-    if estado["paso"] == "nombre":
+            self._purgar_expiradas(ahora)
 
-        if len(texto) < 2:
+            entrada = self.sesiones.get(clave)
 
-            return (
-                "¿Me indicas tu nombre, por favor? "
-            )
+            if entrada is None:
+                return None
 
-        datos["nombre"] = texto
+            self.sesiones[clave] = (ahora, entrada[1])
+            self.sesiones.move_to_end(clave)
 
-        actualizar_conversacion_datos(
-            cliente_id,
-            canal,
-            nombre=texto
-        )
+            return entrada[1]
 
-        if (
-            canal == "whatsapp"
-            and datos.get("telefono")
-        ):
+    def guardar(self, clave, texto):
 
-            actualizar_conversacion_datos(
-                cliente_id,
-                canal,
-                telefono=datos["telefono"]
-            )
+        ahora = time.monotonic()
+
+        with self.lock:
+
+            self.sesiones[clave] = (ahora, texto)
+            self.sesiones.move_to_end(clave)
+
+            self._purgar_expiradas(ahora)
+
+            while len(self.sesiones) > self.max_sesiones:
+
+                self.sesiones.popitem(last=False)
+                self.expulsadas += 1
+
+    def eliminar(self, clave):
+
+        with self.lock:
+            self.sesiones.pop(clave, None)
+
+    def metricas(self):
+
+        with self.lock:
+
+            return {
+                "backend": self.nombre,
+                "sesiones": len(self.sesiones),
+                "max_sesiones": self.max_sesiones,
+                "bytes": sum(
+                    len(texto)
+                    for _, texto in self.sesiones.values()
+                ),
+                "expulsadas": self.expulsadas,
+                "expiradas": self.expiradas,
+            }
+
+
+class AlmacenSesionesSQL(AlmacenSesiones):
+    """
+    Almacén sobre SQLite o PostgreSQL. Las sesiones vencidas se
+    borran como máximo una vez cada diez minutos.
+    """
+
+    def __init__(
+        self,
+        sql,
+        tabla,
+        ttl_segundos
+    ):
 
-            estado["paso"] = "correo"
+        self.nombre = sql.nombre
+        self.sql = sql
+        self.tabla = tabla
+        self.ttl_segundos = ttl_segundos
 
-            return (
-                f"Perfecto, {texto} 😊\n\n"
-                "Ya tengo tu número de WhatsApp.\n\n"
-                "¿Cuál es tu correo electrónico?\n\n"
-                "Lo usaremos para enviarte la invitación "
-                "de Google Calendar con los datos de tu cita presencial."
+        self.ultima_purga = 0.0
+
+        self.sql.ejecutar(
+            f"""
+            CREATE TABLE IF NOT EXISTS {tabla} (
+                clave TEXT PRIMARY KEY,
+                estado TEXT NOT NULL,
+                actualizado_en DOUBLE PRECISION NOT NULL
             )
+            """
+        )
 
-        estado["paso"] = "telefono"
+    def cargar(self, clave):
 
-        return (
-            f"Perfecto, {texto} 😊\n\n"
-            "¿Cuál es tu número de teléfono? "
+        fila = self.sql.ejecutar(
+            f"""
+            SELECT estado FROM {self.tabla}
+            WHERE clave = ? AND actualizado_en >= ?
+            """,
+            (clave, time.time() - self.ttl_segundos),
+            leer=True
         )
 
+        return fila[0] if fila else None
 
-    # ========================================================
-    # TELÉFONO
-    # ========================================================
+    def guardar(self, clave, texto):
 
-    if estado["paso"] == "telefono":
+        ahora = time.time()
 
-        # En WhatsApp/Twilio el número ya viene identificado
-        # automáticamente en el campo From.
-        if (
-            canal == "whatsapp"
-            and datos.get("telefono")
-        ):
+        self.sql.ejecutar(
+            f"""
+            INSERT INTO {self.tabla} (clave, estado, actualizado_en)
+            VALUES (?, ?, ?)
+            ON CONFLICT (clave) DO UPDATE SET
+                estado = excluded.estado,
+                actualizado_en = excluded.actualizado_en
+            """,
+            (clave, texto, ahora)
+        )
 
-            actualizar_conversacion_datos(
-                cliente_id,
-                canal,
-                telefono=datos["telefono"]
-            )
+        if ahora - self.ultima_purga > 600:
 
-            estado["paso"] = "correo"
+            self.ultima_purga = ahora
 
-            return (
-                "Perfecto 😊\n\n"
-                "Ya tengo tu número de WhatsApp.\n\n"
-                "¿Cuál es tu correo electrónico?\n\n"
-                "Lo usaremos para enviarte la invitación "
-                "de Google Calendar con los datos de tu cita presencial."
+            self.sql.ejecutar(
+                f"DELETE FROM {self.tabla} WHERE actualizado_en < ?",
+                (ahora - self.ttl_segundos,)
             )
 
-        telefono_limpio = re.sub(
-            r"[^\d+]",
-            "",
-            texto
+    def eliminar(self, clave):
+
+        self.sql.ejecutar(
+            f"DELETE FROM {self.tabla} WHERE clave = ?",
+            (clave,)
         )
 
-        if len(
-            re.sub(
-                r"\D",
-                "",
-                telefono_limpio
-            )
-        ) < 8:
+    def metricas(self):
 
-            return (
-                "¿Me indicas un número de teléfono "
-                "válido, por favor? "
+        fila = self.sql.ejecutar(
+            f"SELECT COUNT(*) FROM {self.tabla}",
+            leer=True
+        )
+
+        return {
+            "backend": self.nombre,
+            "sesiones": fila[0] if fila else 0,
+        }
+
+
+def crear_almacen_sesiones(
+    backend,
+    tabla,
+    max_sesiones,
+    ttl_segundos
+):
+    """
+    Si la base no responde al arrancar se usa memoria: la app sigue
+    levantando, incluidas las rutas que no usan sesiones.
+    """
+
+    try:
+
+        sql = crear_cliente_sql(
+            backend,
+            WA_SESSION_SQLITE_PATH,
+            WA_SESSION_DATABASE_URL
+        )
+
+        if sql is not None:
+
+            return AlmacenSesionesSQL(
+                sql,
+                tabla,
+                ttl_segundos
             )
 
-        datos["telefono"] = telefono_limpio
+    except Exception as e:
 
-        actualizar_conversacion_datos(
-            cliente_id,
-            canal,
-            telefono=telefono_limpio
+        print(
+            "ERROR ALMACEN DE SESIONES, SE USA MEMORIA:",
+            tabla,
+            repr(e)
         )
 
-        estado["paso"] = "correo"
+        backend = "memoria"
 
-        return (
-            "Perfecto 😊\n\n"
-            "¿Cuál es tu correo electrónico?\n\n"
-            "Lo usaremos para enviarte la invitación "
-            "de Google Calendar con los datos de tu cita presencial."
+    if backend != "memoria":
+
+        print(
+            "ADVERTENCIA: almacén de sesiones desconocido, se usa memoria:",
+            backend
         )
 
+    return AlmacenSesionesMemoria(
+        max_sesiones,
+        ttl_segundos
+    )
 
-    # ========================================================
-    # CORREO
-    # ========================================================
 
-    if estado["paso"] == "correo":
+ALMACEN_SESIONES = crear_almacen_sesiones(
+    WA_SESSION_STORE,
+    "wa_sesiones",
+    WA_SESSION_MAX,
+    WA_SESSION_TTL_SECONDS
+)
 
-        correo = texto.lower().strip()
+ALMACEN_SESIONES_WEB = crear_almacen_sesiones(
+    WEB_SESSION_STORE,
+    "web_sesiones",
+    WEB_SESSION_MAX,
+    WEB_SESSION_TTL_SECONDS
+)
 
-        patron_correo = (
-            r"^[^@\s]+@[^@\s]+\.[^@\s]+$"
-        )
 
-        if not re.match(
-            patron_correo,
-            correo
-        ):
+def cargar_sesion(almacen, clave):
 
-            return (
-                "Parece que el correo no está correcto .\n\n"
-                "Escríbelo nuevamente, por ejemplo:\n"
-                "nombre@gmail.com"
-            )
+    try:
 
-        datos["correo"] = correo
+        texto = almacen.cargar(clave)
 
-        actualizar_conversacion_datos(
-            cliente_id,
-            canal,
-            correo=correo
+    except Exception as e:
+
+        print(
+            "ERROR CARGANDO SESION:",
+            repr(e)
         )
 
-        estado["paso"] = "confirmar"
+        return None
 
-        if canal == "whatsapp":
+    if texto is None:
+        return None
 
-            enviar_mensaje_progreso_twilio(
-                cliente_id,
-                (
-                    "📅 Gracias. Estoy haciendo la última validación "
-                    "en la agenda y cerrando tu cita. Dame un momento 😊"
-                )
-            )
+    return deserializar_sesion(texto)
 
-        return completar_reserva(
-            estado,
-            cliente_id,
-            canal
+
+def guardar_sesion(almacen, clave, estado, max_historial):
+
+    # El historial también se recorta en memoria, para que el
+    # turno siguiente no arrastre mensajes que ya no se guardan. Con
+    # 0 o menos no se guarda historial ([:-0] no borraría nada).
+    if max_historial > 0:
+        del estado["historial"][:-max_historial]
+    else:
+        estado["historial"].clear()
+
+    try:
+
+        almacen.guardar(
+            clave,
+            serializar_sesion(estado)
         )
 
+    except Exception as e:
 
-    return completar_reserva(
+        print(
+            "ERROR GUARDANDO SESION:",
+            repr(e)
+        )
+
+
+def get_wa_session(wa_id):
+
+    return (
+        cargar_sesion(ALMACEN_SESIONES, wa_id)
+        or nueva_wa_session(wa_id)
+    )
+
+
+def guardar_wa_session(wa_id, estado):
+
+    guardar_sesion(
+        ALMACEN_SESIONES,
+        wa_id,
         estado,
+        WA_HISTORIAL_MAX
+    )
+
+
+def get_web_session(cliente_id):
+
+    return (
+        cargar_sesion(ALMACEN_SESIONES_WEB, cliente_id)
+        or nueva_web_session()
+    )
+
+
+def guardar_web_session(cliente_id, estado):
+
+    guardar_sesion(
+        ALMACEN_SESIONES_WEB,
         cliente_id,
-        canal
+        estado,
+        WEB_HISTORIAL_MAX
     )
 
 
 # ============================================================
-# COMPLETAR RESERVA
+# DEDUPLICACIÓN TWILIO
 # ============================================================
 
-def completar_reserva(
-    estado,
-    cliente_id,
-    canal
-):
+# Twilio reintenta el webhook si no recibe respuesta a tiempo, y el
+# reintento puede llegar a otro worker. Cada MessageSid se registra
+# primero en memoria y, con WA_DEDUP_BACKEND=sqlite|postgres, en una
+# tabla compartida con clave primaria para que solo un proceso lo
+# atienda.
 
-    datos = estado["datos_reserva"]
+DEDUP_TTL_SECONDS = int(
+    os.getenv(
+        "DEDUP_TTL_SECONDS",
+        "120"
+    )
+)
 
-    if not datos["servicio"]:
+WA_DEDUP_BACKEND = os.getenv(
+    "WA_DEDUP_BACKEND",
+    "memoria"
+).strip().lower()
 
-        estado["paso"] = "servicio"
 
-        return mostrar_servicios()
+class DeduplicadorMemoria:
+    """
+    Ids recientes agrupados en baldes de tiempo. Expirar un balde
+    completo es O(1) por id, sin recorrer todos los ids en cada
+    mensaje.
+    """
 
-    if not datos["fecha_hora"]:
+    def __init__(
+        self,
+        ttl_segundos,
+        baldes=12
+    ):
 
-        estado["paso"] = "seleccionar_hora"
+        self.ttl_segundos = ttl_segundos
+        self.segundos_por_balde = max(
+            ttl_segundos / baldes,
+            1
+        )
 
-        horas = buscar_proximas_15_horas()
+        self.ids = set()
 
-        if horas is None:
-            return (
-                "No pude consultar la agenda en este momento 😕. "
-                "Intenta nuevamente en unos segundos."
-            )
+        # (numero_balde, ids_del_balde), del más antiguo al más nuevo.
+        self.baldes = deque()
 
-        estado["horas_ofrecidas"] = [
-            h.isoformat()
-            for h in horas
-        ]
+        self.lock = threading.Lock()
 
-        return (
-            "Estas son las próximas 15 horas disponibles:\n\n"
-            f"{formatear_opciones_horas(horas)}\n\n"
-            "Respóndeme con el número de la hora que prefieras."
+    def _expirar(self, balde_actual):
+
+        # Un balde se descarta cuando hasta su id más nuevo supera
+        # el TTL.
+        limite = (
+            balde_actual
+            - int(self.ttl_segundos / self.segundos_por_balde)
+            - 1
         )
 
-    if not datos["nombre"]:
+        while self.baldes and self.baldes[0][0] < limite:
 
-        estado["paso"] = "nombre"
+            _, ids = self.baldes.popleft()
+            self.ids.difference_update(ids)
 
-        return (
-            "¿Me indicas tu nombre? "
+    def registrar(self, msg_id):
+        """
+        Devuelve True si el id no se había visto dentro del TTL.
+        """
+
+        balde_actual = int(
+            time.monotonic() / self.segundos_por_balde
         )
 
-    if not datos["telefono"]:
+        with self.lock:
 
-        estado["paso"] = "telefono"
+            self._expirar(balde_actual)
 
-        return (
-            "¿Cuál es tu número de teléfono? "
-        )
+            if msg_id in self.ids:
+                return False
 
-    if not datos["correo"]:
+            if not self.baldes or self.baldes[-1][0] != balde_actual:
+                self.baldes.append((balde_actual, set()))
 
-        estado["paso"] = "correo"
+            self.baldes[-1][1].add(msg_id)
+            self.ids.add(msg_id)
 
-        return (
-            "¿Cuál es tu correo electrónico? "
-        )
+            return True
 
-    inicio = datetime.fromisoformat(
-        datos["fecha_hora"]
-    )
+    def metricas(self):
 
-    # ========================================================
-    # RESERVA SEGURA
-    # ========================================================
+        with self.lock:
 
-    resultado = crear_reserva_segura(
-        inicio=inicio,
-        datos=datos,
-        cliente_id=cliente_id,
-        canal=canal
-    )
+            return {
+                "ids": len(self.ids),
+                "baldes": len(self.baldes),
+            }
 
-    if resultado.get("ocupada"):
 
-        datos["fecha_hora"] = None
+class DeduplicadorSQL:
+    """
+    Registro compartido: gana el primer INSERT de cada MessageSid y
+    los demás no insertan filas. Las filas vencidas se borran como
+    máximo una vez por minuto.
+    """
 
-        estado["paso"] = "seleccionar_hora"
+    def __init__(
+        self,
+        sql,
+        ttl_segundos
+    ):
 
-        horas = buscar_proximas_15_horas()
+        self.sql = sql
+        self.ttl_segundos = ttl_segundos
 
-        if horas is None:
-            return (
-                "No pude actualizar la agenda en este momento 😕. "
-                "Intenta nuevamente en unos segundos."
+        self.ultima_purga = 0.0
+
+        self.sql.ejecutar(
+            """
+            CREATE TABLE IF NOT EXISTS wa_mensajes_procesados (
+                msg_id TEXT PRIMARY KEY,
+                recibido_en DOUBLE PRECISION NOT NULL
             )
+            """
+        )
 
-        estado["horas_ofrecidas"] = [
-            h.isoformat()
-            for h in horas
-        ]
+    def registrar(self, msg_id):
 
-        return (
-            "Justo esa hora acaba de ocuparse 😕.\n\n"
-            "Volví a consultar la agenda y estas son las "
-            "próximas 15 horas disponibles:\n\n"
-            f"{formatear_opciones_horas(horas)}\n\n"
-            "Respóndeme con el número de la nueva hora "
-            "que prefieras."
-        )
+        ahora = time.time()
 
-    if not resultado["ok"]:
+        if ahora - self.ultima_purga > 60:
 
-        print(
-            "ERROR RESERVANDO:",
-            resultado.get("error")
-        )
+            self.ultima_purga = ahora
 
-        return (
-            "No pude completar la reserva "
-            "en este momento .\n\n"
-            "Intenta nuevamente en unos segundos."
+            self.sql.ejecutar(
+                """
+                DELETE FROM wa_mensajes_procesados
+                WHERE recibido_en < ?
+                """,
+                (ahora - self.ttl_segundos,)
+            )
+
+        insertadas = self.sql.ejecutar(
+            """
+            INSERT INTO wa_mensajes_procesados (msg_id, recibido_en)
+            VALUES (?, ?)
+            ON CONFLICT (msg_id) DO NOTHING
+            """,
+            (msg_id, ahora)
         )
 
-    servicio = obtener_servicio(
-        datos["servicio"]
-    )
+        return insertadas == 1
 
-    meet_url = resultado.get(
-        "meet_url"
-    )
+    def metricas(self):
 
-    actualizar_conversacion_datos(
-        cliente_id,
-        canal,
-        nombre=datos["nombre"],
-        telefono=datos["telefono"],
-        correo=datos["correo"],
-        servicio=servicio["nombre"],
-        fecha_reserva=inicio,
-        meet_url=meet_url,
-        estado="reserva_confirmada"
-    )
+        fila = self.sql.ejecutar(
+            "SELECT COUNT(*) FROM wa_mensajes_procesados",
+            leer=True
+        )
 
-    fecha_texto = formato_fecha_larga(
-        inicio
-    )
+        return {
+            "backend": self.sql.nombre,
+            "ids": fila[0] if fila else 0,
+        }
 
-    # ========================================================
-    # GUARDAR MENSAJE DE CONFIRMACIÓN
-    # ========================================================
 
-    # Antes de resetear guardamos el estado.
-    telefono_guardar = datos["telefono"]
+DEDUP_LOCAL = DeduplicadorMemoria(
+    DEDUP_TTL_SECONDS
+)
 
-    resetear_reserva(
-        estado
-    )
+DEDUP_COMPARTIDO = None
 
-    estado["datos_reserva"]["telefono"] = (
-        telefono_guardar
-    )
+_dedup_sql = crear_cliente_sql(
+    WA_DEDUP_BACKEND,
+    WA_SESSION_SQLITE_PATH,
+    WA_SESSION_DATABASE_URL
+)
 
-    precio = precio_texto_servicio(
-        servicio
-    )
+if _dedup_sql is not None:
 
-    respuesta = (
-        " ¡Reserva confirmada!\n\n"
-        f" Servicio: {servicio['nombre']}\n"
-        f" Valor: {precio}\n"
-        f" Cliente: {datos['nombre']}\n"
-        f" Teléfono: {datos['telefono']}\n"
-        f" Correo: {datos['correo']}\n"
-        f" {fecha_texto}\n\n"
-        f"Tu hora quedó agendada directamente "
-        f"en la agenda de {ESTILISTA_NOMBRE}.\n\n"
+    DEDUP_COMPARTIDO = DeduplicadorSQL(
+        _dedup_sql,
+        DEDUP_TTL_SECONDS
     )
 
-    respuesta += (
-        "La invitación de Google Calendar fue enviada "
-        "al correo indicado.\n\n"
-    )
+elif WA_DEDUP_BACKEND != "memoria":
 
-    respuesta += (
-        "La atención dura 1 hora.\n\n"
-        "📍 Dirección de atención:\n"
-        "2 Norte 280\n\n"
-        "💳 Datos de transferencia:\n"
-        "Nombre: Diego\n"
-        "RUT: 18.149.067-5\n"
-        "Banco: BancoEstado\n"
-        "Tipo de cuenta: Cuenta Vista\n"
-        "N° de cuenta: 18149067\n\n"
-        "¡Te esperamos! 😊"
+    print(
+        "ADVERTENCIA: WA_DEDUP_BACKEND desconocido, se usa memoria:",
+        WA_DEDUP_BACKEND
     )
 
-    return respuesta
-
-
-# ============================================================
-# SESIONES WHATSAPP
-# ============================================================
 
-WA_SESSIONS = {}
+def registrar_mensaje_nuevo(msg_id):
+    """
+    Devuelve True si este proceso debe atender el mensaje.
+    """
 
-PROCESSED_MSG_IDS = {}
+    if not DEDUP_LOCAL.registrar(msg_id):
+        return False
 
-DEDUP_TTL_SECONDS = 120
+    if DEDUP_COMPARTIDO is None:
+        return True
 
+    try:
 
-def get_wa_session(wa_id):
+        return DEDUP_COMPARTIDO.registrar(msg_id)
 
-    if wa_id not in WA_SESSIONS:
+    except Exception as e:
 
-        WA_SESSIONS[wa_id] = {
+        # Sin la tabla compartida seguimos con la deduplicación
+        # local antes que dejar de responder.
+        print(
+            "ERROR DEDUPLICACION COMPARTIDA:",
+            repr(e)
+        )
 
-            "historial": [],
+        return True
 
-            "modo_agendar": False,
 
-            "paso": "menu_principal",
+def metricas_deduplicacion():
 
-            "horas_ofrecidas": [],
+    metricas = {
+        "local": DEDUP_LOCAL.metricas(),
+    }
 
-            "datos_reserva": {
+    if DEDUP_COMPARTIDO is not None:
 
-                "servicio": None,
-                "fecha_hora": None,
-                "nombre": None,
-                "telefono": wa_id,
-                "correo": None,
-                "fecha_preferida": None,
-                "mes_desde": None,
-            },
-        }
+        try:
+            metricas["compartido"] = DEDUP_COMPARTIDO.metricas()
+        except Exception as e:
+            metricas["compartido"] = {"error": repr(e)}
 
-    return WA_SESSIONS[wa_id]
+    return metricas
 
 
 # ============================================================
@@ -3028,13 +8468,181 @@ if (
         )
 
 
+WHATSAPP_ASYNC = (
+    os.getenv(
+        "WHATSAPP_ASYNC",
+        "0"
+    )
+    == "1"
+)
+
+WHATSAPP_WORKERS = int(
+    os.getenv(
+        "WHATSAPP_WORKERS",
+        "4"
+    )
+)
+
+WHATSAPP_COLA_MAX = int(
+    os.getenv(
+        "WHATSAPP_COLA_MAX",
+        "200"
+    )
+)
+
+EJECUTOR_WHATSAPP = EjecutorPorClave(
+    "whatsapp",
+    WHATSAPP_WORKERS,
+    WHATSAPP_COLA_MAX
+)
+
+
+# Los mensajes de progreso ("Estoy revisando...") se envían desde
+# un pool aparte para no bloquear la búsqueda. Se mantienen en orden
+# por destinatario, se descartan si llevan demasiado en la cola y se
+# suprimen si la respuesta final ya está lista.
+
+PROGRESO_WORKERS = int(
+    os.getenv(
+        "PROGRESO_WORKERS",
+        "4"
+    )
+)
+
+PROGRESO_COLA_MAX = int(
+    os.getenv(
+        "PROGRESO_COLA_MAX",
+        "100"
+    )
+)
+
+PROGRESO_MAX_ATRASO_SECONDS = float(
+    os.getenv(
+        "PROGRESO_MAX_ATRASO_SECONDS",
+        "10"
+    )
+)
+
+# Espera breve antes de enviar: si la respuesta final llega antes,
+# el cliente no recibe un "Estoy revisando..." innecesario.
+PROGRESO_DEMORA_SECONDS = float(
+    os.getenv(
+        "PROGRESO_DEMORA_SECONDS",
+        "0.3"
+    )
+)
+
+EJECUTOR_PROGRESO = EjecutorPorClave(
+    "progreso",
+    PROGRESO_WORKERS,
+    PROGRESO_COLA_MAX
+)
+
+# Turno abierto por destinatario. cerrar_turno_progreso() lo marca
+# como terminado y los mensajes de progreso pendientes no se envían.
+PROGRESO_TURNOS = {}
+
+PROGRESO_LOCK = threading.Lock()
+
+
 def enviar_mensaje_progreso_twilio(
     telefono_twilio,
     texto
 ):
     """
-    Envía un mensaje inmediato mientras el webhook continúa
-    procesando la búsqueda de disponibilidad.
+    Encola un mensaje de progreso sin esperar a Twilio mientras el
+    webhook continúa procesando la búsqueda de disponibilidad.
+    """
+
+    if not twilio_client:
+        return False
+
+    if not telefono_twilio:
+        return False
+
+    with PROGRESO_LOCK:
+
+        turno = PROGRESO_TURNOS.setdefault(
+            telefono_twilio,
+            {"vigente": True}
+        )
+
+    return EJECUTOR_PROGRESO.enviar(
+        telefono_twilio,
+        enviar_progreso_pendiente,
+        telefono_twilio,
+        texto,
+        turno,
+        time.monotonic()
+    )
+
+
+def enviar_progreso_pendiente(
+    telefono_twilio,
+    texto,
+    turno,
+    encolado_en
+):
+
+    restante = (
+        encolado_en
+        + PROGRESO_DEMORA_SECONDS
+        - time.monotonic()
+    )
+
+    if restante > 0:
+        time.sleep(restante)
+
+    if not turno["vigente"]:
+
+        print(
+            "MENSAJE PROGRESO SUPRIMIDO:",
+            telefono_twilio
+        )
+
+        return
+
+    if (
+        time.monotonic() - encolado_en
+        > PROGRESO_MAX_ATRASO_SECONDS
+    ):
+
+        print(
+            "MENSAJE PROGRESO DESCARTADO POR ATRASO:",
+            telefono_twilio
+        )
+
+        return
+
+    enviar_mensaje_twilio(
+        telefono_twilio,
+        texto
+    )
+
+
+def cerrar_turno_progreso(telefono_twilio):
+    """
+    Se llama cuando la respuesta final está lista: los mensajes de
+    progreso que sigan en cola ya no se envían.
+    """
+
+    with PROGRESO_LOCK:
+
+        turno = PROGRESO_TURNOS.pop(
+            telefono_twilio,
+            None
+        )
+
+    if turno is not None:
+        turno["vigente"] = False
+
+
+def enviar_mensaje_twilio(
+    telefono_twilio,
+    texto
+):
+    """
+    Envía un mensaje de WhatsApp por la API REST de Twilio.
     """
 
     if not twilio_client:
@@ -3043,73 +8651,195 @@ def enviar_mensaje_progreso_twilio(
     if not telefono_twilio:
         return False
 
-    try:
+    try:
+
+        destino = telefono_twilio
+
+        if not destino.startswith("whatsapp:"):
+            destino = "whatsapp:" + destino
+
+        twilio_client.messages.create(
+            from_=TWILIO_WHATSAPP_FROM,
+            to=destino,
+            body=texto
+        )
+
+        print(
+            "MENSAJE TWILIO ENVIADO:",
+            destino
+        )
+
+        return True
+
+    except Exception as e:
+
+        print(
+            "ERROR MENSAJE TWILIO:",
+            repr(e)
+        )
+
+        return False
+
+
+def normalizar_telefono_twilio(valor):
+    """
+    Twilio entrega:
+    whatsapp:+56912345678
+
+    Para guardar la reserva usamos:
+    +56912345678
+    """
+    valor = (valor or "").strip()
+
+    if valor.startswith("whatsapp:"):
+        return valor[len("whatsapp:"):]
+
+    return valor
+
+
+# ============================================================
+# HOME
+# ============================================================
+
+@app.route("/")
+def home():
+
+    return redirect(
+        url_for("chat")
+    )
+
+
+# ============================================================
+# CHAT WEB
+# ============================================================
+
+def responder_flujo_web(
+    estado_web,
+    pregunta,
+    cliente_id,
+    analisis
+):
+    """
+    Aplica la agenda y el menú de servicios a un mensaje del chat
+    web. Devuelve None cuando el mensaje debe responderlo OpenAI.
+    """
+
+    # =================================================
+    # AGENDA ACTIVA
+    # =================================================
+
+    if estado_web.get(
+        "modo_agendar",
+        False
+    ):
+
+        estado = {
+
+            "modo_agendar":
+                True,
+
+            "paso":
+                estado_web.get(
+                    "paso",
+                    "inicio"
+                ),
+
+            "horas_ofrecidas":
+                estado_web.get(
+                    "horas_ofrecidas",
+                    []
+                ),
+
+            "datos_reserva":
+                estado_web["datos_reserva"],
+        }
+
+        respuesta = procesar_agenda(
+            estado,
+            pregunta,
+            cliente_id,
+            "web",
+            analisis
+        )
+
+        estado_web["modo_agendar"] = (
+            estado["modo_agendar"]
+        )
+
+        estado_web["paso"] = (
+            estado["paso"]
+        )
+
+        estado_web["horas_ofrecidas"] = (
+            estado["horas_ofrecidas"]
+        )
+
+        estado_web["datos_reserva"] = (
+            estado["datos_reserva"]
+        )
+
+        return respuesta
+
 
-        destino = telefono_twilio
+    # =================================================
+    # INICIAR AGENDA
+    # =================================================
 
-        if not destino.startswith("whatsapp:"):
-            destino = "whatsapp:" + destino
+    elif "agendar" in analisis["intenciones"]:
 
-        twilio_client.messages.create(
-            from_=TWILIO_WHATSAPP_FROM,
-            to=destino,
-            body=texto
-        )
+        estado_web["modo_agendar"] = True
+        estado_web["paso"] = "inicio"
 
-        print(
-            "MENSAJE PROGRESO TWILIO ENVIADO:",
-            destino
-        )
+        estado = {
 
-        return True
+            "modo_agendar":
+                True,
 
-    except Exception as e:
+            "paso":
+                "inicio",
 
-        print(
-            "ERROR MENSAJE PROGRESO TWILIO:",
-            repr(e)
-        )
+            "horas_ofrecidas":
+                [],
 
-        return False
+            "datos_reserva":
+                estado_web["datos_reserva"],
+        }
 
+        respuesta = procesar_agenda(
+            estado,
+            pregunta,
+            cliente_id,
+            "web",
+            analisis
+        )
 
-def normalizar_telefono_twilio(valor):
-    """
-    Twilio entrega:
-    whatsapp:+56912345678
+        estado_web["paso"] = (
+            estado["paso"]
+        )
 
-    Para guardar la reserva usamos:
-    +56912345678
-    """
-    valor = (valor or "").strip()
+        estado_web["horas_ofrecidas"] = (
+            estado["horas_ofrecidas"]
+        )
 
-    if valor.startswith("whatsapp:"):
-        return valor[len("whatsapp:"):]
+        estado_web["datos_reserva"] = (
+            estado["datos_reserva"]
+        )
 
-    return valor
+        return respuesta
 
 
-# ============================================================
-# HOME
-# ============================================================
+    # =================================================
+    # SERVICIOS
+    # =================================================
 
-@app.route("/")
-def home():
+    elif "servicios" in analisis["intenciones"]:
 
-    return redirect(
-        url_for("chat")
-    )
+        return mostrar_servicios()
 
+    return None
 
-# ============================================================
-# CHAT WEB
-# ============================================================
 
-@app.route(
-    "/chat",
-    methods=["GET", "POST"]
-)
-def chat():
+def obtener_cliente_id_web():
 
     session.permanent = True
 
@@ -3128,67 +8858,204 @@ def chat():
 
         session["cliente_id"] = cliente_id
 
+    return cliente_id
+
 
-    if "historial" not in session:
+SALUDO_WEB = (
+    "¡Hola!  "
+    "Soy el Asistente Virtual "
+    "de Estilista Diego \n\n"
+    "¿Cómo estás?"
+)
 
-        session["historial"] = [
 
-            {
+@app.route(
+    "/chat",
+    methods=["GET", "POST"]
+)
+def chat():
+
+    cliente_id = obtener_cliente_id_web()
+
+    # La cookie solo lleva cliente_id; el historial y el estado de
+    # la reserva quedan en el almacén de sesiones. Se descartan los
+    # datos que dejaron cookies de versiones anteriores.
+    for clave in (
+        "historial",
+        "modo_agendar",
+        "paso",
+        "horas_ofrecidas",
+        "datos_reserva",
+    ):
+        session.pop(clave, None)
+
+    with bloqueo_conversacion(cliente_id):
+
+        estado_web = get_web_session(
+            cliente_id
+        )
+
+        # En un GET el saludo solo se muestra: la sesión se guarda
+        # recién con la primera pregunta.
+        nueva = not estado_web["historial"]
+
+        if nueva:
+
+            estado_web["historial"].append({
+
                 "role":
                     "assistant",
 
                 "content":
-                    (
-                        "¡Hola!  "
-                        "Soy el Asistente Virtual "
-                        "de Estilista Diego \n\n"
-                        "¿Cómo estás?"
-                    ),
-            }
-        ]
+                    SALUDO_WEB,
+            })
 
-        guardar_mensaje(
-            cliente_id,
-            "web",
-            "assistant",
-            session["historial"][0]["content"]
-        )
 
+        if request.method == "POST":
 
-    if "modo_agendar" not in session:
-        session["modo_agendar"] = False
+            pregunta = (
+                request.form
+                .get(
+                    "pregunta",
+                    ""
+                )
+                .strip()
+            )
 
-    if "paso" not in session:
-        session["paso"] = "inicio"
+            if pregunta:
 
-    if "horas_ofrecidas" not in session:
-        session["horas_ofrecidas"] = []
+                if nueva:
 
-    if "datos_reserva" not in session:
+                    guardar_mensaje(
+                        cliente_id,
+                        "web",
+                        "assistant",
+                        SALUDO_WEB
+                    )
 
-        session["datos_reserva"] = {
-            "servicio": None,
-            "fecha_hora": None,
-            "nombre": None,
-            "telefono": None,
-            "correo": None,
-        }
+                estado_web["historial"].append({
+                    "role":
+                        "user",
+                    "content":
+                        pregunta,
+                })
+
+                guardar_mensaje(
+                    cliente_id,
+                    "web",
+                    "user",
+                    pregunta
+                )
 
+                analisis = analizar_mensaje(
+                    pregunta
+                )
 
-    if request.method == "POST":
 
-        pregunta = (
-            request.form
-            .get(
-                "pregunta",
-                ""
-            )
-            .strip()
+                respuesta = responder_flujo_web(
+                    estado_web,
+                    pregunta,
+                    cliente_id,
+                    analisis
+                )
+
+                # Lo que no resuelve el flujo lo responde OpenAI.
+                if respuesta is None:
+
+                    respuesta = responder_openai(
+                        estado_web["historial"],
+                        pregunta
+                    )
+
+
+                estado_web["historial"].append({
+                    "role":
+                        "assistant",
+                    "content":
+                        respuesta,
+                })
+
+                guardar_mensaje(
+                    cliente_id,
+                    "web",
+                    "assistant",
+                    respuesta
+                )
+
+                guardar_web_session(
+                    cliente_id,
+                    estado_web
+                )
+
+
+    return render_template_string(
+        TEMPLATE,
+        historial=estado_web["historial"]
+    )
+
+
+# ============================================================
+# CHAT WEB EN STREAMING
+# ============================================================
+
+def evento_sse(evento, datos):
+
+    return (
+        f"event: {evento}\n"
+        f"data: {json.dumps(datos, ensure_ascii=False)}\n\n"
+    )
+
+
+@app.route(
+    "/chat/stream",
+    methods=["POST"]
+)
+def chat_stream():
+    """
+    Igual que POST /chat, pero responde con Server-Sent Events: las
+    respuestas de OpenAI llegan token a token y las de la agenda en
+    un solo evento. Al final se guarda el historial completo.
+    """
+
+    cliente_id = obtener_cliente_id_web()
+
+    pregunta = (
+        request.form
+        .get(
+            "pregunta",
+            ""
         )
+        .strip()
+    )
 
-        if pregunta:
+    if not pregunta:
+        return "Falta pregunta.", 400
 
-            session["historial"].append({
+    def generar():
+
+        with bloqueo_conversacion(cliente_id):
+
+            estado_web = get_web_session(
+                cliente_id
+            )
+
+            if not estado_web["historial"]:
+
+                estado_web["historial"].append({
+                    "role":
+                        "assistant",
+                    "content":
+                        SALUDO_WEB,
+                })
+
+                guardar_mensaje(
+                    cliente_id,
+                    "web",
+                    "assistant",
+                    SALUDO_WEB
+                )
+
+            estado_web["historial"].append({
                 "role":
                     "user",
                 "content":
@@ -3202,156 +9069,326 @@ def chat():
                 pregunta
             )
 
+            trozos = []
 
-            # =================================================
-            # AGENDA ACTIVA
-            # =================================================
+            try:
 
-            if session.get(
-                "modo_agendar",
-                False
-            ):
+                analisis = analizar_mensaje(
+                    pregunta
+                )
+
+                respuesta = responder_flujo_web(
+                    estado_web,
+                    pregunta,
+                    cliente_id,
+                    analisis
+                )
 
-                estado = {
+                if respuesta is None:
 
-                    "modo_agendar":
-                        True,
+                    for trozo in responder_openai_stream(
+                        estado_web["historial"],
+                        pregunta
+                    ):
 
-                    "paso":
-                        session.get(
-                            "paso",
-                            "inicio"
-                        ),
+                        trozos.append(trozo)
 
-                    "horas_ofrecidas":
-                        session.get(
-                            "horas_ofrecidas",
-                            []
-                        ),
+                        yield evento_sse(
+                            "token",
+                            {"texto": trozo}
+                        )
 
-                    "datos_reserva":
-                        session["datos_reserva"],
-                }
+                else:
 
-                respuesta = procesar_agenda(
-                    estado,
-                    pregunta,
-                    cliente_id,
-                    "web"
-                )
+                    trozos.append(respuesta)
 
-                session["modo_agendar"] = (
-                    estado["modo_agendar"]
-                )
+                    yield evento_sse(
+                        "token",
+                        {"texto": respuesta}
+                    )
 
-                session["paso"] = (
-                    estado["paso"]
+                yield evento_sse(
+                    "fin",
+                    {}
                 )
 
-                session["horas_ofrecidas"] = (
-                    estado["horas_ofrecidas"]
-                )
+            finally:
+
+                # También si el navegador cortó la conexión: se
+                # guarda lo que alcanzó a generarse.
+                respuesta = "".join(trozos).strip()
+
+                if respuesta:
+
+                    estado_web["historial"].append({
+                        "role":
+                            "assistant",
+                        "content":
+                            respuesta,
+                    })
 
-                session["datos_reserva"] = (
-                    estado["datos_reserva"]
+                    guardar_mensaje(
+                        cliente_id,
+                        "web",
+                        "assistant",
+                        respuesta
+                    )
+
+                guardar_web_session(
+                    cliente_id,
+                    estado_web
                 )
 
+    return Response(
+        generar(),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
 
-            # =================================================
-            # INICIAR AGENDA
-            # =================================================
 
-            elif es_intencion_agendar(
-                pregunta
-            ):
+# ============================================================
+# WHATSAPP / TWILIO WEBHOOK
+# ============================================================
+
+def procesar_mensaje_whatsapp(
+    telefono_twilio,
+    text
+):
+    """
+    Aplica la lógica de conversación a un mensaje de WhatsApp ya
+    validado y deduplicado, y devuelve el texto de respuesta.
+    """
 
-                session["modo_agendar"] = True
-                session["paso"] = "inicio"
+    # ====================================================
+    # SESIÓN POR NÚMERO
+    # ====================================================
 
-                estado = {
+    cliente_id = telefono_twilio
 
-                    "modo_agendar":
-                        True,
+    telefono_cliente = (
+        normalizar_telefono_twilio(
+            telefono_twilio
+        )
+    )
 
-                    "paso":
-                        "inicio",
+    estado = get_wa_session(
+        cliente_id
+    )
 
-                    "horas_ofrecidas":
-                        [],
+    # Twilio ya nos entrega el teléfono del cliente.
+    # No necesitamos volver a pedirlo durante la reserva.
+    estado[
+        "datos_reserva"
+    ][
+        "telefono"
+    ] = telefono_cliente
 
-                    "datos_reserva":
-                        session["datos_reserva"],
-                }
+    estado["historial"].append({
+        "role":
+            "user",
+        "content":
+            text,
+    })
 
-                respuesta = procesar_agenda(
-                    estado,
-                    pregunta,
-                    cliente_id,
-                    "web"
-                )
+    guardar_mensaje(
+        cliente_id,
+        "whatsapp",
+        "user",
+        text
+    )
+
+
+    # ====================================================
+    # PROCESAR CON LA LÓGICA ORIGINAL
+    # ====================================================
+
+    print(
+        "ESTADO WHATSAPP ANTES DE PROCESAR:",
+        {
+            "modo_agendar": estado.get("modo_agendar"),
+            "paso": estado.get("paso"),
+            "servicio": estado.get("datos_reserva", {}).get("servicio"),
+            "horas_guardadas": len(estado.get("horas_ofrecidas", [])),
+        }
+    )
+
+    analisis = analizar_mensaje(text)
+
+    texto_n = analisis["texto_n"]
+
+    # MENÚ siempre permite salir de cualquier flujo y comenzar de nuevo.
+    if analisis["comando_menu"]:
+
+        resetear_reserva(estado)
+        estado["paso"] = "menu_principal"
+        respuesta = mensaje_menu_principal()
+
+    # Si el cliente ya está dentro de una reserva, seguimos el flujo
+    # sin enviar la conversación a OpenAI.
+    elif estado["modo_agendar"]:
+
+        respuesta = procesar_agenda(
+            estado,
+            text,
+            cliente_id,
+            "whatsapp",
+            analisis
+        )
+
+    # Respuesta al menú inicial.
+    elif estado.get("paso") == "menu_principal":
+
+        if texto_n in {"1", "servicios", "precios", "servicios y precios"}:
+            estado["paso"] = "servicios_mostrados"
+            respuesta = mostrar_servicios()
+
+        elif texto_n in {"2", "agendar", "reservar", "agenda"}:
+            estado["modo_agendar"] = True
+            estado["paso"] = "inicio"
+            respuesta = (
+                "Perfecto 📅 ¿Qué servicio quieres agendar?\n\n"
+                + mostrar_servicios()
+            )
+
+        else:
+            respuesta = mensaje_menu_principal()
+
+    # Después de mostrar los precios, un número del 1 al 12
+    # se interpreta como selección del servicio y abre la agenda.
+    elif estado.get("paso") == "servicios_mostrados" and analisis["servicio"]:
+
+        estado["modo_agendar"] = True
+        estado["paso"] = "inicio"
+        respuesta = procesar_agenda(
+            estado,
+            text,
+            cliente_id,
+            "whatsapp",
+            analisis
+        )
+
+    elif "servicios" in analisis["intenciones"]:
+
+        estado["paso"] = "servicios_mostrados"
+        respuesta = mostrar_servicios()
+
+    elif "agendar" in analisis["intenciones"]:
+
+        estado["modo_agendar"] = True
+        estado["paso"] = "inicio"
+        respuesta = procesar_agenda(
+            estado,
+            text,
+            cliente_id,
+            "whatsapp",
+            analisis
+        )
+
+    elif analisis["servicio"]:
+
+        estado["modo_agendar"] = True
+        estado["paso"] = "inicio"
+        respuesta = procesar_agenda(
+            estado,
+            text,
+            cliente_id,
+            "whatsapp",
+            analisis
+        )
+
+    # Saludos y cualquier consulta fuera de flujo vuelven al menú.
+    # Así evitamos que el bot divague.
+    else:
+
+        estado["paso"] = "menu_principal"
+        respuesta = mensaje_menu_principal()
+
+
+    estado["historial"].append({
+        "role":
+            "assistant",
+        "content":
+            respuesta,
+    })
 
-                session["paso"] = (
-                    estado["paso"]
-                )
+    guardar_mensaje(
+        cliente_id,
+        "whatsapp",
+        "assistant",
+        respuesta
+    )
 
-                session["horas_ofrecidas"] = (
-                    estado["horas_ofrecidas"]
-                )
+    guardar_wa_session(
+        cliente_id,
+        estado
+    )
 
-                session["datos_reserva"] = (
-                    estado["datos_reserva"]
-                )
+    return respuesta
 
 
-            # =================================================
-            # SERVICIOS
-            # =================================================
+def atender_mensaje_whatsapp_async(
+    telefono_twilio,
+    text
+):
+    """
+    Procesa un mensaje encolado por el webhook y envía la respuesta
+    por la API REST de Twilio.
+    """
 
-            elif pregunta_servicios(
-                pregunta
-            ):
+    try:
 
-                respuesta = mostrar_servicios()
+        with bloqueo_conversacion(telefono_twilio):
 
+            # El turno se cierra sin soltar el bloqueo; si no, podría
+            # cerrar el del siguiente mensaje del mismo número.
+            try:
 
-            # =================================================
-            # OPENAI
-            # =================================================
+                respuesta = procesar_mensaje_whatsapp(
+                    telefono_twilio,
+                    text
+                )
 
-            else:
+            finally:
 
-                respuesta = responder_openai(
-                    session["historial"],
-                    pregunta
+                cerrar_turno_progreso(
+                    telefono_twilio
                 )
 
+    except Exception as e:
 
-            session["historial"].append({
-                "role":
-                    "assistant",
-                "content":
-                    respuesta,
-            })
+        print(
+            "TWILIO WHATSAPP ERROR:",
+            repr(e)
+        )
 
-            guardar_mensaje(
-                cliente_id,
-                "web",
-                "assistant",
-                respuesta
-            )
+        import traceback
+        print(
+            traceback.format_exc()
+        )
 
-            session.modified = True
+        respuesta = (
+            "Disculpa 🙏 Estoy teniendo un problema técnico. "
+            "Intenta nuevamente en unos segundos."
+        )
 
+    # La respuesta final pasa por la misma cola que los mensajes de
+    # progreso para que nunca llegue antes que uno ya en envío.
+    if not EJECUTOR_PROGRESO.enviar(
+        telefono_twilio,
+        enviar_mensaje_twilio,
+        telefono_twilio,
+        respuesta
+    ):
 
-    return render_template_string(
-        TEMPLATE,
-        historial=session["historial"]
-    )
+        enviar_mensaje_twilio(
+            telefono_twilio,
+            respuesta
+        )
 
 
-# ============================================================
-# WHATSAPP / TWILIO WEBHOOK
-# ============================================================
 
 @app.route(
     "/whatsapp/webhook",
@@ -3436,27 +9473,9 @@ def whatsapp_webhook():
         # DEDUPLICACIÓN TWILIO
         # ====================================================
 
-        ahora_timestamp = (
-            datetime.now().timestamp()
-        )
-
         if msg_id:
 
-            for old_id in list(
-                PROCESSED_MSG_IDS.keys()
-            ):
-
-                if (
-                    ahora_timestamp
-                    - PROCESSED_MSG_IDS[old_id]
-                    > DEDUP_TTL_SECONDS
-                ):
-
-                    del PROCESSED_MSG_IDS[
-                        old_id
-                    ]
-
-            if msg_id in PROCESSED_MSG_IDS:
+            if not registrar_mensaje_nuevo(msg_id):
 
                 # Twilio puede reintentar webhooks.
                 # Devolvemos TwiML vacío para no responder dos veces.
@@ -3469,163 +9488,50 @@ def whatsapp_webhook():
                     }
                 )
 
-            PROCESSED_MSG_IDS[
-                msg_id
-            ] = ahora_timestamp
-
 
         # ====================================================
-        # SESIÓN POR NÚMERO
+        # PROCESAMIENTO EN SEGUNDO PLANO
         # ====================================================
 
-        cliente_id = telefono_twilio
-
-        telefono_cliente = (
-            normalizar_telefono_twilio(
-                telefono_twilio
+        # Con WHATSAPP_ASYNC=1 respondemos a Twilio de inmediato y la
+        # respuesta se envía por la API REST desde un worker. Si la
+        # cola está llena se procesa aquí mismo, como siempre; un
+        # número con mensajes en cola siempre encola, así no se
+        # adelanta a ellos.
+        if (
+            WHATSAPP_ASYNC
+            and twilio_client
+            and EJECUTOR_WHATSAPP.enviar(
+                telefono_twilio,
+                atender_mensaje_whatsapp_async,
+                telefono_twilio,
+                text
             )
-        )
-
-        estado = get_wa_session(
-            cliente_id
-        )
-
-        # Twilio ya nos entrega el teléfono del cliente.
-        # No necesitamos volver a pedirlo durante la reserva.
-        estado[
-            "datos_reserva"
-        ][
-            "telefono"
-        ] = telefono_cliente
-
-        estado["historial"].append({
-            "role":
-                "user",
-            "content":
-                text,
-        })
-
-        guardar_mensaje(
-            cliente_id,
-            "whatsapp",
-            "user",
-            text
-        )
-
-
-        # ====================================================
-        # PROCESAR CON LA LÓGICA ORIGINAL
-        # ====================================================
-
-        print(
-            "ESTADO WHATSAPP ANTES DE PROCESAR:",
-            {
-                "modo_agendar": estado.get("modo_agendar"),
-                "paso": estado.get("paso"),
-                "servicio": estado.get("datos_reserva", {}).get("servicio"),
-                "horas_guardadas": len(estado.get("horas_ofrecidas", [])),
-            }
-        )
-
-        texto_n = normalizar_texto(text)
-
-        # MENÚ siempre permite salir de cualquier flujo y comenzar de nuevo.
-        if es_comando_menu(text):
-
-            resetear_reserva(estado)
-            estado["paso"] = "menu_principal"
-            respuesta = mensaje_menu_principal()
-
-        # Si el cliente ya está dentro de una reserva, seguimos el flujo
-        # sin enviar la conversación a OpenAI.
-        elif estado["modo_agendar"]:
+        ):
 
-            respuesta = procesar_agenda(
-                estado,
-                text,
-                cliente_id,
-                "whatsapp"
+            return (
+                str(twiml),
+                200,
+                {
+                    "Content-Type":
+                        "application/xml; charset=utf-8"
+                }
             )
 
-        # Respuesta al menú inicial.
-        elif estado.get("paso") == "menu_principal":
+        with bloqueo_conversacion(telefono_twilio):
 
-            if texto_n in {"1", "servicios", "precios", "servicios y precios"}:
-                estado["paso"] = "servicios_mostrados"
-                respuesta = mostrar_servicios()
+            try:
 
-            elif texto_n in {"2", "agendar", "reservar", "agenda"}:
-                estado["modo_agendar"] = True
-                estado["paso"] = "inicio"
-                respuesta = (
-                    "Perfecto 📅 ¿Qué servicio quieres agendar?\n\n"
-                    + mostrar_servicios()
+                respuesta = procesar_mensaje_whatsapp(
+                    telefono_twilio,
+                    text
                 )
 
-            else:
-                respuesta = mensaje_menu_principal()
-
-        # Después de mostrar los precios, un número del 1 al 12
-        # se interpreta como selección del servicio y abre la agenda.
-        elif estado.get("paso") == "servicios_mostrados" and detectar_servicio(text):
-
-            estado["modo_agendar"] = True
-            estado["paso"] = "inicio"
-            respuesta = procesar_agenda(
-                estado,
-                text,
-                cliente_id,
-                "whatsapp"
-            )
-
-        elif pregunta_servicios(text):
-
-            estado["paso"] = "servicios_mostrados"
-            respuesta = mostrar_servicios()
-
-        elif es_intencion_agendar(text):
-
-            estado["modo_agendar"] = True
-            estado["paso"] = "inicio"
-            respuesta = procesar_agenda(
-                estado,
-                text,
-                cliente_id,
-                "whatsapp"
-            )
-
-        elif detectar_servicio(text):
-
-            estado["modo_agendar"] = True
-            estado["paso"] = "inicio"
-            respuesta = procesar_agenda(
-                estado,
-                text,
-                cliente_id,
-                "whatsapp"
-            )
-
-        # Saludos y cualquier consulta fuera de flujo vuelven al menú.
-        # Así evitamos que el bot divague.
-        else:
-
-            estado["paso"] = "menu_principal"
-            respuesta = mensaje_menu_principal()
-
+            finally:
 
-        estado["historial"].append({
-            "role":
-                "assistant",
-            "content":
-                respuesta,
-        })
-
-        guardar_mensaje(
-            cliente_id,
-            "whatsapp",
-            "assistant",
-            respuesta
-        )
+                cerrar_turno_progreso(
+                    telefono_twilio
+                )
 
         twiml.message(
             respuesta
@@ -3743,12 +9649,63 @@ def admin_conversaciones():
     if not admin_autorizado():
         return redirect(url_for("admin"))
 
-    return (
-        "Panel de conversaciones deshabilitado temporalmente en la versión sin base de datos.",
-        200
+    if not DB_DIALECTO:
+
+        return (
+            "Panel de conversaciones deshabilitado: falta DATABASE_URL.",
+            200
+        )
+
+    try:
+
+        conversaciones = listar_conversaciones()
+
+    except Exception as e:
+
+        print(
+            "ERROR DB LISTAR CONVERSACIONES:",
+            repr(e)
+        )
+
+        return render_template_string(
+            ERROR_TEMPLATE,
+            titulo="Error de base de datos",
+            mensaje=str(e)
+        )
+
+    return render_template_string(
+        ADMIN_CONVERSACIONES_TEMPLATE,
+        conversaciones=conversaciones
     )
 
 
+# ============================================================
+# ADMIN MÉTRICAS
+# ============================================================
+
+@app.route(
+    "/admin/metricas"
+)
+def admin_metricas():
+
+    if not admin_autorizado():
+        return redirect(url_for("admin"))
+
+    return jsonify({
+        "calendar_service": estadisticas_calendar_service(),
+        "cola_whatsapp": EJECUTOR_WHATSAPP.metricas(),
+        "cola_progreso": EJECUTOR_PROGRESO.metricas(),
+        "conversaciones": metricas_locks_conversacion(),
+        "sesiones_whatsapp": ALMACEN_SESIONES.metricas(),
+        "sesiones_web": ALMACEN_SESIONES_WEB.metricas(),
+        "deduplicacion": metricas_deduplicacion(),
+        "mensajes_db": BUFFER_MENSAJES.metricas(),
+        "analisis_mensajes": estadisticas_analisis(),
+        "cache_openai": CACHE_OPENAI.metricas(),
+        "openai": metricas_openai(),
+    })
+
+
 # ============================================================
 # DETALLE CONVERSACIÓN
 # ============================================================
@@ -3761,9 +9718,47 @@ def admin_conversacion_detalle(conversation_id):
     if not admin_autorizado():
         return redirect(url_for("admin"))
 
-    return (
-        "Detalle de conversaciones deshabilitado temporalmente en la versión sin base de datos.",
-        200
+    if not DB_DIALECTO:
+
+        return (
+            "Detalle de conversaciones deshabilitado: falta DATABASE_URL.",
+            200
+        )
+
+    try:
+
+        conversacion = obtener_conversacion_por_id(
+            conversation_id
+        )
+
+        mensajes = listar_mensajes(
+            conversation_id
+        ) if conversacion else []
+
+    except Exception as e:
+
+        print(
+            "ERROR DB DETALLE CONVERSACION:",
+            repr(e)
+        )
+
+        return render_template_string(
+            ERROR_TEMPLATE,
+            titulo="Error de base de datos",
+            mensaje=str(e)
+        )
+
+    if not conversacion:
+
+        return (
+            "Conversación no encontrada.",
+            404
+        )
+
+    return render_template_string(
+        ADMIN_DETALLE_TEMPLATE,
+        conversacion=conversacion,
+        mensajes=mensajes
     )
 
 
@@ -4231,6 +10226,138 @@ window.onload = function() {
 
 };
 
+// Envía por /chat/stream y muestra la respuesta a medida que llega.
+// Sin fetch con streaming, el formulario se envía de la forma normal.
+
+function agregarMensaje(clase, texto) {
+
+    const box =
+        document.getElementById(
+            "chat-messages"
+        );
+
+    const div =
+        document.createElement("div");
+
+    div.className = "msg " + clase;
+
+    div.textContent = texto;
+
+    box.appendChild(div);
+
+    box.scrollTop =
+        box.scrollHeight;
+
+    return div;
+}
+
+document
+    .getElementById("chat-input-form")
+    .addEventListener("submit", async function(evento) {
+
+    if (!window.fetch || !window.TextDecoder || !window.ReadableStream) {
+        return;
+    }
+
+    evento.preventDefault();
+
+    const input =
+        document.getElementById(
+            "chat-input"
+        );
+
+    const pregunta =
+        input.value.trim();
+
+    if (!pregunta) {
+        return;
+    }
+
+    input.value = "";
+
+    agregarMensaje("user", pregunta);
+
+    const burbuja =
+        agregarMensaje("bot", "…");
+
+    const box =
+        document.getElementById(
+            "chat-messages"
+        );
+
+    const datos =
+        new FormData();
+
+    datos.append("pregunta", pregunta);
+
+    try {
+
+        const respuesta =
+            await fetch("/chat/stream", {
+                method: "POST",
+                body: datos,
+                credentials: "same-origin"
+            });
+
+        const lector =
+            respuesta.body.getReader();
+
+        const decoder =
+            new TextDecoder();
+
+        let pendiente = "";
+        let texto = "";
+
+        while (true) {
+
+            const { value, done } =
+                await lector.read();
+
+            if (done) {
+                break;
+            }
+
+            pendiente +=
+                decoder.decode(value, { stream: true });
+
+            const eventos =
+                pendiente.split("\n\n");
+
+            pendiente = eventos.pop();
+
+            for (const bloque of eventos) {
+
+                const lineas =
+                    bloque.split("\n");
+
+                const tipo =
+                    (lineas.find(l => l.startsWith("event: ")) || "")
+                    .slice(7);
+
+                const dato =
+                    lineas.find(l => l.startsWith("data: "));
+
+                if (tipo === "token" && dato) {
+
+                    texto +=
+                        JSON.parse(dato.slice(6)).texto;
+
+                    burbuja.textContent = texto;
+
+                    box.scrollTop =
+                        box.scrollHeight;
+                }
+            }
+        }
+
+    } catch (e) {
+
+        burbuja.textContent =
+            "Disculpa 🙏 Tuve un problema procesando el mensaje. "
+            + "Intenta nuevamente.";
+    }
+});
+
 </script>
 
 </body>
@@ -0,0 +1,165 @@
+"""
+Micro-benchmark del índice de horas ocupadas (construir_indice_ocupados
+e intervalo_ocupado) contra el recorrido de todos los eventos que se
+usaba antes.
+
+Genera calendarios sintéticos de 31 días con 50, 500 y 5000 eventos
+(solapados, contiguos y de largo variable), comprueba que ambos dan
+el mismo resultado para cada hora candidata del mes y mide el tiempo
+por consulta de 15 horas libres.
+
+Uso, desde la raíz del repositorio:
+
+    python bench/bench_disponibilidad.py
+"""
+
+import os
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+
+
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.pop("DATABASE_URL", None)
+
+sys.path.insert(
+    0,
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+import app  # noqa: E402
+
+
+DURACION = timedelta(minutes=app.DURACION_RESERVA)
+
+
+def calendario_sintetico(eventos, desde, semilla):
+
+    azar = random.Random(semilla)
+
+    ocupados = []
+
+    for _ in range(eventos):
+
+        inicio = desde + timedelta(
+            minutes=azar.randrange(0, 31 * 24 * 60, 15)
+        )
+
+        fin = inicio + timedelta(
+            minutes=azar.choice([15, 30, 45, 60, 90, 120])
+        )
+
+        ocupados.append((inicio, fin))
+
+    return ocupados
+
+
+def candidatos_mes(desde):
+
+    return [
+        desde + timedelta(hours=hora)
+        for hora in range(31 * 24)
+        if app.HORA_APERTURA <= (desde + timedelta(hours=hora)).hour
+        < app.HORA_CIERRE
+    ]
+
+
+def ocupado_recorriendo(ocupados, inicio, fin):
+
+    for inicio_ocupado, fin_ocupado in ocupados:
+
+        if inicio < fin_ocupado and fin > inicio_ocupado:
+            return True
+
+    return False
+
+
+def primeras_libres(ocupado, candidatos, cantidad=15):
+
+    libres = []
+
+    for inicio in candidatos:
+
+        if not ocupado(inicio, inicio + DURACION):
+
+            libres.append(inicio)
+
+            if len(libres) == cantidad:
+                break
+
+    return libres
+
+
+def medir(funcion, repeticiones):
+
+    inicio = time.perf_counter()
+
+    for _ in range(repeticiones):
+        funcion()
+
+    return (time.perf_counter() - inicio) / repeticiones * 1000
+
+
+def main():
+
+    desde = app.ZONA.localize(datetime(2026, 10, 1, 0, 0))
+
+    candidatos = candidatos_mes(desde)
+
+    print("eventos  recorrido_ms  indice_ms  construir_indice_ms")
+
+    for eventos in (50, 500, 5000):
+
+        ocupados = calendario_sintetico(eventos, desde, eventos)
+
+        indice = app.construir_indice_ocupados(ocupados)
+
+        for inicio in candidatos:
+
+            fin = inicio + DURACION
+
+            assert (
+                app.intervalo_ocupado(indice, inicio, fin)
+                == ocupado_recorriendo(ocupados, inicio, fin)
+            ), (eventos, inicio)
+
+        repeticiones = max(2, 20000 // eventos)
+
+        recorrido_ms = medir(
+            lambda: primeras_libres(
+                lambda inicio, fin: ocupado_recorriendo(
+                    ocupados,
+                    inicio,
+                    fin
+                ),
+                candidatos
+            ),
+            repeticiones
+        )
+
+        indice_ms = medir(
+            lambda: primeras_libres(
+                lambda inicio, fin: app.intervalo_ocupado(
+                    indice,
+                    inicio,
+                    fin
+                ),
+                candidatos
+            ),
+            repeticiones * 10
+        )
+
+        construir_ms = medir(
+            lambda: app.construir_indice_ocupados(ocupados),
+            repeticiones
+        )
+
+        print(
+            f"{eventos:>7}  {recorrido_ms:>12.3f}  {indice_ms:>9.3f}"
+            f"  {construir_ms:>19.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
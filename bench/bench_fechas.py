@@ -0,0 +1,180 @@
+"""
+Casos y tiempos de interpretar_fecha_hora.
+
+Interpreta frases de fecha y hora en instantes de referencia fijos,
+incluidos los días del cambio de horario de Chile (abril y septiembre
+de 2026), y comprueba:
+- la fecha y hora esperadas para cada caso, con su desfase UTC;
+- que cada resultado tenga el desfase que corresponde a la zona en
+  ese instante (ZONA.normalize no lo cambia).
+
+Luego mide el tiempo por mensaje. Uso, desde la raíz del repositorio:
+
+    python bench/bench_fechas.py
+"""
+
+import os
+import sys
+import time
+from datetime import datetime
+
+
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("TIMEZONE", "America/Santiago")
+os.environ.pop("DATABASE_URL", None)
+
+sys.path.insert(
+    0,
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+import app  # noqa: E402
+
+
+FRASES = [
+    "pasado mañana a las 15",
+    "mañana a las 11",
+    "hoy a las 17:30",
+    "el lunes a las 10",
+    "domingo 4 pm",
+    "a las 12",
+    "2 de septiembre a las 3",
+    "pasado mañana",
+    "viernes",
+    "el 12 de octubre",
+    "en diciembre",
+    "pasado mañana 15:30",
+    "a las 10 de octubre",
+    "quiero hora",
+]
+
+# (referencia, frase, fecha_hora esperada en ISO)
+CASOS = [
+    (
+        datetime(2026, 9, 5, 12, 0),
+        "pasado mañana a las 15",
+        "2026-09-07T15:00:00-03:00",
+    ),
+    (
+        datetime(2026, 9, 5, 12, 0),
+        "mañana a las 11",
+        "2026-09-06T11:00:00-03:00",
+    ),
+    (
+        datetime(2026, 9, 5, 12, 0),
+        "hoy a las 17:30",
+        "2026-09-05T17:30:00-04:00",
+    ),
+    (
+        datetime(2026, 9, 5, 12, 0),
+        "2 de septiembre a las 3",
+        "2027-09-02T15:00:00-04:00",
+    ),
+    (
+        datetime(2026, 4, 3, 12, 0),
+        "pasado mañana a las 15",
+        "2026-04-05T15:00:00-04:00",
+    ),
+    (
+        datetime(2026, 4, 3, 12, 0),
+        "mañana a las 11",
+        "2026-04-04T11:00:00-03:00",
+    ),
+    (
+        datetime(2026, 4, 3, 12, 0),
+        "el lunes a las 10",
+        "2026-04-06T10:00:00-04:00",
+    ),
+    (
+        datetime(2026, 6, 10, 9, 37),
+        "domingo 4 pm",
+        "2026-06-14T16:00:00-04:00",
+    ),
+    (
+        datetime(2026, 6, 10, 9, 37),
+        "a las 12",
+        "2026-06-10T12:00:00-04:00",
+    ),
+]
+
+REFERENCIAS = [
+    datetime(2026, 9, 5, 12, 0),
+    datetime(2026, 4, 3, 12, 0),
+    datetime(2026, 6, 10, 9, 37),
+    datetime(2026, 12, 30, 18, 0),
+]
+
+
+def main():
+
+    zona = app.ZONA
+
+    errores = []
+
+    for referencia, frase, esperado in CASOS:
+
+        resultado = app.interpretar_fecha_hora(
+            frase,
+            zona.localize(referencia)
+        )["fecha_hora"]
+
+        obtenido = resultado.isoformat() if resultado else None
+
+        if obtenido != esperado:
+            errores.append(
+                f"{referencia} {frase!r}: {obtenido} != {esperado}"
+            )
+
+    for referencia in REFERENCIAS:
+
+        ahora = zona.localize(referencia)
+
+        for frase in FRASES:
+
+            resultado = app.interpretar_fecha_hora(frase, ahora)
+
+            for clave in ("fecha", "fecha_hora", "mes"):
+
+                valor = resultado[clave]
+
+                if valor is None:
+                    continue
+
+                if valor.utcoffset() != zona.normalize(valor).utcoffset():
+                    errores.append(
+                        f"{referencia} {frase!r} {clave}: desfase"
+                        f" {valor.isoformat()}"
+                    )
+
+    ahora = zona.localize(REFERENCIAS[0])
+    repeticiones = 2000
+
+    inicio = time.perf_counter()
+
+    for _ in range(repeticiones):
+
+        for frase in FRASES:
+            app.interpretar_fecha_hora(frase, ahora)
+
+    us = (
+        (time.perf_counter() - inicio)
+        / (repeticiones * len(FRASES))
+        * 1e6
+    )
+
+    print(
+        "casos:", len(CASOS),
+        "frases:", len(FRASES) * len(REFERENCIAS),
+        "errores:", len(errores)
+    )
+
+    print("us por mensaje:", round(us, 2))
+
+    for error in errores:
+        print("ERROR:", error)
+
+    sys.exit(1 if errores else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Compara formatear_fechas_cortas con formato_fecha_corta y con un
+formato de referencia hecho con zoneinfo, y mide ambas funciones.
+
+Las horas cubren los cambios de horario de Chile de abril y
+septiembre de 2026 y llegan de cuatro formas: con localize(), sumando
+días a una fecha aware (que conserva el offset anterior al cambio),
+en UTC y con un offset fijo.
+
+Uso, desde la raíz del repositorio:
+
+    python bench/bench_formato_fechas.py
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("TIMEZONE", "America/Santiago")
+os.environ.pop("DATABASE_URL", None)
+
+sys.path.insert(
+    0,
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+import app  # noqa: E402
+
+
+def horas_de_prueba():
+
+    zona = app.ZONA
+
+    fechas = []
+
+    for inicio in (datetime(2026, 3, 30), datetime(2026, 8, 30)):
+
+        base = zona.localize(inicio)
+
+        for media_hora in range(12 * 48):
+
+            desplazamiento = timedelta(minutes=30 * media_hora)
+
+            local = zona.localize(inicio + desplazamiento)
+
+            fechas.extend([
+                local,
+                # Aritmética sobre una fecha aware de pytz: el offset
+                # queda el de antes del cambio de horario.
+                base + desplazamiento,
+                local.astimezone(timezone.utc),
+                local.astimezone(timezone(timedelta(hours=-5))),
+            ])
+
+    return fechas
+
+
+def referencia(fecha):
+
+    fecha = fecha.astimezone(ZoneInfo(app.TIMEZONE))
+
+    return (
+        f"{app.DIAS_NOMBRES[fecha.weekday()]} "
+        f"{fecha.day}/{fecha.month} "
+        f"{fecha.hour:02d}:{fecha.minute:02d}"
+    )
+
+
+def medir(funcion, repeticiones=200):
+
+    inicio = time.perf_counter()
+
+    for _ in range(repeticiones):
+        funcion()
+
+    return (time.perf_counter() - inicio) / repeticiones * 1000
+
+
+def main():
+
+    fechas = horas_de_prueba()
+
+    lote = app.formatear_fechas_cortas(fechas)
+
+    errores = []
+
+    for fecha, texto in zip(fechas, lote):
+
+        esperado = referencia(fecha)
+
+        if texto != esperado:
+            errores.append(
+                f"lote {fecha.isoformat()}: {texto} != {esperado}"
+            )
+
+        if app.formato_fecha_corta(fecha) != esperado:
+            errores.append(
+                f"corta {fecha.isoformat()}:"
+                f" {app.formato_fecha_corta(fecha)} != {esperado}"
+            )
+
+    mil = fechas[:1000]
+
+    uno_a_uno_ms = medir(
+        lambda: [app.formato_fecha_corta(fecha) for fecha in mil]
+    )
+
+    lote_ms = medir(lambda: app.formatear_fechas_cortas(mil))
+
+    print("horas:", len(fechas), "errores:", len(errores))
+
+    print(
+        "ms por 1000 horas  formato_fecha_corta:",
+        round(uno_a_uno_ms, 3),
+        " formatear_fechas_cortas:",
+        round(lote_ms, 3)
+    )
+
+    for error in errores[:20]:
+        print("ERROR:", error)
+
+    sys.exit(1 if errores else 0)
+
+
+if __name__ == "__main__":
+    main()
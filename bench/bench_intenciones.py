@@ -0,0 +1,159 @@
+"""
+Compara las expresiones de REGEX_INTENCIONES con la búsqueda frase por
+frase que se usaba antes (any(p in texto) y, para fechas y meses,
+una búsqueda por palabra completa por cada palabra).
+
+Usa mensajes de ejemplo más recombinaciones al azar de sus palabras,
+comprueba que ambas formas detectan las mismas intenciones y mide el
+tiempo por mensaje de cada una.
+
+Uso, desde la raíz del repositorio:
+
+    python bench/bench_intenciones.py [recombinaciones]
+"""
+
+import os
+import re
+import sys
+import time
+import random
+
+
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.pop("DATABASE_URL", None)
+
+sys.path.insert(
+    0,
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+import app  # noqa: E402
+
+
+MENSAJES = [
+    "Hola, quiero agendar una hora",
+    "hola",
+    "buenas tardes, ¿qué servicios tienen?",
+    "Cuánto cuesta el corte de pelo?",
+    "cuanto sale la barba",
+    "lista de precios porfa",
+    "tienes hora mañana?",
+    "hay horas el sábado en la tarde",
+    "quiero una hora para el viernes a las 15",
+    "no gracias",
+    "no, por ahora no",
+    "déjalo así, después te escribo",
+    "olvídalo",
+    "cancela la reserva del martes",
+    "quiero cancelar mi cita",
+    "necesito un corte urgente",
+    "¿qué horas tienes disponibles en septiembre?",
+    "el 12 de octubre puedes?",
+    "pasado mañana a las 11",
+    "disponible hoy?",
+    "quiero cortarme el pelo",
+    "me quiero cortar el cabello el lunes",
+    "Reservame para el miércoles",
+    "gracias, no",
+    "que hacen ahí?",
+    "valores de tinte y mechas",
+    "Ana",
+    "2",
+    "ok perfecto",
+    "en diciembre tienen turno?",
+]
+
+
+def referencia(texto_n):
+    """
+    Intenciones detectadas frase por frase, como antes de precompilar.
+    """
+
+    intenciones = set()
+
+    if any(p in texto_n for p in app.PATRONES_SERVICIOS):
+        intenciones.add("servicios")
+
+    if any(p in texto_n for p in app.PATRONES_AGENDAR):
+        intenciones.add("agendar")
+
+    if any(p in texto_n for p in app.PATRONES_NO_QUIERE):
+        intenciones.add("no_quiere")
+
+    if any(
+        re.search(rf"\b{re.escape(p)}\b", texto_n)
+        for p in app.PALABRAS_FECHA
+    ):
+        intenciones.add("fecha_o_mes")
+
+    return intenciones
+
+
+def recombinar(mensajes, cantidad, semilla=16):
+
+    azar = random.Random(semilla)
+
+    palabras = " ".join(mensajes).split()
+
+    return [
+        " ".join(
+            azar.choice(palabras)
+            for _ in range(azar.randint(1, 12))
+        )
+        for _ in range(cantidad)
+    ]
+
+
+def medir(funcion, textos, repeticiones=200):
+
+    inicio = time.perf_counter()
+
+    for _ in range(repeticiones):
+
+        for texto_n in textos:
+            funcion(texto_n)
+
+    return (
+        (time.perf_counter() - inicio)
+        / (repeticiones * len(textos))
+        * 1e6
+    )
+
+
+def main():
+
+    cantidad = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+
+    textos = [
+        app.normalizar_texto(mensaje)
+        for mensaje in MENSAJES + recombinar(MENSAJES, cantidad)
+    ]
+
+    distintos = 0
+
+    for texto_n in textos:
+
+        esperado = referencia(texto_n)
+        obtenido = app.detectar_intenciones(texto_n)
+
+        if obtenido != esperado:
+
+            distintos += 1
+            print("DISTINTO:", repr(texto_n), esperado, obtenido)
+
+    reales = textos[:len(MENSAJES)]
+
+    print("mensajes:", len(textos), "distintos:", distintos)
+
+    print(
+        "us por mensaje  referencia:",
+        round(medir(referencia, reales), 2),
+        " regex:",
+        round(medir(app.detectar_intenciones, reales), 2)
+    )
+
+    sys.exit(1 if distintos else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Compara normalizar_texto con un plegado de referencia carácter por
+carácter (NFD y descarte de unicodedata.combining) y mide su tiempo
+contra la versión anterior de seis str.replace.
+
+Comprueba mayúsculas, eñes, diéresis, acentos combinantes, emojis y
+textos vacíos o None, y mide mensajes cortos (los que pasan por la
+caché) y un mensaje largo con tildes.
+
+Uso, desde la raíz del repositorio:
+
+    python bench/bench_normalizar.py
+"""
+
+import os
+import sys
+import time
+import unicodedata
+
+
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.pop("DATABASE_URL", None)
+
+sys.path.insert(
+    0,
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+import app  # noqa: E402
+
+
+CORTOS = [
+    "1",
+    "2",
+    "hola",
+    "Menu",
+    "si",
+    "no gracias",
+    "MAÑANA",
+    "pasado mañana a las 15",
+    "el sábado",
+    "¿qué servicios tienen?",
+]
+
+LARGO = (
+    "Hola, buenas tardes. ¿Tendrías disponibilidad el miércoles o el "
+    "sábado en la mañana para un corte con lavado y peinado, por favor?"
+)
+
+CASOS = CORTOS + [
+    LARGO,
+    "",
+    None,
+    "   Pingüino  ",
+    "ÁÉÍÓÚÜÑ",
+    "café mañana",
+    "gracias 👍",
+    "Ça va, Zoë?",
+    LARGO.upper(),
+]
+
+
+def referencia(texto):
+
+    texto = (texto or "").strip().lower()
+
+    return "".join(
+        caracter
+        for caracter in unicodedata.normalize("NFD", texto)
+        if not unicodedata.combining(caracter)
+    )
+
+
+def anterior(texto):
+    """
+    normalizar_texto antes de plegar con NFD (solo vocales
+    minúsculas compuestas).
+    """
+
+    texto = (texto or "").strip().lower()
+
+    for a, b in {
+        "á": "a",
+        "é": "e",
+        "í": "i",
+        "ó": "o",
+        "ú": "u",
+        "ü": "u",
+    }.items():
+        texto = texto.replace(a, b)
+
+    return texto
+
+
+def medir(funcion, textos, repeticiones=20000):
+
+    inicio = time.perf_counter()
+
+    for _ in range(repeticiones):
+
+        for texto in textos:
+            funcion(texto)
+
+    return (
+        (time.perf_counter() - inicio)
+        / (repeticiones * len(textos))
+        * 1e6
+    )
+
+
+def main():
+
+    distintos = 0
+
+    for texto in CASOS:
+
+        esperado = referencia(texto)
+        obtenido = app.normalizar_texto(texto)
+
+        if obtenido != esperado:
+
+            distintos += 1
+            print("DISTINTO:", repr(texto), repr(esperado), repr(obtenido))
+
+    print("casos:", len(CASOS), "distintos:", distintos)
+
+    print("us por mensaje     anterior  actual")
+
+    for nombre, textos in (
+        ("cortos (cache)", CORTOS),
+        ("largo con tildes", [LARGO]),
+    ):
+
+        print(
+            f"{nombre:<17}  {medir(anterior, textos):>8.2f}"
+            f"  {medir(app.normalizar_texto, textos):>6.2f}"
+        )
+
+    sys.exit(1 if distintos else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Prueba de estrés de la serialización por conversación.
+
+Cada número recibe varias veces el mismo guion ("menu", "2", un
+servicio, un día, una hora, un nombre) intercalado con los demás
+números, por la cola de EJECUTOR_WHATSAPP igual que con
+WHATSAPP_ASYNC=1. Al mismo tiempo otros hilos atienden números por el
+camino síncrono del webhook, varios hilos con el mismo número.
+
+Comprueba que:
+- dos turnos de un mismo número nunca se solapan;
+- las respuestas de cada número llegan en orden y son las mismas que
+  da el guion procesado en secuencia;
+- al terminar cada turno, si "paso" es seleccionar_hora hay
+  horas_ofrecidas.
+
+Google Calendar y Twilio se reemplazan por dobles en memoria; no usa
+la base de datos. Uso, desde la raíz del repositorio:
+
+    python bench/estres_conversaciones.py [numeros] [repeticiones]
+"""
+
+import os
+import sys
+import time
+import threading
+from collections import defaultdict
+
+
+os.environ.setdefault("SECRET_KEY", "estres")
+os.environ.setdefault("WHATSAPP_COLA_MAX", "1000000")
+os.environ.pop("DATABASE_URL", None)
+os.environ["WA_SESSION_STORE"] = "memoria"
+os.environ["WA_DEDUP_BACKEND"] = "memoria"
+
+sys.path.insert(
+    0,
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+import app  # noqa: E402
+
+
+GUION = [
+    "menu",
+    "2",
+    "corte de pelo hombre",
+    "mañana",
+    "1",
+    "Ana",
+]
+
+INDICE_VACIO = app.construir_indice_ocupados([])
+
+LOCK = threading.Lock()
+ACTIVOS = defaultdict(int)
+RESPUESTAS = defaultdict(list)
+ERRORES = []
+
+procesar_original = app.procesar_mensaje_whatsapp
+
+
+def procesar_vigilado(telefono, texto):
+
+    with LOCK:
+
+        ACTIVOS[telefono] += 1
+
+        if ACTIVOS[telefono] > 1:
+            ERRORES.append(f"turnos solapados en {telefono}")
+
+    try:
+
+        respuesta = procesar_original(telefono, texto)
+
+        estado = app.get_wa_session(telefono)
+
+        if (
+            estado["paso"] == "seleccionar_hora"
+            and not estado["horas_ofrecidas"]
+        ):
+            ERRORES.append(
+                f"{telefono}: seleccionar_hora sin horas_ofrecidas"
+            )
+
+        return respuesta
+
+    finally:
+
+        with LOCK:
+            ACTIVOS[telefono] -= 1
+
+
+def enviar_falso(telefono, texto):
+
+    with LOCK:
+        RESPUESTAS[telefono].append(texto)
+
+
+def preparar():
+
+    app.obtener_indice_ocupados = lambda *args, **kwargs: INDICE_VACIO
+    app.enviar_mensaje_progreso_twilio = lambda *args, **kwargs: None
+    app.enviar_mensaje_twilio = enviar_falso
+    app.procesar_mensaje_whatsapp = procesar_vigilado
+
+
+def respuestas_esperadas(repeticiones):
+
+    telefono = "whatsapp:+56900000000"
+
+    return [
+        procesar_original(telefono, texto)
+        for _ in range(repeticiones)
+        for texto in GUION
+    ]
+
+
+def camino_sincrono(telefono, repeticiones):
+
+    for _ in range(repeticiones):
+
+        for texto in GUION:
+
+            with app.bloqueo_conversacion(telefono):
+                procesar_vigilado(telefono, texto)
+
+
+def main():
+
+    numeros = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    repeticiones = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    preparar()
+
+    esperadas = respuestas_esperadas(repeticiones)
+
+    telefonos = [
+        f"whatsapp:+5691{numero:07d}"
+        for numero in range(numeros)
+    ]
+
+    # Varios hilos por número en el camino síncrono: el orden entre
+    # ellos no está definido, pero no deben solaparse.
+    hilos = [
+        threading.Thread(
+            target=camino_sincrono,
+            args=(f"whatsapp:+5692{numero:07d}", repeticiones)
+        )
+        for numero in range(numeros // 10)
+        for _ in range(3)
+    ]
+
+    inicio = time.perf_counter()
+
+    for hilo in hilos:
+        hilo.start()
+
+    for _ in range(repeticiones):
+
+        for texto in GUION:
+
+            for telefono in telefonos:
+
+                app.EJECUTOR_WHATSAPP.enviar(
+                    telefono,
+                    app.atender_mensaje_whatsapp_async,
+                    telefono,
+                    texto
+                )
+
+    for hilo in hilos:
+        hilo.join()
+
+    total = numeros * repeticiones * len(GUION)
+
+    while True:
+
+        with LOCK:
+            recibidas = sum(
+                len(RESPUESTAS[telefono])
+                for telefono in telefonos
+            )
+
+        if recibidas >= total:
+            break
+
+        time.sleep(0.05)
+
+    duracion = time.perf_counter() - inicio
+
+    for telefono in telefonos:
+
+        if RESPUESTAS[telefono] != esperadas:
+            ERRORES.append(f"{telefono}: respuestas fuera de orden")
+
+    print(
+        "mensajes:", total + len(hilos) * repeticiones * len(GUION),
+        "segundos:", round(duracion, 2),
+        "errores:", len(ERRORES)
+    )
+
+    print(app.metricas_locks_conversacion())
+
+    for error in ERRORES[:20]:
+        print("ERROR:", error)
+
+    sys.exit(1 if ERRORES else 0)
+
+
+if __name__ == "__main__":
+    main()
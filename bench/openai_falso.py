@@ -0,0 +1,327 @@
+"""
+Prueba del cliente de OpenAI contra un servidor falso local.
+
+Levanta un servidor HTTP que imita /v1/chat/completions (respuestas
+normales, streaming SSE, errores 400 y 500, streams que se cuelgan o
+que gotean, y respuestas lentas una de cada dos) y comprueba:
+- un 500 abre el circuito y con el circuito abierto no sale ninguna
+  petición;
+- un error no transitorio (400) durante la prueba semiabierta no
+  cierra el circuito, y la siguiente llamada vuelve a probar;
+- un stream colgado corta por OPENAI_TIMEOUT_SECONDS y uno que gotea
+  por OPENAI_DEADLINE_SECONDS, ambos contando como fallo;
+- un stream que el cliente corta después de recibir texto cierra el
+  circuito;
+- con hedging, la respuesta llega antes que la petición lenta y la
+  perdedora se cierra.
+
+Uso, desde la raíz del repositorio:
+
+    python bench/openai_falso.py
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+SERVIDOR = {"modo": "ok", "peticiones": 0}
+
+
+def fragmento(texto):
+
+    return (
+        "data: "
+        + json.dumps({
+            "id": "falso",
+            "object": "chat.completion.chunk",
+            "created": 1,
+            "model": "falso",
+            "choices": [{
+                "index": 0,
+                "delta": {"content": texto},
+                "finish_reason": None,
+            }],
+        })
+        + "\n\n"
+    ).encode()
+
+
+class OpenAIFalso(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def responder_json(self, estado, cuerpo):
+
+        cuerpo = json.dumps(cuerpo).encode()
+
+        self.send_response(estado)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def do_POST(self):
+
+        self.rfile.read(int(self.headers["Content-Length"]))
+
+        SERVIDOR["peticiones"] += 1
+
+        numero = SERVIDOR["peticiones"]
+        modo = SERVIDOR["modo"]
+
+        try:
+
+            if modo in ("400", "500"):
+
+                self.responder_json(
+                    int(modo),
+                    {"error": {"message": "falso " + modo}}
+                )
+                return
+
+            if modo in ("sse", "colgado", "goteo"):
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+
+                self.wfile.write(fragmento("Ho"))
+                self.wfile.flush()
+
+                if modo == "colgado":
+                    time.sleep(10)
+                    return
+
+                if modo == "goteo":
+
+                    for _ in range(20):
+
+                        time.sleep(0.5)
+
+                        self.wfile.write(fragmento("."))
+                        self.wfile.flush()
+
+                self.wfile.write(fragmento("la"))
+                self.wfile.write(b"data: [DONE]\n\n")
+                return
+
+            if modo == "alterno" and numero % 2 == 1:
+                time.sleep(1.5)
+
+            self.responder_json(200, {
+                "id": "falso",
+                "object": "chat.completion",
+                "created": 1,
+                "model": "falso",
+                "choices": [{
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {
+                        "role": "assistant",
+                        "content": f"ok {numero}",
+                    },
+                }],
+                "usage": {
+                    "prompt_tokens": 5,
+                    "completion_tokens": 2,
+                    "total_tokens": 7,
+                },
+            })
+
+        except (BrokenPipeError, ConnectionResetError):
+            # El cliente cerró la conexión (timeout o hedge perdedor).
+            pass
+
+
+servidor = ThreadingHTTPServer(("127.0.0.1", 0), OpenAIFalso)
+
+threading.Thread(
+    target=servidor.serve_forever,
+    daemon=True
+).start()
+
+os.environ.update(
+    SECRET_KEY=os.getenv("SECRET_KEY", "openai-falso"),
+    OPENAI_API_KEY="falsa",
+    OPENAI_BASE_URL=f"http://127.0.0.1:{servidor.server_port}/v1",
+    OPENAI_TIMEOUT_SECONDS="1",
+    OPENAI_DEADLINE_SECONDS="3",
+    OPENAI_REINTENTOS="0",
+    OPENAI_REINTENTO_BASE_SECONDS="0.1",
+    OPENAI_CIRCUITO_FALLOS="1",
+    OPENAI_CIRCUITO_ABIERTO_SECONDS="0.5",
+    OPENAI_HEDGE_PERCENTIL="50",
+    OPENAI_CACHE_MAX_CHARS="0",
+)
+os.environ.pop("DATABASE_URL", None)
+
+sys.path.insert(
+    0,
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+import app  # noqa: E402
+
+
+ERRORES = []
+
+
+def comprobar(condicion, descripcion):
+
+    print("OK   " if condicion else "FALLA", descripcion)
+
+    if not condicion:
+        ERRORES.append(descripcion)
+
+
+def estado():
+
+    return app.CIRCUITO_OPENAI.metricas()["estado"]
+
+
+def modo(nombre):
+
+    SERVIDOR["modo"] = nombre
+
+
+def esperar_semiabierto():
+
+    time.sleep(0.6)
+
+
+def stream(pregunta="hola"):
+
+    inicio = time.perf_counter()
+
+    texto = "".join(app.responder_openai_stream([], pregunta))
+
+    return texto, time.perf_counter() - inicio
+
+
+def main():
+
+    modo("ok")
+    respuesta = app.responder_openai([], "hola")
+    comprobar(
+        respuesta.startswith("ok") and estado() == "cerrado",
+        "respuesta normal con el circuito cerrado"
+    )
+
+    modo("500")
+    respuesta = app.responder_openai([], "hola")
+    comprobar(
+        not respuesta.startswith("ok") and estado() == "abierto",
+        "un 500 abre el circuito"
+    )
+
+    peticiones = SERVIDOR["peticiones"]
+    app.responder_openai([], "hola")
+    comprobar(
+        SERVIDOR["peticiones"] == peticiones,
+        "con el circuito abierto no sale ninguna petición"
+    )
+
+    esperar_semiabierto()
+    modo("400")
+    app.responder_openai([], "hola")
+    comprobar(
+        estado() == "abierto",
+        "un 400 en la prueba semiabierta no cierra el circuito"
+    )
+
+    peticiones = SERVIDOR["peticiones"]
+    app.responder_openai([], "hola")
+    comprobar(
+        SERVIDOR["peticiones"] == peticiones + 1,
+        "después de un 400 la siguiente llamada vuelve a probar"
+    )
+
+    modo("sse")
+    texto, _ = stream()
+    comprobar(
+        texto == "Hola" and estado() == "cerrado",
+        "un stream completo cierra el circuito"
+    )
+
+    modo("colgado")
+    texto, duracion = stream()
+    comprobar(
+        duracion < 2.5 and estado() == "abierto",
+        f"un stream colgado corta por timeout ({duracion:.2f}s)"
+        " y cuenta como fallo"
+    )
+
+    esperar_semiabierto()
+    modo("sse")
+    stream()
+
+    modo("goteo")
+    texto, duracion = stream()
+    comprobar(
+        2.5 < duracion < 4.5 and estado() == "abierto",
+        f"un stream que gotea corta por el plazo total"
+        f" ({duracion:.2f}s) y cuenta como fallo"
+    )
+
+    esperar_semiabierto()
+    modo("sse")
+    flujo = app.responder_openai_stream([], "hola")
+    next(flujo)
+    flujo.close()
+    comprobar(
+        estado() == "cerrado",
+        "un stream cortado por el cliente con texto cierra el circuito"
+    )
+
+    modo("ok")
+
+    for _ in range(25):
+        app.responder_openai([], "hola")
+
+    cerradas = []
+    cerrar_original = app.cerrar_respuesta_openai
+
+    def cerrar_contando(futuro):
+
+        cerradas.append(futuro)
+
+        return cerrar_original(futuro)
+
+    app.cerrar_respuesta_openai = cerrar_contando
+
+    ganados = app.metricas_openai().get("hedges_ganados", 0)
+
+    modo("alterno")
+    SERVIDOR["peticiones"] = 0
+
+    inicio = time.perf_counter()
+    respuesta = app.responder_openai([], "hola")
+    duracion = time.perf_counter() - inicio
+
+    comprobar(
+        respuesta.startswith("ok") and duracion < 1.5,
+        f"el hedge responde antes que la petición lenta"
+        f" ({duracion:.2f}s)"
+    )
+
+    # La perdedora termina a los 1,5 s.
+    time.sleep(1.6)
+
+    comprobar(
+        cerradas
+        and app.metricas_openai().get("hedges_ganados", 0) > ganados,
+        "la petición perdedora se cierra"
+    )
+
+    print(json.dumps(app.metricas_openai(), ensure_ascii=False))
+
+    sys.exit(1 if ERRORES else 0)
+
+
+if __name__ == "__main__":
+    main()